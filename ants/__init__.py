@@ -5,6 +5,11 @@
 
 from random import random, randint, uniform
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Food:
     
     def __init__(self, x, y, size):
@@ -23,6 +28,114 @@ class Pheromone:
         self.strength *= d
         if self.strength < 0.05: self.strength = 0
 
+class Field:
+    
+    """A grid of pheromone strengths shared by the ants in a colony.
+    
+    Instead of every ant checking every pheromone of every other ant,
+    ants deposit scent in the cells of a 2D array and follow its gradient.
+    Evaporation and diffusion are applied to the whole array at once
+    with Field.update(), which should be called once each frame.
+    Colony.step() already does this, unless it is called with update=False.
+    
+    """
+    
+    def __init__(self, x, y, w, h, cell=5, evaporation=0.985, diffusion=0.1, threshold=0.01):
+        
+        if numpy is None:
+            raise ImportError("ants.Field requires numpy")
+        
+        self.x = x
+        self.y = y
+        self.cell = float(cell)
+        self.rows = int(h / self.cell) + 1
+        self.columns = int(w / self.cell) + 1
+        self.grid = numpy.zeros((self.rows, self.columns))
+        
+        self.evaporation = evaporation
+        self.diffusion = diffusion
+        self.threshold = threshold
+        
+    def _cells(self, x, y):
+        
+        """Returns the row and column of the cells at x and y (numbers or arrays),
+        and whether they are inside the field.
+        """
+        
+        i = numpy.floor((numpy.asarray(y, dtype=float) - self.y) / self.cell).astype(int)
+        j = numpy.floor((numpy.asarray(x, dtype=float) - self.x) / self.cell).astype(int)
+        inside = (i >= 0) & (i < self.rows) & (j >= 0) & (j < self.columns)
+        return numpy.clip(i, 0, self.rows-1), numpy.clip(j, 0, self.columns-1), inside
+        
+    def deposit(self, x, y, strength=1.0):
+        
+        """Adds pheromone at x and y.
+        
+        The x and y can also be arrays, to deposit many markers at once.
+        Markers outside the field are ignored.
+        
+        """
+        
+        i, j, inside = self._cells(x, y)
+        numpy.add.at(self.grid, (i[inside], j[inside]), numpy.broadcast_to(strength, inside.shape)[inside])
+        
+    def strength(self, x, y):
+        
+        """Returns the pheromone strength at x and y (numbers or arrays).
+        """
+        
+        i, j, inside = self._cells(x, y)
+        return numpy.where(inside, self.grid[i, j], 0.0)
+        
+    def gradient(self, x, y):
+        
+        """Returns the direction in which the pheromone strength increases at x and y.
+        
+        The gradient is the difference between the neighbouring cells,
+        left and right (dx) and above and below (dy).
+        
+        """
+        
+        i, j, inside = self._cells(x, y)
+        g = self.grid
+        dx = g[i, numpy.minimum(j+1, self.columns-1)] - g[i, numpy.maximum(j-1, 0)]
+        dy = g[numpy.minimum(i+1, self.rows-1), j] - g[numpy.maximum(i-1, 0), j]
+        return numpy.where(inside, dx, 0.0), numpy.where(inside, dy, 0.0)
+        
+    def sample(self, x, y):
+        
+        """Returns the strength and the gradient (dx, dy) at a single point x, y.
+        This is the same as Field.strength() and Field.gradient(), but faster for one ant.
+        """
+        
+        i = int((y - self.y) // self.cell)
+        j = int((x - self.x) // self.cell)
+        if not (0 <= i < self.rows and 0 <= j < self.columns):
+            return 0.0, 0.0, 0.0
+        g = self.grid
+        row = g[i]
+        dx = row[min(j+1, self.columns-1)] - row[max(j-1, 0)]
+        dy = g[min(i+1, self.rows-1), j] - g[max(i-1, 0), j]
+        return float(row[j]), float(dx), float(dy)
+        
+    def update(self):
+        
+        """Diffuses and evaporates the pheromone.
+        
+        Each cell moves towards the average of its four neighbours
+        by the diffusion rate, and then loses strength by the evaporation rate.
+        Cells weaker than the threshold are cleared.
+        
+        """
+        
+        g = self.grid
+        if self.diffusion:
+            p = numpy.pad(g, 1, mode="edge")
+            avg = (p[:-2,1:-1] + p[2:,1:-1] + p[1:-1,:-2] + p[1:-1,2:]) * 0.25
+            g += self.diffusion * (avg - g)
+        g *= self.evaporation
+        g[g < self.threshold] = 0
+
 class Ant:
 
     def __init__(self, colony, x, y):
@@ -36,6 +149,7 @@ class Ant:
         
         self.has_food = False
         self.trail = []
+        self.scent = 1.0
         self.wandering = randint(0, 10)
     
     def near(self, obj, radius=10):
@@ -92,6 +206,22 @@ class Ant:
         if self.wandering > self.colony.r: self.goal(self.colony)
         if self.near(self.colony): self.wandering = 0
     
+    def mark(self, x, y):
+        
+        """Leave a pheromone marker.
+        
+        If the colony has a pheromone field the marker is deposited there,
+        otherwise it is added to the ant's trail.
+        The scent weakens the farther the ant carries food from its source,
+        so in the field the trail gets stronger towards the food.
+        
+        """
+        
+        if self.colony.field is not None:
+            self.colony.field.deposit(x, y, self.scent)
+        else:
+            self.trail.append(Pheromone(x, y))
+    
     def follow(self):
         
         """Follow a nearby pheromone trail.
@@ -102,8 +232,23 @@ class Ant:
         the ant might lose interest in the trail,
         this ensures it doesn't get "stuck" on a useless trail.
         
+        If the colony has a pheromone field,
+        the ant is nudged along the gradient of the field towards stronger scent,
+        which leads towards the food.
+        
         """
         
+        field = self.colony.field
+        if field is not None:
+            if self.has_food: return
+            strength, dx, dy = field.sample(self.x, self.y)
+            m = max(abs(dx), abs(dy))
+            if strength > 0 and m > 0:
+                self.vx += 0.5 * dx / m
+                self.vy += 0.5 * dy / m
+                self.wandering = 0
+            return
+        
         for ant in self.colony:
             if ant != self or self.has_food == False:
                 for pheromone in ant.trail:
@@ -127,8 +272,10 @@ class Ant:
             if self.near(food, radius=max(2,food.size/2)) and self.has_food == False: 
                 food.size -= 1
                 if food.size == 0: self.colony.foodsources.remove(food)
-                self.trail = [Pheromone(food.x, food.y)]
-                self.trail.append(Pheromone(self.x, self.y))
+                self.trail = []
+                self.scent = 1.0
+                self.mark(food.x, food.y)
+                self.mark(self.x, self.y)
                 self.has_food = True
         
     def hoard(self, trail=0.5):
@@ -142,12 +289,13 @@ class Ant:
         
         if self.has_food:
             self.goal(self.colony)
+            self.scent *= 0.9
             if random() < trail:
-                self.trail.append(Pheromone(self.x, self.y))
+                self.mark(self.x, self.y)
         
         #Drop food and start wandering again
         if self.near(self.colony) and self.has_food:
-            self.trail.append(Pheromone(self.colony.x, self.colony.y))
+            self.mark(self.colony.x, self.colony.y)
             self.vx = 0
             self.vy = 0
             self.has_food = False
@@ -166,18 +314,55 @@ class Ant:
         self.x += self.vx
         self.y += self.vy
         
-        #trail evaporation
+        #trail evaporation (the field evaporates in Field.update())
+        if self.colony.field is not None: return
         for pheromone in self.trail:
             pheromone.evaporate()
-            if pheromone.strength == 0:
-                self.trail.remove(pheromone)
+        self.trail = [p for p in self.trail if p.strength > 0]
+
+def _column(name, j=None, type=float):
+    # A property that reads and writes an ant's row in one of the colony's arrays.
+    def get(self):
+        a = getattr(self.colony, name)
+        return type(a[self.i] if j is None else a[self.i, j])
+    def set(self, v):
+        a = getattr(self.colony, name)
+        if j is None:
+            a[self.i] = v
+        else:
+            a[self.i, j] = v
+    return property(get, set)
+
+class AntView(Ant):
+    
+    """An ant in a colony that is updated with Colony.step().
+    
+    It has the same attributes and methods as an Ant,
+    but its position, velocity and state are a row in the colony's arrays.
+    
+    """
+    
+    def __init__(self, colony, i):
+        self.colony = colony
+        self.i = i
+        self.trail = []
+    
+    x  = _column("p", 0)
+    y  = _column("p", 1)
+    vx = _column("v", 0)
+    vy = _column("v", 1)
+    has_food  = _column("carrying", type=bool)
+    wandering = _column("wandering", type=int)
+    scent     = _column("scent")
 
 class Colony(list):
     
-    def __init__(self, n, x, y, r):
+    def __init__(self, n, x, y, r, seed=None):
         
         self.foodsources = []
         self.food = 0
+        self.field = None
+        self.seed = seed
         
         for i in range(n):
             self.append(Ant(self, x, y))
@@ -185,13 +370,183 @@ class Colony(list):
         self.x = x
         self.y = y
         self.r = r
+        
+        self.p = None
+    
+    def _pack(self):
+        
+        """Moves the state of the ants into arrays,
+        and replaces the ants with AntView objects that refer to them.
+        """
+        
+        if numpy is None:
+            raise ImportError("Colony.step() requires numpy")
+        
+        self.p = numpy.array([(ant.x, ant.y) for ant in self], dtype=float).reshape(-1, 2)
+        self.v = numpy.array([(ant.vx, ant.vy) for ant in self], dtype=float).reshape(-1, 2)
+        self.carrying = numpy.array([ant.has_food for ant in self], dtype=bool)
+        self.wandering = numpy.array([ant.wandering for ant in self], dtype=int)
+        self.scent = numpy.array([getattr(ant, "scent", 1.0) for ant in self], dtype=float)
+        self[:] = [AntView(self, i) for i in range(len(self))]
+        
+        self.rng = numpy.random.default_rng(self.seed)
+        if self.field is None:
+            r = self.r * 3
+            self.field = Field(self.x-r, self.y-r, r*2, r*2)
+    
+    def _goal(self, m, x, y):
+        
+        """Sets x, y as the goal of the ants in mask m (see Ant.goal).
+        """
+        
+        dx = x - self.p[m,0]
+        dy = y - self.p[m,1]
+        vx = dx / numpy.abs(dx + 0.0001)
+        vy = dy / numpy.abs(dy + 0.0001)
+        ratio = numpy.abs(dx) / numpy.abs(dy + 0.0001)
+        vy = numpy.where(ratio != 0, vy / numpy.where(ratio != 0, ratio, 1), vy)
+        self.v[m,0] = vx
+        self.v[m,1] = vy
+        self.wandering[m] = 0
+    
+    def _harvest(self):
+        
+        """Returns the index of the food source each ant is near, or -1.
+        
+        The food sources are sorted into a grid of cells as large as the largest one,
+        so each ant only checks the sources in the 9 cells around it.
+        
+        """
+        
+        n = len(self)
+        found = numpy.full(n, -1)
+        if not self.foodsources:
+            return found
+        
+        f = numpy.array([(food.x, food.y, max(2, food.size/2.0)) for food in self.foodsources], dtype=float)
+        cell = f[:,2].max()
+        fi = numpy.floor(f[:,0:2] / cell).astype(numpy.int64)
+        ai = numpy.floor(self.p / cell).astype(numpy.int64)
+        lo = numpy.minimum(fi.min(axis=0), ai.min(axis=0)) - 1
+        rows = max(fi[:,1].max(), ai[:,1].max()) - lo[1] + 2
+        key = lambda c: (c[:,0] - lo[0]) * rows + (c[:,1] - lo[1])
+        order = numpy.argsort(key(fi), kind="stable")
+        keys = key(fi)[order]
+        
+        hungry = numpy.nonzero(~self.carrying)[0]
+        I, J = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                k = key(ai[hungry] + (dx, dy))
+                start = numpy.searchsorted(keys, k, "left")
+                count = numpy.searchsorted(keys, k, "right") - start
+                offset = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+                I.append(numpy.repeat(hungry, count))
+                J.append(order[numpy.repeat(start, count) + offset])
+        I = numpy.concatenate(I)
+        J = numpy.concatenate(J)
+        d = numpy.abs(self.p[I] - f[J,0:2])
+        m = (d[:,0] < f[J,2]) & (d[:,1] < f[J,2])
+        I, J = I[m], J[m]
+        
+        # Each ant takes from the first food source in the list it is near,
+        # and each source feeds as many ants as its size allows.
+        o = numpy.lexsort((J, I))
+        I, J = I[o], J[o]
+        first = numpy.ones(len(I), dtype=bool)
+        first[1:] = I[1:] != I[:-1]
+        I, J = I[first], J[first]
+        o = numpy.lexsort((I, J))
+        I, J = I[o], J[o]
+        rank = numpy.arange(len(J)) - numpy.searchsorted(J, J)
+        size = numpy.ceil([food.size for food in self.foodsources])
+        m = rank < size[J]
+        found[I[m]] = J[m]
+        return found
+    
+    def step(self, speed=2, trail=0.5, d=0.3, update=True):
+        
+        """Moves all the ants in the colony one frame ahead.
+        
+        This has the same behaviour as calling Ant.forage() for each ant,
+        but the colony is updated all at once with NumPy arrays.
+        Ants deposit their trails in the colony's pheromone field,
+        which is created around the colony if it doesn't have one,
+        and the field evaporates at the end of each step.
+        With update=False the field is left as it is,
+        for example when it is shared by several colonies
+        and Field.update() is called once per frame by the caller.
+        
+        The first step replaces the ants with AntView objects.
+        
+        """
+        
+        if self.p is None:
+            self._pack()
+        
+        n = len(self)
+        p, v = self.p, self.v
+        field = self.field
+        u = self.rng.random((n, 3))
+        
+        # Follow the pheromone field towards food.
+        s = field.strength(p[:,0], p[:,1])
+        gx, gy = field.gradient(p[:,0], p[:,1])
+        g = numpy.maximum(numpy.abs(gx), numpy.abs(gy))
+        m = ~self.carrying & (s > 0) & (g > 0)
+        v[m,0] += 0.5 * gx[m] / g[m]
+        v[m,1] += 0.5 * gy[m] / g[m]
+        self.wandering[m] = 0
+        
+        # Harvest nearby food.
+        found = self._harvest()
+        m = found >= 0
+        if m.any():
+            for j, k in zip(*numpy.unique(found[m], return_counts=True)):
+                self.foodsources[j].size -= k
+            f = numpy.array([(food.x, food.y) for food in self.foodsources])[found[m]]
+            field.deposit(f[:,0], f[:,1])
+            field.deposit(p[m,0], p[m,1])
+            self.foodsources[:] = [food for food in self.foodsources if food.size > 0]
+            self.carrying[m] = True
+            self.scent[m] = 1.0
+        
+        # Hoard food back to the colony.
+        m = self.carrying
+        if m.any():
+            self._goal(m, self.x, self.y)
+            self.scent[m] *= 0.9
+            t = m & (u[:,2] < trail)
+            field.deposit(p[t,0], p[t,1], self.scent[t])
+            home = m & (numpy.abs(p[:,0] - self.x) < 10) & (numpy.abs(p[:,1] - self.y) < 10)
+            field.deposit(numpy.full(home.sum(), self.x), numpy.full(home.sum(), self.y), self.scent[home])
+            v[home] = 0
+            self.carrying[home] = False
+            self.food += int(home.sum())
+        
+        # Wander.
+        v += (u[:,0:2] * 2 - 1) * d
+        self.wandering += 1
+        m = self.wandering > self.r
+        if m.any():
+            self._goal(m, self.x, self.y)
+        m = (numpy.abs(p[:,0] - self.x) < 10) & (numpy.abs(p[:,1] - self.y) < 10)
+        self.wandering[m] = 0
+        
+        numpy.clip(v, -speed, speed, out=v)
+        p += v
+        if update:
+            field.update()
 
-def colony(n, x, y, r):
-    return Colony(n, x, y, r)
+def colony(n, x, y, r, seed=None):
+    return Colony(n, x, y, r, seed)
     
 def food(x, y, size):
     return Food(x, y, size)
 
+def field(x, y, w, h, cell=5, evaporation=0.985, diffusion=0.1):
+    return Field(x, y, w, h, cell, evaporation, diffusion)
+
 if __name__=='__main__':
     c = colony(30, 0, 0, 100)
     c.foodsources.append(food(50, 50, 50))
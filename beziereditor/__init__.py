@@ -64,23 +64,25 @@ class MagneticGrid:
         self.stroke = _ctx.color(0.8)
         self.strokewidth = 0.5
 
-    def draw(self):
+        # The grid lines only change with the canvas size,
+        # they are kept in a path that is reused each frame.
+        self._path = None
+        self._key = None
 
-        _ctx.nofill()
-        _ctx.stroke(self.stroke)
-        _ctx.strokewidth(self.strokewidth)
-        _ctx.autoclosepath(False)
-        _ctx.beginpath(0,0)
-
-        for x in range(_ctx.WIDTH):
-            _ctx.moveto(x*self.padding, 0)
-            _ctx.lineto(x*self.padding, _ctx.HEIGHT)
+    def draw(self):
 
-        for y in range(_ctx.HEIGHT/self.padding):
-            _ctx.moveto(0, y*self.padding)
-            _ctx.lineto(_ctx.WIDTH, y*self.padding)
+        key = (_ctx.WIDTH, _ctx.HEIGHT, self.padding)
+        if self._key != key:
+            self._path = BezierPath()
+            for x in range(int(_ctx.WIDTH/self.padding)+1):
+                self._path.moveto(x*self.padding, 0)
+                self._path.lineto(x*self.padding, _ctx.HEIGHT)
+            for y in range(int(_ctx.HEIGHT/self.padding)+1):
+                self._path.moveto(0, y*self.padding)
+                self._path.lineto(_ctx.WIDTH, y*self.padding)
+            self._key = key
 
-        _ctx.endpath()
+        _ctx.drawpath(self._path, fill=None, stroke=self.stroke, strokewidth=self.strokewidth)
 
     def snap(self, x, y, treshold=0.4):
 
@@ -104,6 +106,21 @@ class BezierPathEditor:
 
     def __init__(self, path=None, file="path", freehand=False):
 
+        # Segment i runs from point i-1 to point i.
+        # The bounds of each segment are kept in a grid of cells
+        # so hit-testing only looks at segments near the mouse.
+        # Points that moved are listed in _changed, their segments
+        # are recomputed on the next frame. Points being edited are
+        # _live: their segments and markers are redrawn each frame,
+        # the rest of the path comes from a cached overlay.
+        self._bounds = []
+        self._cells = {}
+        self._cellsize = 50
+        self._changed = set()
+        self._live = set()
+        self._overlay = None
+        self._path = None
+
         if path != None:
             self.path = path
             self._points = list(path)
@@ -115,6 +132,7 @@ class BezierPathEditor:
         else:
             self.path = None
             self._points = []
+        self._reset()
 
         # These variables discern between different
         # modes of interaction.
@@ -225,12 +243,248 @@ class BezierPathEditor:
         y = y0 + sin(radians(angle)) * distance
         return Point(x, y)
 
+    def _get_path(self):
+        if self._path is None and len(self._points) > 0:
+            self._path = self._build(range(len(self._points)))
+        return self._path
+
+    def _set_path(self, path):
+        self._path = path
+
+    path = property(_get_path, _set_path)
+
+    def _touch(self, i):
+
+        """ Marks point i as moved by the user.
+
+        Its segments are recomputed on the next frame
+        and drawn apart from the cached overlay until the mouse is released.
+
+        """
+
+        self._changed.add(i)
+        self._path = None
+        if i not in self._live:
+            self._live.add(i)
+            self._overlay = None
+
+    def _reset(self):
+
+        """ Recomputes all segments, after points were inserted, deleted or all moved.
+        """
+
+        self._bounds = []
+        self._cells = {}
+        self._changed = set()
+        self._live = set()
+        self._overlay = None
+        self._path = None
+
+    def _settle(self):
+
+        """ Folds the points that were being edited back into the cached overlay.
+        """
+
+        if len(self._live) > 0:
+            self._live = set()
+            self._overlay = None
+
+    def _start(self, i):
+
+        """ Returns the index of the point that starts the subpath containing point i.
+        """
+
+        while i > 0 and self._points[i].cmd != MOVETO:
+            i -= 1
+        return i
+
+    def _segments(self, points):
+
+        """ Returns the indices of the segments that depend on the given points.
+        """
+
+        n = len(self._points)
+        segments = set()
+        for i in points:
+            segments.update([j for j in (i, i+1) if j < n])
+            # Moving the start of a subpath also moves its closing line.
+            if i == 0 or self._points[i].cmd == MOVETO:
+                for j in range(i+1, n):
+                    if self._points[j].cmd == CLOSE:
+                        segments.add(j)
+                    if self._points[j].cmd in (MOVETO, CLOSE):
+                        break
+        return segments
+
+    def _segment_bounds(self, i):
+
+        """ Returns the bounding box of segment i, including its control points.
+        """
+
+        pt = self._points[i]
+        xs = [pt.x]
+        ys = [pt.y]
+        if i > 0 and pt.cmd != MOVETO:
+            prev = self._points[i-1]
+            xs.append(prev.x)
+            ys.append(prev.y)
+            if pt.cmd == CURVETO:
+                xs.extend((pt.ctrl1.x, pt.ctrl2.x))
+                ys.extend((pt.ctrl1.y, pt.ctrl2.y))
+            elif pt.cmd == CLOSE:
+                start = self._points[self._start(i-1)]
+                xs.append(start.x)
+                ys.append(start.y)
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def _cells_in(self, l, t, r, b):
+        s = float(self._cellsize)
+        return [(i, j) for i in range(int(l//s), int(r//s)+1)
+                       for j in range(int(t//s), int(b//s)+1)]
+
+    def _sync(self):
+
+        """ Brings the segment bounds and the grid of cells up to date.
+        """
+
+        n = len(self._points)
+        if len(self._bounds) > n:
+            self._reset()
+        if len(self._bounds) < n:
+            self._changed.update(range(len(self._bounds), n))
+            self._bounds.extend([None] * (n-len(self._bounds)))
+        for i in self._segments(self._changed):
+            if self._bounds[i] is not None:
+                for cell in self._cells_in(*self._bounds[i]):
+                    self._cells[cell].discard(i)
+            self._bounds[i] = self._segment_bounds(i)
+            for cell in self._cells_in(*self._bounds[i]):
+                self._cells.setdefault(cell, set()).add(i)
+        self._changed = set()
+
+    def _near(self, x, y, d=5):
+
+        """ Returns the indices of the segments that come within d of x, y.
+
+        Point i always lies inside the bounds of segment i,
+        so this also finds the points near x, y.
+
+        """
+
+        self._sync()
+        near = set()
+        for cell in self._cells_in(x-d, y-d, x+d, y+d):
+            for i in self._cells.get(cell, ()):
+                l, t, r, b = self._bounds[i]
+                if l-d <= x <= r+d and t-d <= y <= b+d:
+                    near.add(i)
+        return near
+
+    def _build(self, segments):
+
+        """ Returns a path with the given segments, in order.
+
+        Where segments are left out the path is broken with a MOVETO.
+
+        """
+
+        p = BezierPath()
+        last = None
+        broken = False
+        for i in segments:
+            pt = self._points[i]
+            if i == 0 or pt.cmd == MOVETO:
+                p.moveto(pt.x, pt.y)
+                broken = False
+                last = i
+                continue
+            if last != i-1:
+                prev = self._points[i-1]
+                p.moveto(prev.x, prev.y)
+                broken = True
+            if pt.cmd == CLOSE:
+                if broken:
+                    start = self._points[self._start(i-1)]
+                    p.lineto(start.x, start.y)
+                else:
+                    p.closepath()
+            elif pt.cmd == LINETO:
+                p.lineto(pt.x, pt.y)
+            elif pt.cmd == CURVETO:
+                p.curveto(pt.ctrl1.x, pt.ctrl1.y,
+                          pt.ctrl2.x, pt.ctrl2.y,
+                          pt.x, pt.y)
+            last = i
+        return p
+
+    def _markers(self, points, r=4):
+
+        """ Returns paths with the markers for the given points.
+
+        The first contains filled dots, the second the open MOVETO circles.
+
+        """
+
+        dots = BezierPath()
+        movetos = BezierPath()
+        for i in points:
+            pt = self._points[i]
+            if not pt.freehand:
+                if pt.cmd != MOVETO:
+                    dots.oval(pt.x-r/2, pt.y-r/2, r, r)
+                else:
+                    movetos.oval(pt.x-r/2, pt.y-r/2, r, r)
+        return dots, movetos
+
+    def draw_path(self):
+
+        """ Draws the path and the point markers.
+
+        Everything except the points being edited is drawn from a cached overlay.
+
+        """
+
+        self._sync()
+        if self._overlay is None:
+            n = len(self._points)
+            live = self._segments(self._live)
+            path = self._build([i for i in range(n) if i not in live])
+            dots, movetos = self._markers([i for i in range(n) if i not in self._live])
+            self._overlay = path, dots, movetos
+            if len(live) == 0:
+                self._path = path
+
+        path, dots, movetos = self._overlay
+        fill = self.path_fill
+        if len(self._live) > 0:
+            # The cached path has gaps where points are edited,
+            # the fill is drawn from the whole path.
+            if fill.a > 0:
+                _ctx.drawpath(self.path, fill=fill, stroke=None, strokewidth=self.strokewidth)
+            fill = None
+            live_path = self._build(sorted(self._segments(self._live)))
+            live_dots, live_movetos = self._markers(sorted(self._live))
+        else:
+            live_path = live_dots = live_movetos = None
+
+        for p in (path, live_path):
+            if p is not None:
+                _ctx.drawpath(p, fill=fill, stroke=self.path_color, strokewidth=self.strokewidth)
+        for p in (movetos, live_movetos):
+            if p is not None:
+                _ctx.drawpath(p, fill=None, stroke=self.path_color, strokewidth=self.strokewidth)
+        for p in (dots, live_dots):
+            if p is not None:
+                _ctx.drawpath(p, fill=self.path_color, stroke=None)
+
     def contains_point(self, x, y, d=2):
 
         """ Returns true when x, y is on the path stroke outline.
         """
 
-        if self.path != None and len(self.path) > 1 \
+        # Only look at the path when the mouse is near one of its segments.
+        if len(self._near(x, y, d)) > 0 \
+        and self.path != None and len(self.path) > 1 \
         and self.path.contains(x, y):
             # If all points around the mouse are also part of the path,
             # this means we are somewhere INSIDE the path.
@@ -253,70 +507,75 @@ class BezierPathEditor:
         """ Inserts a point on the path at the mouse location.
 
         We first need to check if the mouse location is on the path.
-        Inserting point is time intensive and experimental.
+        Only the segments near the mouse are searched,
+        the one that passes closest gets split in two.
 
         """
 
         from plotdevice.lib import pathmatics
 
-        # Do a number of checks distributed along the path.
-        # Keep the one closest to the actual mouse location.
-        # Ten checks works fast but leads to imprecision in sharp corners
-        # and curves closely located next to each other.
-        # I prefer the slower but more stable approach.
-        n = 100
+        def point(i, t, handles=False):
+            pt = self._points[i]
+            prev = self._points[i-1]
+            if pt.cmd == CURVETO:
+                return pathmatics.curvepoint(t, prev.x, prev.y,
+                                             pt.ctrl1.x, pt.ctrl1.y,
+                                             pt.ctrl2.x, pt.ctrl2.y,
+                                             pt.x, pt.y, handles)
+            if pt.cmd == CLOSE:
+                pt = self._points[self._start(i-1)]
+            return pathmatics.linepoint(t, prev.x, prev.y, pt.x, pt.y)
+
+        # For each nearby segment, do a number of checks distributed along it
+        # and keep the one closest to the actual mouse location.
+        # Next, scan the area around the approximation:
+        # each decimal precision takes 20 iterations.
         closest = None
-        dx0 = float(INFINITY)
-        dy0 = float(INFINITY)
-        for i in range(n):
-            t = float(i)/n
-            pt = self.path.point(t)
-            dx = abs(pt.x-x)
-            dy = abs(pt.y-y)
-            if dx+dy <= dx0+dy0:
-                dx0 = dx
-                dy0 = dy
-                closest = t
-
-        # Next, scan the area around the approximation.
-        # If the closest point is located at 0.2 on the path,
-        # we need to scan between 0.1 and 0.3 for a better
-        # approximation. If 1.5 was the best guess, scan
-        # 1.40, 1.41 ... 1.59 and so on.
-        # Each decimal precision takes 20 iterations.
-        decimals = [3,4]
-        for d in decimals:
-            d = 1.0/pow(10,d)
-
-            for i in range(20):
-                t = closest-d + float(i)*d*0.1
-                if t < 0.0: t = 1.0+t
-                if t > 1.0: t = t-1.0
-                pt = self.path.point(t)
-                dx = abs(pt.x-x)
-                dy = abs(pt.y-y)
-                if dx <= dx0 and dy <= dy0:
-                    dx0 = dx
-                    dy0 = dy
-                    closest_precise = t
-
-            closest = closest_precise
-
-        # Update the points list with the inserted point.
-        p = pathmatics.insert_point(self.path, closest_precise)
-        i, t, pt = pathmatics._locate(self.path, closest_precise)
-        i += 1
+        d0 = float(INFINITY)
+        for i in sorted(self._near(x, y, d=5)):
+            if i == 0 or self._points[i].cmd == MOVETO:
+                continue
+            d1 = float(INFINITY)
+            for j in range(21):
+                t = j * 0.05
+                px, py = point(i, t)[:2]
+                if abs(px-x) + abs(py-y) < d1:
+                    d1 = abs(px-x) + abs(py-y)
+                    t1 = t
+            step = 0.05
+            for decimal in range(3):
+                t0 = t1
+                for j in range(-10, 11):
+                    t = min(max(t0 + j*step*0.1, 0.0), 1.0)
+                    px, py = point(i, t)[:2]
+                    if abs(px-x) + abs(py-y) < d1:
+                        d1 = abs(px-x) + abs(py-y)
+                        t1 = t
+                step *= 0.1
+            if d1 < d0:
+                d0 = d1
+                closest = (i, t1)
+        if closest is None:
+            return
+
+        # Split the segment at t and update the points list.
+        i, t = closest
         pt = PathElement()
-        pt.cmd = p[i].cmd
-        pt.x = p[i].x
-        pt.y = p[i].y
-        pt.ctrl1 = Point(p[i].ctrl1.x, p[i].ctrl1.y)
-        pt.ctrl2 = Point(p[i].ctrl2.x, p[i].ctrl2.y)
         pt.freehand = False
+        if self._points[i].cmd == CURVETO:
+            pt.cmd = CURVETO
+            pt.x, pt.y, c1x, c1y, c2x, c2y, h1x, h1y, h2x, h2y = point(i, t, handles=True)
+            pt.ctrl1 = Point(h1x, h1y)
+            pt.ctrl2 = Point(c1x, c1y)
+            self._points[i].ctrl1 = Point(c2x, c2y)
+            self._points[i].ctrl2 = Point(h2x, h2y)
+        else:
+            pt.cmd = LINETO
+            pt.x, pt.y = point(i, t)
+            pt.ctrl1 = Point(pt.x, pt.y)
+            pt.ctrl2 = Point(pt.x, pt.y)
         self._points.insert(i, pt)
-        self._points[i-1].ctrl1 = Point(p[i-1].ctrl1.x, p[i-1].ctrl1.y)
-        self._points[i+1].ctrl1 = Point(p[i+1].ctrl1.x, p[i+1].ctrl1.y)
-        self._points[i+1].ctrl2 = Point(p[i+1].ctrl2.x, p[i+1].ctrl2.y)
+        self._reset()
 
     def update(self):
 
@@ -440,12 +699,14 @@ class BezierPathEditor:
                         rx, ry = self.reflect(prev.x, prev.y, prev.ctrl2.x, prev.ctrl2.y)
                         self.new.ctrl1 = Point(rx, ry)
                     self._points.append(self.new)
+                    self._touch(len(self._points)-1)
                 else:
                     # Illustrator-like behavior:
                     # when the handle is dragged downwards,
                     # the path bulges upwards.
                     rx, ry = self.reflect(self.new.x, self.new.y, x, y)
                     self.new.ctrl2 = Point(rx, ry)
+                    self._touch(len(self._points)-1)
 
             # Edit mode
             elif self.new == None:
@@ -496,6 +757,7 @@ class BezierPathEditor:
                         next = self._points[self.edit+1]
                         next.ctrl1.x += dx
                         next.ctrl1.y += dy
+                    self._touch(self.edit)
 
                 # In drag-handle mode,
                 # set the path's handle to the mouse location.
@@ -509,6 +771,8 @@ class BezierPathEditor:
                         d = self.distance(prev.x, prev.y, prev.ctrl2.x, prev.ctrl2.y)
                         a = self.angle(prev.x, prev.y, pt.ctrl1.x, pt.ctrl1.y)
                         prev.ctrl2 = self.coordinates(prev.x, prev.y, d, a+180)
+                        self._touch(self.edit-1)
+                    self._touch(self.edit)
                 if self.drag_handle2 == True:
                     pt.ctrl2 = Point(x, y)
                     if self.edit < len(self._points)-1 \
@@ -517,11 +781,13 @@ class BezierPathEditor:
                         d = self.distance(pt.x, pt.y, next.ctrl1.x, next.ctrl1.y)
                         a = self.angle(pt.x, pt.y, pt.ctrl2.x, pt.ctrl2.y)
                         next.ctrl1 = self.coordinates(pt.x, pt.y, d, a+180)
+                    self._touch(self.edit)
 
         elif not self.freehand:
 
             # The mouse button is released
             # so we are not dragging anything around.
+            self._settle()
             self.new = None
             self.drag_point = False
             self.drag_handle1 = False
@@ -559,6 +825,7 @@ class BezierPathEditor:
                             self.last_moveto = pt
                 self.delete = None
                 self.edit = None
+                self._reset()
 
             # The moveto button for the last point
             # in the path was clicked.
@@ -636,6 +903,7 @@ class BezierPathEditor:
                     pt.ctrl1.y += dy
                     pt.ctrl2.x += dx
                     pt.ctrl2.y += dy
+                self._reset()
 
     def draw(self):
 
@@ -660,25 +928,21 @@ class BezierPathEditor:
         _ctx.nofill()
         if len(self._points) > 0:
 
-            first = True
-            for i in range(len(self._points)):
+            # Draw the current path and a circle for each point.
+            self.draw_path()
+
+            # Only the point being added or edited and
+            # the points under the mouse get handles and coordinates.
+            indices = set([i for i in self._near(x, y)
+                           if self.overlap(x, y, self._points[i].x, self._points[i].y)])
+            if self.edit != None:
+                indices.add(self.edit)
+            if self.new != None:
+                indices.add(len(self._points)-1)
+
+            for i in sorted(indices):
 
-                # Construct the path.
                 pt = self._points[i]
-                if first:
-                    _ctx.beginpath(pt.x, pt.y)
-                    first = False
-                else:
-                    if pt.cmd == CLOSE:
-                        _ctx.closepath()
-                    elif pt.cmd == MOVETO:
-                        _ctx.moveto(pt.x, pt.y)
-                    elif pt.cmd == LINETO:
-                        _ctx.lineto(pt.x, pt.y)
-                    elif pt.cmd == CURVETO:
-                        _ctx.curveto(pt.ctrl1.x, pt.ctrl1.y,
-                                     pt.ctrl2.x, pt.ctrl2.y,
-                                     pt.x, pt.y)
                 # In add- or edit-mode,
                 # display the current point's handles.
                 if ((i == self.edit and self.new == None) \
@@ -739,24 +1003,7 @@ class BezierPathEditor:
                 and not pt.freehand:
                     _ctx.text(txt, pt.x+r, pt.y+2)
 
-                # Draw a circle for each point
-                # in the path.
-                if not pt.freehand:
-                    if pt.cmd != MOVETO:
-                        _ctx.fill(self.path_color)
-                        _ctx.nostroke()
-                    else:
-                        _ctx.stroke(self.path_color)
-                        _ctx.nofill()
-                    _ctx.oval(pt.x-r/2, pt.y-r/2, r, r)
-
-            # Draw the current path,
-            # update the path property.
-            _ctx.stroke(self.path_color)
-            _ctx.fill(self.path_fill)
-            _ctx.autoclosepath(False)
-            p = _ctx.endpath()
-            self.path = p
+            pt = self._points[-1]
 
             # Possible to insert a point here.
             if self.insert:
@@ -774,6 +1021,7 @@ class BezierPathEditor:
                 _ctx.nofill()
                 _ctx.stroke(self.new_color)
                 rx, ry = self.reflect(pt.x, pt.y, pt.ctrl2.x, pt.ctrl2.y)
+                _ctx.autoclosepath(False)
                 _ctx.beginpath(pt.x, pt.y)
                 _ctx.curveto(rx, ry, x, y, x, y)
                 _ctx.endpath()
@@ -875,6 +1123,7 @@ class BezierPathEditor:
             pt.ctrl1 = Point(x,y)
             pt.ctrl2 = Point(x,y)
             self._points.append(pt)
+            self._touch(len(self._points)-1)
 
             # Draw the current location of the cursor.
             r = 4
@@ -894,8 +1143,10 @@ class BezierPathEditor:
             self.freehand_move = True
             if self._dirty:
                 self._points[-1].freehand = False
+                self._touch(len(self._points)-1)
                 self.export_svg()
                 self._dirty = False
+            self._settle()
 
     def export_svg(self):
 
@@ -6,10 +6,17 @@
 # For the original pseucode the algorithm is based on:
 # http://www.vergenet.net/~conrad/boids/pseudocode.html
 
-from plotdevice.util import random
+from random import Random
+from copy import deepcopy
+
 from plotdevice.lib import register
 _ctx = register(__name__)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Boid:
 
     def __init__(self, boids, x, y, z):
@@ -39,26 +46,33 @@ class Boid:
 
         return b
 
-    def cohesion(self, d=100):
+    def cohesion(self, d=100, neighbours=None):
 
         """ Boids move towards the flock's centre of mass.
 
         The centre of mass is the average position of all boids,
         not including itself (the "perceived centre").
+        If a list of neighbours is given, only those are taken into account.
 
         """
 
+        if neighbours is None:
+            neighbours = self.boids
+
         vx = vy = vz = 0
-        for b in self.boids:
+        n = 0
+        for b in neighbours:
             if b != self:
                 vx, vy, vz = vx+b.x, vy+b.y, vz+b.z
+                n += 1
 
-        n = len(self.boids)-1
+        if n == 0:
+            return 0, 0, 0
         vx, vy, vz = vx/n, vy/n, vz/n
 
         return (vx-self.x)/d, (vy-self.y)/d, (vz-self.z)/d
 
-    def separation(self, r=10):
+    def separation(self, r=10, neighbours=None):
 
         """ Boids keep a small distance from other boids.
 
@@ -67,8 +81,11 @@ class Boid:
 
         """
 
+        if neighbours is None:
+            neighbours = self.boids
+
         vx = vy = vz = 0
-        for b in self.boids:
+        for b in neighbours:
             if b != self:
                 if abs(self.x-b.x) < r: vx += (self.x-b.x)
                 if abs(self.y-b.y) < r: vy += (self.y-b.y)
@@ -76,17 +93,23 @@ class Boid:
 
         return vx, vy, vz
 
-    def alignment(self, d=5):
+    def alignment(self, d=5, neighbours=None):
 
         """ Boids match velocity with other boids.
         """
 
+        if neighbours is None:
+            neighbours = self.boids
+
         vx = vy = vz = 0
-        for b in self.boids:
-           if b != self:
-               vx, vy, vz = vx+b.vx, vy+b.vy, vz+b.vz
+        n = 0
+        for b in neighbours:
+            if b != self:
+                vx, vy, vz = vx+b.vx, vy+b.vy, vz+b.vz
+                n += 1
 
-        n = len(self.boids)-1
+        if n == 0:
+            return 0, 0, 0
         vx, vy, vz = vx/n, vy/n, vz/n
 
         return (vx-self.vx)/d, (vy-self.vy)/d, (vz-self.vz)/d
@@ -129,12 +152,16 @@ class Boid:
 
 class Boids(list):
 
-    def __init__(self, n, x, y, w, h):
+    def __init__(self, n, x, y, w, h, seed=None):
+
+        # Each flock has its own random generator,
+        # so two flocks with the same seed behave exactly the same.
+        self.rng = Random(seed)
 
         for i in range(n):
-            dx = random(w)
-            dy = random(h)
-            z = random(200)
+            dx = self._random(w)
+            dy = self._random(h)
+            z = self._random(200)
             b = Boid(self, x+dx, y+dy, z)
             self.append(b)
 
@@ -150,7 +177,7 @@ class Boids(list):
 
         self._perch = 1.0 # Lower this number to simulate diving.
         self._perch_y = _ctx.HEIGHT
-        self._perch_t = lambda:25+random(50)
+        self._perch_t = None # 25-75 frames.
 
         self.has_goal = False
         self.flee = False
@@ -162,6 +189,19 @@ class Boids(list):
     def _boids(self): return self
     boids = property(_boids)
 
+    def _random(self, v=None):
+
+        """ Returns a random number between 0.0 and 1.0, or between 0 and v,
+        drawn from the flock's own random generator (see plotdevice.util.random).
+        """
+
+        r = float(self.rng.random())
+        if v is None:
+            return r
+        if isinstance(v, float):
+            return r * v
+        return int(r * v)
+
     def copy(self):
 
         boids = Boids(0, self.x, self.y, self.w, self.h)
@@ -181,11 +221,78 @@ class Boids(list):
         boids._gy = self._gy
         boids._gz = self._gz
 
+        boids.rng = deepcopy(self.rng)
+
         for boid in self:
-            boids.append(boid.copy())
+            b = boid.copy()
+            b.boids = b.flock = boids
+            boids.append(b)
 
         return boids
 
+    def state(self):
+
+        """ Returns the state of the boids as an (n,8) array.
+        Each row has the x, y, z, vx, vy, vz, is_perching and perch frames of a boid.
+        """
+
+        return numpy.array([
+            (b.x, b.y, b.z, b.vx, b.vy, b.vz, b.is_perching, b._perch_t) for b in self
+        ], dtype=float).reshape(-1, 8)
+
+    def snapshot(self):
+
+        """ Returns a Snapshot of the flock, which can be restored later.
+        Unlike Boids.copy(), it only stores arrays and doesn't create new Boid objects.
+        """
+
+        return Snapshot(self.state(), self.scattered, self._scatter_i, deepcopy(self.rng))
+
+    def restore(self, snapshot):
+
+        """ Resets the flock to the given Snapshot.
+        Updating the flock afterwards yields the same frames as after the snapshot was taken.
+        """
+
+        if len(snapshot.state) != len(self):
+            raise ValueError("snapshot has %s boids, flock has %s" % (len(snapshot.state), len(self)))
+        for b, (x, y, z, vx, vy, vz, perching, t) in zip(self, snapshot.state.tolist()):
+            b.x, b.y, b.z = x, y, z
+            b.vx, b.vy, b.vz = vx, vy, vz
+            b.is_perching = bool(perching)
+            b._perch_t = t
+        self.scattered = snapshot.scattered
+        self._scatter_i = snapshot.scatter_i
+        self.rng = deepcopy(snapshot.rng)
+
+    def simulate(self, frames, path=None, **kwargs):
+
+        """ Updates the flock for the given number of frames and returns the trajectories.
+
+        The trajectories are a (frames, n, 6) array with the x, y, z, vx, vy, vz of each boid
+        after each update, so drawing a frame is an array lookup instead of a simulation.
+        Row i always belongs to the same boid, even if the flock is shuffled.
+        With a path, the array is memory-mapped to a .npy file (see load()).
+        Keyword arguments are passed to Boids.update().
+
+        """
+
+        shape = (frames, len(self), 6)
+        if path:
+            a = numpy.lib.format.open_memmap(path, mode="w+", dtype=float, shape=shape)
+        else:
+            a = numpy.empty(shape)
+        order = list(self)
+        for i in range(frames):
+            self.update(**kwargs)
+            self._record(a[i], order)
+        if path:
+            a.flush()
+        return a
+
+    def _record(self, out, order):
+        out[:] = [(b.x, b.y, b.z, b.vx, b.vy, b.vz) for b in order]
+
     def scatter(self, chance=0.005, frames=50):
 
         self._scatter = chance
@@ -195,7 +302,7 @@ class Boids(list):
 
         self._scatter = 0.0
 
-    def perch(self, ground=None, chance=1.0, frames=lambda:25+random(50)):
+    def perch(self, ground=None, chance=1.0, frames=None):
 
         if ground == None:
             ground = _ctx.HEIGHT
@@ -220,6 +327,35 @@ class Boids(list):
 
         self.has_goal = False
 
+    def neighbours(self, radius):
+
+        """ Returns a function that yields the boids within radius of a given boid.
+
+        The boids are bucketed into a 3D grid of cells the size of the radius,
+        so only the boids in the 27 surrounding cells need to be checked.
+
+        """
+
+        cells = {}
+        for b in self:
+            k = (int(b.x // radius), int(b.y // radius), int(b.z // radius))
+            cells.setdefault(k, []).append(b)
+
+        r2 = radius * radius
+        def near(boid):
+            i, j, k = int(boid.x // radius), int(boid.y // radius), int(boid.z // radius)
+            n = []
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    for dk in (-1, 0, 1):
+                        for b in cells.get((i+di, j+dj, k+dk), ()):
+                            dx, dy, dz = b.x-boid.x, b.y-boid.y, b.z-boid.z
+                            if dx*dx + dy*dy + dz*dz <= r2:
+                                n.append(b)
+            return n
+
+        return near
+
     def constrain(self):
 
         """ Cages the flock inside the x, y, w, h area.
@@ -238,38 +374,35 @@ class Boids(list):
 
         for b in self:
 
-            if b.x < self.x-dx: b.vx += random(dx)
-            if b.y < self.y-dy: b.vy += random(dy)
-            if b.x > self.x+self.w+dx: b.vx -= random(dx)
-            if b.y > self.y+self.h+dy: b.vy -= random(dy)
+            if b.x < self.x-dx: b.vx += self._random(dx)
+            if b.y < self.y-dy: b.vy += self._random(dy)
+            if b.x > self.x+self.w+dx: b.vx -= self._random(dx)
+            if b.y > self.y+self.h+dy: b.vy -= self._random(dy)
             if b.z < 0: b.vz += 10
             if b.z > 100: b.vz -= 10
 
-            if b.y > self._perch_y and random() < self._perch:
+            if b.y > self._perch_y and self._random() < self._perch:
                 b.y = self._perch_y
                 b.vy = -abs(b.vy) * 0.2
                 b.is_perching = True
-                try:
-                    b._perch_t = self._perch_t()
-                except:
-                    b._perch_t = self._perch_t
+                b._perch_t = self._perch_frames()
 
-    def update(self,
-               shuffled=True,
-               cohesion=100,
-               separation=10,
-               alignment=5,
-               goal=20,
-               limit=30):
+    def _perch_frames(self):
 
-        """ Calculates the next motion frame for the flock.
+        """ Returns the number of frames a boid that lands will perch.
         """
 
-        # Shuffling the list of boids ensures fluid movement.
-        # If you need the boids to retain their position in the list
-        # each update, set the shuffled parameter to False.
-        from random import shuffle
-        if shuffled: shuffle(self)
+        if self._perch_t is None:
+            return 25 + self._random(50)
+        try:
+            return self._perch_t()
+        except:
+            return self._perch_t
+
+    def _weights(self):
+
+        """ Returns the weights of cohesion, separation, alignment and goal for the next frame.
+        """
 
         m1 = 1.0 # cohesion
         m2 = 1.0 # separation
@@ -281,7 +414,7 @@ class Boids(list):
         # and their joint alignment (m3) is dimished,
         # causing boids to oscillate in confusion.
         # Setting Boids.scatter(chance=0) ensures they never scatter.
-        if not self.scattered and random() < self._scatter:
+        if not self.scattered and self._random() < self._scatter:
             self.scattered = True
         if self.scattered:
             m1 = -m1
@@ -298,6 +431,36 @@ class Boids(list):
         if self.flee:
             m4 = -m4
 
+        return m1, m2, m3, m4
+
+    def update(self,
+               shuffled=True,
+               cohesion=100,
+               separation=10,
+               alignment=5,
+               goal=20,
+               limit=30,
+               radius=None):
+
+        """ Calculates the next motion frame for the flock.
+
+        By default, each boid looks at every other boid in the flock.
+        With a perception radius, each boid only looks at the boids within that radius,
+        which is much faster for large flocks.
+
+        """
+
+        # Shuffling the list of boids ensures fluid movement.
+        # If you need the boids to retain their position in the list
+        # each update, set the shuffled parameter to False.
+        if shuffled: self.rng.shuffle(self)
+
+        m1, m2, m3, m4 = self._weights()
+
+        near = None
+        if radius:
+            near = self.neighbours(radius)
+
         for b in self:
 
             # A boid that is perching will continue to do so
@@ -309,9 +472,13 @@ class Boids(list):
                 else:
                     b.is_perching = False
 
-            vx1, vy1, vz1 = b.cohesion(cohesion)
-            vx2, vy2, vz2 = b.separation(separation)
-            vx3, vy3, vz3 = b.alignment(alignment)
+            neighbours = None
+            if near:
+                neighbours = near(b)
+
+            vx1, vy1, vz1 = b.cohesion(cohesion, neighbours)
+            vx2, vy2, vz2 = b.separation(separation, neighbours)
+            vx3, vy3, vz3 = b.alignment(alignment, neighbours)
             vx4, vy4, vz4 = b.goal(self._gx, self._gy, self._gz, goal)
 
             b.vx += m1*vx1 + m2*vx2 + m3*vx3 + m4*vx4
@@ -326,6 +493,264 @@ class Boids(list):
 
         self.constrain()
 
-def flock(n, x, y, w, h):
+class Snapshot:
+
+    """ The state of a flock at one frame, returned from Boids.snapshot().
+    """
+
+    def __init__(self, state, scattered, scatter_i, rng):
+        self.state = state
+        self.scattered = scattered
+        self.scatter_i = scatter_i
+        self.rng = rng
+
+### ARRAY-BACKED FLOCK ##############################################################################
+
+def _column(name, j=None):
+    # A property that reads and writes a boid's row in one of the flock's arrays.
+    def get(self):
+        a = getattr(self.flock, name)
+        return a[self.i] if j is None else float(a[self.i, j])
+    def set(self, v):
+        a = getattr(self.flock, name)
+        if j is None:
+            a[self.i] = v
+        else:
+            a[self.i, j] = v
+    return property(get, set)
+
+class BoidView(Boid):
+
+    """ A boid in an ArrayBoids flock.
+
+    It has the same attributes and methods as a Boid,
+    but its position and velocity are a row in the flock's arrays.
+
+    """
+
+    def __init__(self, boids, i):
+        self.boids = boids
+        self.flock = boids
+        self.i = i
+
+    x  = _column("p", 0)
+    y  = _column("p", 1)
+    z  = _column("p", 2)
+    vx = _column("v", 0)
+    vy = _column("v", 1)
+    vz = _column("v", 2)
+    is_perching = _column("perching")
+    _perch_t = _column("perch_t")
+
+class ArrayBoids(Boids):
+
+    """ A flock with its positions and velocities stored in (n,3) NumPy arrays.
+
+    All the rules are calculated for all boids at once, instead of one boid at a time.
+    Iterating over the flock yields BoidView objects that work like Boid objects,
+    so sketches that draw the flock with "for b in flock" don't need to change.
+    Boids can't be added to or removed from the flock.
+
+    """
+
+    # Number of boid pairs compared at once, limits memory use.
+    chunk = 1000000
+
+    def __init__(self, n, x, y, w, h, seed=None):
+
+        if numpy is None:
+            raise ImportError("ArrayBoids requires numpy")
+
+        Boids.__init__(self, 0, x, y, w, h)
+        self.rng = numpy.random.default_rng(seed)
+        self.p = numpy.column_stack((
+            x + self.rng.random(n) * w,
+            y + self.rng.random(n) * h,
+            self.rng.random(n) * 200
+        ))
+        self.v = numpy.zeros((n, 3))
+        self.perching = numpy.zeros(n, dtype=bool)
+        self.perch_t = numpy.zeros(n)
+        self.extend(BoidView(self, i) for i in range(n))
+
+    def copy(self):
+
+        boids = ArrayBoids(0, self.x, self.y, self.w, self.h)
+        for k, v in self.__dict__.items():
+            if k not in ("p", "v", "perching", "perch_t", "rng"):
+                setattr(boids, k, v)
+        boids.rng = deepcopy(self.rng)
+        boids.p = self.p.copy()
+        boids.v = self.v.copy()
+        boids.perching = self.perching.copy()
+        boids.perch_t = self.perch_t.copy()
+        boids.extend(BoidView(boids, i) for i in range(len(self)))
+        return boids
+
+    def state(self):
+        return numpy.column_stack((self.p, self.v, self.perching, self.perch_t))
+
+    def restore(self, snapshot):
+
+        if len(snapshot.state) != len(self):
+            raise ValueError("snapshot has %s boids, flock has %s" % (len(snapshot.state), len(self)))
+        self.p[:] = snapshot.state[:,0:3]
+        self.v[:] = snapshot.state[:,3:6]
+        self.perching[:] = snapshot.state[:,6] > 0
+        self.perch_t[:] = snapshot.state[:,7]
+        self.scattered = snapshot.scattered
+        self._scatter_i = snapshot.scatter_i
+        self.rng = deepcopy(snapshot.rng)
+
+    def _record(self, out, order):
+        out[:,0:3] = self.p
+        out[:,3:6] = self.v
+
+    def _pairs(self, radius):
+
+        """ Returns the indices i, j of all pairs of boids within radius of each other.
+
+        Boids are sorted by the cell they are in, on a 3D grid of cells the size of the radius.
+        For each of the 27 surrounding cells, the range of boids in that cell
+        is looked up in the sorted list, so only nearby boids are compared.
+
+        """
+
+        p = self.p
+        n = len(p)
+        cell = numpy.floor(p / radius).astype(numpy.int64)
+        cell -= cell.min(axis=0) - 1
+        dims = cell.max(axis=0) + 2
+        key = lambda c: (c[:,0] * dims[1] + c[:,1]) * dims[2] + c[:,2]
+        order = numpy.argsort(key(cell), kind="stable")
+        keys = key(cell)[order]
+        I, J = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    k = key(cell + (dx, dy, dz))
+                    start = numpy.searchsorted(keys, k, "left")
+                    count = numpy.searchsorted(keys, k, "right") - start
+                    i = numpy.repeat(numpy.arange(n), count)
+                    offset = numpy.arange(len(i)) - numpy.repeat(numpy.cumsum(count) - count, count)
+                    I.append(i)
+                    J.append(order[numpy.repeat(start, count) + offset])
+        I = numpy.concatenate(I)
+        J = numpy.concatenate(J)
+        d = p[I] - p[J]
+        m = (I != J) & ((d * d).sum(axis=1) <= radius * radius)
+        return I[m], J[m]
+
+    def _rules(self, separation, radius=None):
+
+        """ Returns the centre of mass and the average velocity of the neighbours of each boid,
+        the number of neighbours and the separation vector.
+        """
+
+        p, v = self.p, self.v
+        n = len(p)
+        if radius:
+            I, J = self._pairs(radius)
+            count = numpy.bincount(I, minlength=n).astype(float)
+            d = p[I] - p[J]
+            d = numpy.where(numpy.abs(d) < separation, d, 0)
+            centre = numpy.column_stack([numpy.bincount(I, p[J,k], n) for k in range(3)])
+            velocity = numpy.column_stack([numpy.bincount(I, v[J,k], n) for k in range(3)])
+            apart = numpy.column_stack([numpy.bincount(I, d[:,k], n) for k in range(3)])
+        else:
+            # Every boid sees all the other boids.
+            count = numpy.full(n, n-1, dtype=float)
+            centre = p.sum(axis=0) - p
+            velocity = v.sum(axis=0) - v
+            apart = numpy.zeros((n, 3))
+            step = max(1, self.chunk // max(n, 1))
+            for k in range(3):
+                x = p[:,k]
+                for i in range(0, n, step):
+                    d = x[i:i+step,numpy.newaxis] - x[numpy.newaxis,:]
+                    d *= numpy.abs(d) < separation
+                    apart[i:i+step,k] = d.sum(axis=1)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            centre = centre / count[:,numpy.newaxis]
+            velocity = velocity / count[:,numpy.newaxis]
+        return centre, velocity, count, apart
+
+    def constrain(self):
+
+        p, v = self.p, self.v
+        n = len(p)
+        dx = self.w * 0.1
+        dy = self.h * 0.1
+
+        v[:,0] += numpy.where(p[:,0] < self.x-dx, self.rng.random(n) * dx, 0)
+        v[:,1] += numpy.where(p[:,1] < self.y-dy, self.rng.random(n) * dy, 0)
+        v[:,0] -= numpy.where(p[:,0] > self.x+self.w+dx, self.rng.random(n) * dx, 0)
+        v[:,1] -= numpy.where(p[:,1] > self.y+self.h+dy, self.rng.random(n) * dy, 0)
+        v[:,2] += numpy.where(p[:,2] < 0, 10, 0)
+        v[:,2] -= numpy.where(p[:,2] > 100, 10, 0)
+
+        perch = (p[:,1] > self._perch_y) & (self.rng.random(n) < self._perch)
+        p[perch,1] = self._perch_y
+        v[perch,1] = -numpy.abs(v[perch,1]) * 0.2
+        self.perching[perch] = True
+        for i in numpy.nonzero(perch)[0]:
+            self.perch_t[i] = self._perch_frames()
+
+    def update(self,
+               shuffled=True,
+               cohesion=100,
+               separation=10,
+               alignment=5,
+               goal=20,
+               limit=30,
+               radius=None):
+
+        """ Calculates the next motion frame for the flock.
+
+        All boids move at the same time, so the order of the boids doesn't matter
+        and the shuffled parameter is ignored.
+        With a perception radius, each boid only looks at the boids within that radius.
+
+        """
+
+        m1, m2, m3, m4 = self._weights()
+        p, v = self.p, self.v
+
+        # A boid that is perching will continue to do so
+        # until its perch time reaches zero.
+        waiting = self.perching & (self.perch_t > 0)
+        self.perch_t[waiting] -= 1
+        self.perching[self.perching & ~waiting] = False
+        active = ~waiting
+
+        centre, velocity, count, apart = self._rules(separation, radius)
+        alone = (count == 0)[:,numpy.newaxis]
+        v1 = numpy.where(alone, 0, (centre - p) / cohesion)
+        v2 = apart
+        v3 = numpy.where(alone, 0, (velocity - v) / alignment)
+        v4 = (numpy.array((self._gx, self._gy, self._gz)) - p) / goal
+
+        v[active] += (m1*v1 + m2*v2 + m3*v3 + m4*v4)[active]
+        v[active] = numpy.clip(v[active], -limit, limit)
+        p[active] += v[active]
+
+        self.constrain()
+
+def flock(n, x, y, w, h, arrays=False, seed=None):
+
+    """ Returns a flock of n boids in the given area.
+    With arrays=True, the flock is an ArrayBoids flock which is much faster for large flocks.
+    Flocks created with the same seed (and updated with the same parameters) move the same.
+    """
+
+    if arrays:
+        return ArrayBoids(n, x, y, w, h, seed)
+    return Boids(n, x, y, w, h, seed)
+
+def load(path):
+
+    """ Returns the trajectory array saved to the given file by Boids.simulate().
+    The file is memory-mapped, so frames are only read from disk when they are used.
+    """
 
-    return Boids(n, x, y, w, h)
\ No newline at end of file
+    return numpy.load(path, mmap_mode="r")
\ No newline at end of file
@@ -8,6 +8,11 @@ from math import *
 from plotdevice.lib import register
 _ctx = register(__name__)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 ### CORNU ############################################################################################
 
 # fit arc to pts (0, 0), (x, y), and (1, 0), return th tangent to
@@ -237,7 +242,7 @@ def draw_tan(x, y, th):
     print_pt(x - dx, y - dy, 'moveto')
     print_pt(x + dx, y + dy, 'lineto')
 
-def draw_cornu(path, ths, closed, flat=False):
+def draw_cornu(path, ths, closed, flat=False, out=None):
     cmd = 'moveto'
     for i in range(len(path) - 1 + closed):
         x0, y0 = path[i]
@@ -265,14 +270,14 @@ def draw_cornu(path, ths, closed, flat=False):
         cs = scale * cos(rot)
         ss = scale * sin(rot)
         if flat:
-            cmd = draw_cornu_flat(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd)
+            cmd = draw_cornu_flat(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, out)
         else:
-            cmd = draw_cornu_bezier(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, scale, rot)
+            cmd = draw_cornu_bezier(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, scale, rot, out)
     if closed:
         pass # print 'closepath'
     #print 'stroke'
 
-def draw_cornu_flat(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd):
+def draw_cornu_flat(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, out=None):
 
     """ Raph Levien's code draws fast LINETO segments.
     """
@@ -286,11 +291,11 @@ def draw_cornu_flat(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd):
         #print '%', c, s
         x = c * cs - s * ss
         y = s * cs + c * ss
-        print_pt(x0 + x, y0 + y, cmd)
+        print_pt(x0 + x, y0 + y, cmd, out)
         cmd = 'lineto'
     return cmd
 
-def draw_cornu_bezier(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, scale, rot):
+def draw_cornu_bezier(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, scale, rot, out=None):
 
     """ Mark Meyer's code draws elegant CURVETO segments.
     """
@@ -342,9 +347,9 @@ def draw_cornu_bezier(x0, y0, t0, t1, s0, c0, flip, cs, ss, cmd, scale, rot):
         y2 = (y3 - ((Dt/3.0) * dy2))
 
         if cmd == 'moveto':
-            print_pt(x, y, cmd)
+            print_pt(x, y, cmd, out)
             cmd = 'curveto'
-        print_crv(x1, y1, x2, y2, x3, y3)
+        print_crv(x1, y1, x2, y2, x3, y3, out)
 
         dx1, dy1 = dx2, dy2
         x,y = x3, y3
@@ -427,32 +432,241 @@ def draw_cspline(path, ths):
             print_pt(x0 + x, y0 + y, cmd)
             cmd = 'lineto'
 
+### CORNU ARRAYS #####################################################################################
+
+# The functions below mirror the scalar solver above,
+# but fit and evaluate all the segments of a path at once.
+# path() uses them when NumPy is installed.
+
+def fresnel_array(xxa):
+    xxa = numpy.asarray(xxa, dtype=float)
+    x = numpy.abs(xxa)
+    x2 = x * x
+    small = x2 < 2.5625
+    ss = numpy.empty_like(x)
+    cc = numpy.empty_like(x)
+    # power series
+    xs = x[small]
+    xs2 = xs * xs
+    t = xs2 * xs2
+    ss[small] = xs * xs2 * polevl(t, sn) / polevl(t, sd)
+    cc[small] = xs * polevl(t, cn) / polevl(t, cd)
+    # asymptotic expansion
+    large = ~small
+    xl = x[large]
+    t = pi * xl * xl
+    u = 1.0 / (t * t)
+    t = 1.0 / t
+    f = 1.0 - u * polevl(u, fn) / polevl(u, fd)
+    g = t * polevl(u, gn) / polevl(u, gd)
+    t = pi * .5 * xl * xl
+    c = numpy.cos(t)
+    s = numpy.sin(t)
+    t = pi * xl
+    cc[large] = numpy.where(xl > 36974.0, 0.5, 0.5 + (f * s - g * c) / t)
+    ss[large] = numpy.where(xl > 36974.0, 0.5, 0.5 - (f * c + g * s) / t)
+    sign = numpy.where(xxa < 0, -1.0, 1.0)
+    return ss * sign, cc * sign
+
+def eval_cornu_array(t):
+    spio2 = sqrt(pi * .5)
+    s, c = fresnel_array(numpy.asarray(t) / spio2)
+    return s * spio2, c * spio2
+
+def mod_2pi_array(th):
+    u = th / (2 * pi)
+    return 2 * pi * (u - numpy.floor(u + 0.5))
+
+def fit_cornu_half_array(th0, th1):
+    epsilon = numpy.where(th0 + th1 < 1e-6, 1e-6, 0.0)
+    th0 = th0 + epsilon
+    th1 = th1 + epsilon
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        est_tm = 0.29112 * (th1 + th0) / numpy.sqrt(th1 - th0)
+    l = est_tm * .9
+    r = est_tm * 2
+    # Bisection runs the same 21 steps as fit_cornu_half(),
+    # for every segment at the same time.
+    for n_iter in range(1, 22):
+        t_m = .5 * (l + r)
+        dt = (th0 + th1) / (4 * t_m)
+        t0 = t_m - dt
+        t1 = t_m + dt
+        s0, c0 = eval_cornu_array(t0)
+        s1, c1 = eval_cornu_array(t1)
+        if n_iter == 21:
+            break
+        chord_th = numpy.arctan2(s1 - s0, c1 - c0)
+        left = mod_2pi_array(chord_th - t0 * t0 - th0) < 0
+        l = numpy.where(left, t_m, l)
+        r = numpy.where(left, r, t_m)
+    chordlen = numpy.hypot(s1 - s0, c1 - c0)
+    k0 = t0 * chordlen
+    k1 = t1 * chordlen
+    return t0, t1, k0, k1
+
+def fit_segments(path, ths, closed):
+    """ Fits a Cornu spiral to each segment of the path, returns arrays.
+    """
+    p = numpy.asarray(path, dtype=float)
+    ths = numpy.asarray(ths, dtype=float)
+    i = numpy.arange(len(p) - 1 + closed)
+    j = (i + 1) % len(p)
+    x0, y0 = p[i].T
+    x1, y1 = p[j].T
+    th = numpy.arctan2(y1 - y0, x1 - x0)
+    th0 = mod_2pi_array(ths[i] - th)
+    th1 = mod_2pi_array(th - ths[j]) + 1e-6
+    flip = numpy.where(th1 < th0, 1, -1)
+    swap = flip == 1
+    t0, t1, k0, k1 = fit_cornu_half_array(
+        numpy.where(swap, th1, th0),
+        numpy.where(swap, th0, th1)
+    )
+    t0, t1 = numpy.where(swap, t1, t0), numpy.where(swap, t0, t1)
+    k0, k1 = numpy.where(swap, k1, k0), numpy.where(swap, k0, k1)
+    return x0, y0, x1, y1, th, flip, t0, t1, k0, k1
+
+def tweak_ths_array(path, ths, closed):
+    """ Same as tweak_ths() on a NumPy array of thetas, returns the largest change.
+    """
+    p = numpy.asarray(path, dtype=float)
+    x0, y0, x1, y1, th, flip, t0, t1, k0, k1 = fit_segments(p, ths, closed)
+    scale = 1 / numpy.maximum(numpy.hypot(y1 - y0, x1 - x0), 0.0001)
+    k0 = k0 * scale
+    k1 = k1 * scale
+    dks = k0[1:] - k1[:-1]
+    if closed:
+        dks = numpy.append(dks, k0[0] - k1[-1])
+    i = numpy.arange(len(dks))
+    d1 = p[(i + 1) % len(p)] - p[i]
+    d2 = p[(i + 2) % len(p)] - p[(i + 1) % len(p)]
+    chord1 = numpy.hypot(d1[:,0], d1[:,1])
+    chord2 = numpy.hypot(d2[:,0], d2[:,1])
+    dth = .5 * (dks / (chord1 + chord2))
+    ths[(i + 1) % len(p)] -= dth
+    if len(dth) == 0:
+        return 0.0
+    return float(numpy.abs(dth).max())
+
+def cornu_curves(path, ths, closed, flat=False):
+    """ Returns the path's start point and its lineto points (flat) or curveto control points.
+
+    Coordinates are scaled by 100 like print_pt() and print_crv() do.
+    The curves are recorded from draw_cornu(), so they can be cached and replayed.
+    """
+    out = []
+    draw_cornu(path, ths, closed, flat, out)
+    if len(out) == 0:
+        return None, []
+    return out[0], out[1:]
+
+def cornu_curves_array(path, ths, closed, flat=False):
+    """ Returns the same start point and curves as cornu_curves(),
+    with all segments sampled at once.
+    """
+    x0, y0, x1, y1, th, flip, t0, t1, k0, k1 = fit_segments(path, ths, closed)
+    s0, c0 = eval_cornu_array(t0)
+    s0 *= flip
+    s1, c1 = eval_cornu_array(t1)
+    s1 *= flip
+    chord_th = numpy.arctan2(s1 - s0, c1 - c0)
+    chordlen = numpy.hypot(s1 - s0, c1 - c0)
+    rot = th - chord_th
+    scale = numpy.hypot(y1 - y0, x1 - x0) / chordlen
+    cs = scale * numpy.cos(rot)
+    ss = scale * numpy.sin(rot)
+
+    # Sample every segment at the same times in one go,
+    # one row per segment.
+    if flat:
+        t = numpy.arange(100) * .01
+    else:
+        t = numpy.array([0.0] + [j * .2 + .2 for j in range(5)])
+    col = lambda a: a[:,numpy.newaxis]
+    curvetime = col(t0) + t * col(t1 - t0)
+    s, c = eval_cornu_array(curvetime)
+    s = s * col(flip) - col(s0)
+    c = c - col(c0)
+    x = c * col(cs) - s * col(ss) + col(x0)
+    y = s * col(cs) + c * col(ss) + col(y0)
+
+    if len(x) == 0:
+        return None, []
+    start = (100 * x[0,0], 100 * y[0,0])
+    if flat:
+        pts = numpy.dstack((x, y)).reshape(-1, 2)[1:] * 100
+        return start, [tuple(pt) for pt in pts.tolist()]
+
+    # Tangents and control points for Mark Meyer's curveto segments.
+    a = curvetime ** 2 + col(flip * rot)
+    dx = numpy.cos(a)
+    dy = col(flip) * numpy.sin(a)
+    Dt = (curvetime[:,1:] - curvetime[:,:-1]) * col(scale) / 3.0
+    ctrl1x = x[:,:-1] + Dt * dx[:,:-1]
+    ctrl1y = y[:,:-1] + Dt * dy[:,:-1]
+    ctrl2x = x[:,1:] - Dt * dx[:,1:]
+    ctrl2y = y[:,1:] - Dt * dy[:,1:]
+    curves = numpy.dstack((ctrl1x, ctrl1y, ctrl2x, ctrl2y, x[:,1:], y[:,1:])) * 100
+    return start, [tuple(crv) for crv in curves.reshape(-1, 6).tolist()]
+
+def draw_curves(start, curves, flat=False):
+    if start is None:
+        return
+    _ctx.moveto(*start)
+    if flat:
+        for x, y in curves:
+            _ctx.lineto(x, y)
+    else:
+        for crv in curves:
+            _ctx.curveto(*crv)
+
+def solve_ths(path, closed, tweaks=20, tolerance=1e-6):
+    """ Returns the thetas of the Cornu spline through the path.
+
+    Runs at most the given number of tweaks,
+    stopping earlier once no theta changes more than the tolerance.
+    """
+    ths = numpy.array(local_ths(path, closed), dtype=float)
+    for i in range(tweaks):
+        boundary_ths(path, ths, closed)
+        if tweak_ths_array(path, ths, closed) < tolerance:
+            break
+    boundary_ths(path, ths, closed)
+    return ths
+
 ### NODEBOX BINDINGS #################################################################################
 
-def print_pt(x, y, cmd):
+def print_pt(x, y, cmd, out=None):
     x = 100 * x
     y = 100 * y
-    if (cmd == 'moveto'):
+    if out is not None:
+        out.append((x, y))
+    elif (cmd == 'moveto'):
         _ctx.moveto(x, y)
     elif (cmd == 'lineto'):
         _ctx.lineto(x, y)
     else:
         print(cmd, x, y)
 
-def print_crv(x1, y1, x2, y2, x3, y3):
+def print_crv(x1, y1, x2, y2, x3, y3, out=None):
     x1 *= 100
     y1 *= 100
     x2 *= 100
     y2 *= 100
     x3 *= 100
     y3 *= 100
-    _ctx.curveto(x1, y1, x2, y2, x3, y3)
+    if out is not None:
+        out.append((x1, y1, x2, y2, x3, y3))
+    else:
+        _ctx.curveto(x1, y1, x2, y2, x3, y3)
 
 def dot_pt(x, y):
     _ctx.oval(x-3,y-3, 6, 6)
 
 def relativise(path):
 
+    seen = set()
     for i in range(len(path)):
         x, y = path[i]
         x *= 0.01 * _ctx.WIDTH
@@ -460,16 +674,25 @@ def relativise(path):
 
         #Points on the path that have identical coordinates
         #generate a ZeroDivisionError
-        for point in path:
-            if (x,y) == point:
-                x += 0.0000000001
-                y += 0.0000000001
+        while (x,y) in seen:
+            x += 0.0000000001
+            y += 0.0000000001
+        seen.add((x,y))
 
         path[i] = (x,y)
 
     return path
 
-def path(points, close=False, tweaks=20, flat=False, draw=False, helper=False):
+# Fitted thetas and curves of recently drawn paths,
+# keyed by their relativised points and options.
+_cache = {}
+CACHE_SIZE = 100
+
+# Paths with fewer points are fitted one segment at a time:
+# below this size the fixed cost of the NumPy calls outweighs the gain.
+NUMPY_POINTS = 40
+
+def path(points, close=False, tweaks=20, flat=False, draw=False, helper=False, tolerance=1e-6, cached=True):
 
     # To make sure we don't change the original, make a copy of the
     # given points
@@ -477,15 +700,32 @@ def path(points, close=False, tweaks=20, flat=False, draw=False, helper=False):
 
     points = relativise(points)
 
-    ths = local_ths(points, close)
-    for i in range(tweaks):
-        boundary_ths(points, ths, close)
-        tweak_ths(points, ths, close)
-    boundary_ths(points, ths, close)
+    # Redrawing an unchanged path only replays the cached curves,
+    # fit_cornu_half() and eval_cornu() are not called again.
+    key = (tuple(points), close, flat, tweaks, tolerance)
+    if cached and key in _cache:
+        ths, curves = _cache[key] = _cache.pop(key)
+    else:
+        # With NumPy all segments of a large path are fitted at once,
+        # and tweaking stops when the thetas no longer change.
+        if numpy is not None and len(points) >= NUMPY_POINTS:
+            ths = solve_ths(points, close, tweaks, tolerance)
+            curves = cornu_curves_array(points, ths, close, flat)
+        else:
+            ths = local_ths(points, close)
+            for i in range(tweaks):
+                boundary_ths(points, ths, close)
+                tweak_ths(points, ths, close)
+            boundary_ths(points, ths, close)
+            curves = cornu_curves(points, ths, close, flat)
+        if cached:
+            if len(_cache) >= CACHE_SIZE:
+                del _cache[next(iter(_cache))]
+            _cache[key] = ths, curves
 
     _ctx.autoclosepath(False)
     _ctx.beginpath()
-    draw_cornu(points, ths, close, flat)
+    draw_curves(curves[0], curves[1], flat)
     p =  _ctx.endpath(draw=draw)
 
     #beginpath()
@@ -503,9 +743,9 @@ def path(points, close=False, tweaks=20, flat=False, draw=False, helper=False):
 
     return p
 
-def drawpath(p, close=False, tweaks=20, points=False, flat=False):
+def drawpath(p, close=False, tweaks=20, points=False, flat=False, tolerance=1e-6, cached=True):
 
-    path(p, close, tweaks, flat, draw=True, helper=points)
+    path(p, close, tweaks, flat, draw=True, helper=points, tolerance=tolerance, cached=cached)
 
 ### PSYCO SPECIALIZATION #############################################################################
 
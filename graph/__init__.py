@@ -12,7 +12,7 @@
 # See LICENSE.txt for details.
 
 __author__    = "Tom De Smedt"
-__version__   = "1.9.5.6"
+__version__   = "1.9.5.7"
 __copyright__ = "Copyright (c) 2008 Tom De Smedt"
 __license__   = "GPL"
 
@@ -523,6 +523,13 @@ class graph(dict):
         except:
             return None
 
+    def shortest_paths(self, id, heuristic=None, directed=False):
+        """ Returns a dictionary of node id's linking to the shortest path from the given node.
+        """
+        if id not in self:
+            return {}
+        return proximity.dijkstra_shortest_paths(self, id, heuristic, directed)
+
     def betweenness_centrality(self, normalized=True, directed=False):
         """ Calculates betweenness centrality and returns an node id -> weight dictionary.
         Node betweenness weights are updated in the process.
@@ -813,6 +820,10 @@ def create(iterations=1000, distance=1.0, layout=LAYOUT_SPRING, depth=True):
 
     return g
 
+# 1.9.5.7
+# Added proximity.dijkstra_shortest_paths() and graph.shortest_paths(),
+# the shortest paths from one node to all other nodes in a single search.
+
 # 1.9.5.6
 # Fixed circle_layout copy (number of orbits and starting angle weren't copied).
 
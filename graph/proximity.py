@@ -124,6 +124,54 @@ def dijkstra_shortest_path(graph, id1, id2, heuristic=None, directed=False):
             if v2 not in visited:
                 heapq.heappush(q, (cost1 + cost2, v2, path))
 
+def dijkstra_shortest_paths(graph, id, heuristic=None, directed=False):
+    
+    """ Dijkstra algorithm for finding the shortest paths from one node to all other nodes.
+    
+    Returns a dictionary of node id's linking to the path from the given node (a list of node id's).
+    Nodes that can't be reached are not in the dictionary.
+    
+    """
+    
+    G = adjacency(graph, directed=directed, heuristic=heuristic)
+    return single_source_shortest_paths(G, id)
+
+def single_source_shortest_paths(G, start, targets=None):
+    
+    """ Dijkstra shortest paths from the start id in the given adjacency list (see adjacency()).
+    
+    A single search yields the paths to all reachable nodes.
+    With a list of target id's, the search stops once the paths to all of them are found.
+    When searching from many nodes, the adjacency list only needs to be built once,
+    and it can be sent to other processes (it is a dictionary of dictionaries).
+    
+    """
+    
+    def flatten(L):       
+        while len(L) > 0:
+            yield L[0]
+            L = L[1]
+    
+    if targets != None:
+        targets = set(targets)
+    paths = {}
+    q = [(0, start, ())]  # Heap of (cost, path_head, path_rest).
+    while q:
+        (cost1, v1, path) = heapq.heappop(q)
+        if v1 in paths:
+            continue
+        paths[v1] = list(flatten(path))[::-1] + [v1]
+        if targets != None:
+            targets.discard(v1)
+            if len(targets) == 0:
+                break
+        path = (v1, path)
+        for (v2, cost2) in G[v1].items():
+            if v2 not in paths:
+                heapq.heappush(q, (cost1 + cost2, v2, path))
+    
+    return paths
+
 #--- BRANDES BETWEENNESS CENTRALITY ------------------------------------------------------------------
 
 def brandes_betweenness_centrality(graph, normalized=True, directed=False):
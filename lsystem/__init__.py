@@ -10,11 +10,337 @@ __license__   = "MIT"
 
 ### L-SYSTEM #########################################################################################
 
+import re
+import math
 from sys import maxsize
+from math import radians, sin, cos
+from hashlib import md5
+from bisect import bisect_left
+from collections import OrderedDict
 from plotdevice.gfx import CORNER, CENTER
 from plotdevice.lib import register
 _ctx = register(__name__)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+### COMMAND STREAM ###################################################################################
+
+# Opcodes in a compiled command stream.
+SEGMENT, MOVE, LEFT, RIGHT, FLIP, PUSH, POP, COMMAND = list(range(8))
+
+# Standard command symbols and their opcodes:
+# f signifies a move,
+# + and - rotate either left or right, | rotates 180 degrees,
+# [ and ] are for push() and pop(), e.g. offshoot branches.
+_opcodes = {
+    "f" : MOVE,
+    "-" : LEFT,
+    "+" : RIGHT,
+    "|" : FLIP,
+    "[" : PUSH,
+    "]" : POP
+}
+
+class Stream(list):
+
+    """ The rules of an LSystem expanded into a flat list of commands.
+
+    Each command is an (opcode, generation, length, angle, cost, gate, symbol)-tuple.
+    The angle is relative to LSystem.angle (i.e. 1.0 unless modified by ! ( or )).
+    The cost is the time depleted by F commands before the command is reached.
+    The command is only reached when the time is greater than its gate.
+
+    """
+
+    def __init__(self, commands=[]):
+        list.__init__(self, commands)
+        self.duration = 0
+        self.segments = 0
+        # The sorted gates of all segments, to count the segments reached in a given time.
+        self.gates = sorted(cmd[5] for cmd in self if cmd[0] == SEGMENT)
+
+class Subtree(object):
+
+    """ A rule expanded for a number of generations at a given segment length.
+
+    Subtrees are memoized by LSystem._expand(): when the same rule is reached
+    at the same generation and length, the subtree is reused instead of expanded again.
+    Its commands are relative to the point where it is reached:
+    the angle is relative to the current angle and costs and gates to the time spent so far.
+
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.head = []      # Commands for the symbol itself.
+        self.children = []  # (subtree, angle, cost) for each symbol in the expanded rule.
+        self.segments = 0
+        self.duration = None
+        self.depth = 0      # Number of push() minus number of pop() commands.
+        self.lowest = 0     # Lowest depth reached, negative if it pops beyond its own pushes.
+        self._commands = None
+
+    @property
+    def balanced(self):
+        return self.depth == 0 and self.lowest >= 0
+
+    @property
+    def commands(self):
+        # The flat list of commands, built once from the commands of the children.
+        if self._commands is None:
+            commands = list(self.head)
+            for child, angle, cost in self.children:
+                commands.extend([
+                    (op, generation, length, a*angle, c+cost, max(gate+cost, 0.0), rule)
+                    for op, generation, length, a, c, gate, rule in child.commands
+                ])
+            self._commands = commands
+        return self._commands
+
+### GRAMMAR ##########################################################################################
+
+# A symbol in a rule, optionally followed by numeric arguments in curly braces, e.g. A{x*0.7, 2}.
+# Curly braces are used since ( and ) are already command symbols.
+_token = re.compile(r"([^{}])(?:\{([^}]*)\})?")
+
+# A rule key: a symbol, optionally with parameter names and a condition, e.g. A{x} : x > 1.
+_production = re.compile(r"^\s*([^{}])\s*(?:\{([^}]*)\})?\s*(?::(.*))?$")
+
+# Expressions in arguments and conditions can use math functions.
+_namespace = dict((k, getattr(math, k)) for k in dir(math) if not k.startswith("_"))
+_namespace.update({"__builtins__": {}, "min": min, "max": max, "abs": abs, "round": round})
+
+def _tokens(rule):
+    # Parses a rule into (symbol, arguments)-tokens,
+    # where arguments is compiled code that evaluates to a tuple, or None.
+    tokens = []
+    for symbol, args in _token.findall(rule):
+        if args.strip():
+            args = compile("(%s,)" % args, rule, "eval")
+        else:
+            args = None
+        tokens.append((symbol, args))
+    return tokens
+
+def _freeze(v):
+    # Rules can contain lists of alternatives, which are not hashable.
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    return v
+
+class Production(object):
+
+    """ A rule for a symbol: its parameters, a condition and one or more weighted alternatives.
+
+    Each alternative is a list of (symbol, arguments)-tokens.
+
+    """
+
+    def __init__(self, key, value):
+        m = _production.match(key)
+        if m is None:
+            raise ValueError("invalid rule %s" % repr(key))
+        self.symbol = m.group(1)
+        self.params = tuple(p.strip() for p in (m.group(2) or "").split(",") if p.strip())
+        self.condition = None
+        if m.group(3) and m.group(3).strip():
+            self.condition = compile(m.group(3).strip(), key, "eval")
+        if isinstance(value, str):
+            value = [value]
+        self.alternatives = []
+        for v in value:
+            if isinstance(v, str):
+                v = (v, 1.0)
+            self.alternatives.append((_tokens(v[0]), float(v[1])))
+        self.weight = sum(w for tokens, w in self.alternatives)
+
+    @property
+    def stochastic(self):
+        return len(self.alternatives) > 1
+
+    def env(self, args):
+        return dict(zip(self.params, args or ()))
+
+    def matches(self, args):
+        if self.condition is None:
+            return True
+        return bool(eval(self.condition, _namespace, self.env(args)))
+
+    def choose(self, seed, key):
+        # A weighted choice between alternatives, seeded by the seed and the key
+        # so that the same subtree is always expanded the same way.
+        if not self.stochastic:
+            return self.alternatives[0][0]
+        h = md5(repr((seed,) + key).encode("utf-8")).hexdigest()
+        r = int(h[:8], 16) / 4294967296.0 * self.weight
+        for tokens, w in self.alternatives:
+            r -= w
+            if r < 0:
+                return tokens
+        return self.alternatives[-1][0]
+
+class Grammar(object):
+
+    """ The rules of an LSystem, parsed once.
+
+    Rules map a symbol to a string, or to a list of alternative strings,
+    optionally with weights, e.g. [("FF[+1]", 2), ("F[-1]", 1)].
+    A rule key can declare parameters and a condition, e.g. "A{x} : x > 1",
+    and symbols in a rule can pass arguments, e.g. "F{x}[+A{x*0.7}]".
+    Grammars are shared between all systems with the same rules (e.g. a forest).
+
+    """
+
+    def __init__(self, rules):
+        self.productions = {}
+        for key, value in rules.items():
+            p = Production(key, value)
+            self.productions.setdefault(p.symbol, []).append(p)
+        # Symbols whose expansion involves a choice between alternatives,
+        # directly or in one of the symbols they expand to.
+        self.stochastic = set(s for s, ps in self.productions.items() if any(p.stochastic for p in ps))
+        changed = True
+        while changed:
+            changed = False
+            for s, ps in self.productions.items():
+                if s not in self.stochastic \
+                and any(symbol in self.stochastic 
+                        for p in ps for tokens, w in p.alternatives for symbol, a in tokens):
+                    self.stochastic.add(s)
+                    changed = True
+
+    def match(self, symbol, args=None):
+        for p in self.productions.get(symbol, []):
+            if p.matches(args):
+                return p
+        return None
+
+_grammars = {}
+def grammar(rules):
+    key = _freeze(sorted(rules.items()))
+    if key not in _grammars:
+        if len(_grammars) > 100:
+            _grammars.clear()
+        _grammars[key] = Grammar(rules)
+    return _grammars[key]
+
+### GEOMETRY #########################################################################################
+
+class Geometry(object):
+
+    """ The segments of an LSystem as NumPy arrays.
+
+    Segment i runs from (x0[i], y0[i]) to (x1[i], y1[i]),
+    relative to the position the system is drawn at.
+    It has a heading in degrees, a depth (i.e. the generation it was drawn at),
+    a length and a unique id between 1 and LSystem.segments().
+    The cost and gate of each segment are used to filter the segments by time.
+
+    """
+
+    _fields = ("x0", "y0", "x1", "y1", "heading", "depth", "length", "id", "cost", "gate")
+
+    def __init__(self, **arrays):
+        for k in self._fields:
+            setattr(self, k, arrays[k])
+
+    def __len__(self):
+        return len(self.id)
+
+    def at(self, time):
+
+        """ Returns the segments that are drawn at the given time.
+
+        Segments that are still growing are shortened to their current length.
+        They keep their full-grown position and angle however,
+        so growing tips can differ slightly from LSystem.draw().
+
+        """
+
+        t = time - self.cost
+        i = (time > self.gate) & (t >= 0)
+        k = numpy.minimum(t[i], 1.0)
+        g = Geometry(**dict((f, getattr(self, f)[i]) for f in self._fields))
+        g.x1 = g.x0 + (g.x1 - g.x0) * k
+        g.y1 = g.y0 + (g.y1 - g.y0) * k
+        g.length = g.length * k
+        return g
+
+class Turtle(object):
+
+    """ Moves through commands arithmetically, collecting the segments.
+
+    Each segment starts at the turtle's position, in the direction of its heading.
+    Moving forward in local coordinates, translate(0, -length),
+    is a step of (-sin(heading), -cos(heading)) in world coordinates.
+    Each segment is an (x0, y0, x1, y1, heading, depth, length, cost, gate) row.
+
+    """
+
+    fields = ("x0", "y0", "x1", "y1", "heading", "depth", "length", "cost", "gate")
+
+    def __init__(self):
+        self.x, self.y, self.heading = 0.0, 0.0, 0.0
+        self.dx, self.dy = 0.0, -1.0
+        self.stack = []
+        self.rows = []
+        self.chunks = []
+
+    def rotate(self, angle):
+        self.heading += angle
+        self.dx, self.dy = -sin(radians(self.heading)), -cos(radians(self.heading))
+
+    def run(self, commands, angle, cost=0.0, gate=float("-inf")):
+        for op, generation, length, a, c, g, rule in commands:
+            if op == SEGMENT:
+                x1, y1 = self.x + self.dx*length, self.y + self.dy*length
+                self.rows.append((self.x, self.y, x1, y1, self.heading, generation, length, c+cost, max(g+cost, gate)))
+                self.x, self.y = x1, y1
+            elif op == MOVE:
+                self.x, self.y = self.x + self.dx*length, self.y + self.dy*length
+            elif op == LEFT  : self.rotate(-a * angle)
+            elif op == RIGHT : self.rotate(+a * angle)
+            elif op == FLIP  : self.rotate(180)
+            elif op == PUSH:
+                self.stack.append((self.x, self.y, self.heading, self.dx, self.dy))
+            elif op == POP and self.stack:
+                self.x, self.y, self.heading, self.dx, self.dy = self.stack.pop()
+
+    def instance(self, shape, cost=0.0, gate=0.0):
+        # Places the segments of a balanced subtree,
+        # rotated to the turtle's heading and moved to its position.
+        a, x, y, heading = shape
+        self._flush()
+        h = radians(self.heading)
+        cos_h, sin_h = cos(h), sin(h)
+        b = a.copy()
+        for i, j in ((0, 1), (2, 3)):
+            b[:,i] = self.x + a[:,i]*cos_h + a[:,j]*sin_h
+            b[:,j] = self.y - a[:,i]*sin_h + a[:,j]*cos_h
+        b[:,4] += self.heading
+        b[:,7] += cost
+        b[:,8] = numpy.maximum(a[:,8] + cost, gate)
+        self.chunks.append(b)
+        self.x, self.y = self.x + x*cos_h + y*sin_h, self.y - x*sin_h + y*cos_h
+        self.rotate(heading)
+
+    def _flush(self):
+        if self.rows:
+            self.chunks.append(numpy.array(self.rows, dtype=numpy.float64))
+            self.rows = []
+
+    def shape(self):
+        # The segments and the position and heading of the turtle.
+        self._flush()
+        if self.chunks:
+            a = numpy.concatenate(self.chunks)
+        else:
+            a = numpy.zeros((0, 9))
+        return a, self.x, self.y, self.heading
+
 class LSystem(object):
 
     def __init__(self):
@@ -27,6 +353,8 @@ class LSystem(object):
         # The system's growth pattern.
         # Each rule can contain command symbols
         # or a character referring to another rule.
+        # A rule can also be a list of weighted alternatives,
+        # or take parameters (see Grammar).
         # This default ruleset draws a nice geometric tree.
         self.rules = {
             "1" : "FFF[--2][-2][+2][++2]",
@@ -40,11 +368,42 @@ class LSystem(object):
         # You also define your own command symbols.
         self.commands = {}
 
+        # Seeds the choice between alternatives in stochastic rules.
+        self.seed = 0
+
         self._segments = 0
         self._duration = 0
         self._timed = False
         self.cost = 0.25
 
+        # Compiled command streams, the least recently used is dropped.
+        self._streams = OrderedDict()
+        self._streams_size = 10
+        self._geometries = OrderedDict()
+
+        # Memoized subtrees and their geometry,
+        # valid as long as the rules and settings don't change.
+        self._memo = {}
+        self._memo_key = None
+        self._shapes = {}
+        self._shapes_size = 10000
+
+    def copy(self, seed=None):
+
+        """ Returns a copy of the system, optionally with another seed.
+        """
+
+        s = self.__class__()
+        for k in ("angle", "segmentlength", "decrease", "threshold", "root", "cost", "seed"):
+            setattr(s, k, getattr(self, k))
+        s.rules = dict(self.rules)
+        s.commands = dict(self.commands)
+        if "segment" in self.__dict__:
+            s.segment = self.segment
+        if seed is not None:
+            s.seed = seed
+        return s
+
     def _get_d(self): return self.segmentlength
     def _set_d(self, v): self.segmentlength = v
     d = property(_get_d, _set_d)
@@ -52,100 +411,309 @@ class LSystem(object):
     def _reset(self):
 
         """ Resets the number of drawn segments and the duration.
-
-        To calculate the number of segments or the total time needed,
-        we need to recurse through LSystem._grow().
-        Before that, the draw(), segments() and duration() command
-        will reset both tally variables.
-
         """
 
         self._segments = 0
         self._duration = 0
 
-    def _grow(self, generation, rule, angle, length, time=maxsize, draw=True):
+    def _rules_key(self):
 
-        """ Recurse through the system.
+        # Everything that affects the expansion of a rule.
+        # The angle is not part of it, since commands store it relative to LSystem.angle.
+        return (
+            self.decrease,
+            self.threshold,
+            self.cost,
+            self.seed,
+            _freeze(sorted(self.rules.items())),
+            tuple(sorted(self.commands))
+        )
 
-        When a segment is drawn, the LSsytem.segment() method will be called.
-        You can customize this method to create your own visualizations.
-        It takes an optional time parameter.
+    def _key(self, generation):
+        return (generation, self.root, self.segmentlength) + self._rules_key()
 
-        If you divide this parameter by LSsytem.duration() you get
-        a number between 0.0 and 1.0 you can use as an alpha value for example.
+    def compile(self, generation):
 
-        The method also has an id parameter which is a unique number
-        between 0 and LSystem.segments.
+        """ Returns the rules expanded for a number of generations, as a Stream of commands.
+
+        Expanding the rules is the expensive part of drawing a system,
+        so the stream is cached until the rules or settings change.
+        Drawing, counting segments and calculating the duration
+        are then single passes over the same stream.
+
+        """
 
+        key = self._key(generation)
+        if key in self._streams:
+            self._streams.move_to_end(key)
+            return self._streams[key]
+        tree = self._subtree(generation)
+        stream = Stream(tree.commands)
+        stream.segments = tree.segments
+        if tree.duration is not None:
+            stream.duration = 1 + tree.duration
+        self._streams[key] = stream
+        while len(self._streams) > self._streams_size:
+            self._streams.popitem(last=False)
+        return stream
+
+    def _subtree(self, generation):
+
+        """ Returns the root rule expanded for a number of generations, as a Subtree.
         """
 
+        key = self._rules_key()
+        if key != self._memo_key:
+            self._memo = {}
+            self._memo_key = key
+            self._shapes = {}
+            self._grammar = grammar(self.rules)
+        # The root can pass arguments to a parametric rule, e.g. A{1.0}.
+        root, args = _tokens(self.root)[0]
+        if args is not None:
+            args = eval(args, _namespace)
+        return self._expand(generation, root, self.d, args)
+
+    def _expand(self, generation, rule, length, args=None, path=()):
+
+        """ Recurse through the system once, memoizing each expanded rule.
+
+        The same rule at the same generation and (rounded) length always expands the same way,
+        so the subtree is expanded once and then reused wherever it is reached.
+        Rules that involve a choice between alternatives are the exception:
+        they are chosen anew for each occurrence, seeded by its path from the root.
+        The cost is the time depleted so far (maxsize-time in an uncompiled system).
+        Time depletes differently along each branch,
+        so each command stores the time it needs to be reached (the gate)
+        and the time it has spent when it is reached (the cost).
+
+        """
+
+        if args is not None:
+            args = tuple(round(float(v), 6) for v in args)
+        production = self._grammar.match(rule, args)
+        key = (rule, args, generation, round(length, 6))
+        stochastic = rule in self._grammar.stochastic
+        if stochastic:
+            # Each occurrence is unique, so the subtree is not memoized.
+            key += (path,)
+        elif key in self._memo:
+            return self._memo[key]
+        tree = Subtree(key)
+        if not stochastic:
+            self._memo[key] = tree
+        successor = None
+        if production is not None:
+            successor = production.choose(self.seed, key)
+
+        # Numeric arguments of standard symbols scale the segment length or the angle,
+        # e.g. F{0.5} draws a segment half as long, +{2} rotates twice the angle.
+        k = 1.0
+        if args and production is None:
+            k = args[0]
+
         if generation == 0:
             # We are at the bottom of the system so now we know the total time needed.
-            self._duration = 1 + (maxsize-time)
+            tree.duration = 0.0
 
         if length <= self.threshold:
             # Segment length has fallen below the threshold, stop recursing.
-            self._duration = 1 + (maxsize-time)
-            return
+            tree.duration = 0.0
+            return tree
 
         if rule in self.commands:
             # Custom command symbols:
             # If the rule is a key in the LSsytem.commands dictionary,
-            # execute its value which is a function taking 6 parameters:
+            # its value is a function taking 6 parameters:
             # lsystem, generation, rule, angle, length and time.
-            self.commands[rule](self, generation, rule, angle, length, time)
-
-        if draw:
-            # Standard command symbols:
-            # f signifies a move,
-            # + and - rotate either left or right, | rotates 180 degrees,
-            # [ and ] are for push() and pop(), e.g. offshoot branches,
-            # < and > decrease or increases the segment length,
-            # ( and ) decrease or increases the rotation angle.
-            if   rule == "f": _ctx.translate(0, -min(length, length*time))
-            elif rule == "-": _ctx.rotate(max(-angle, -angle*time))
-            elif rule == "+": _ctx.rotate(min(+angle, +angle*time))
-            elif rule == "|": _ctx.rotate(180)
-            elif rule == "[": _ctx.push()
-            elif rule == "]": _ctx.pop()
-
-        if rule in self.rules \
-        and generation > 0 \
-        and time > 0:
+            tree.head.append((COMMAND, generation, length, 1.0, 0.0, float("-inf"), rule))
+
+        if rule in _opcodes:
+            tree.head.append((_opcodes[rule], generation, length*k, k, 0.0, float("-inf"), rule))
+            if rule == "[": tree.depth = 1
+            if rule == "]": tree.depth = tree.lowest = -1
+
+        if successor is not None \
+        and generation > 0:
             # Recursion:
             # Occurs when there is enough "life" (i.e. generation or time).
             # Generation is decreased and segment length scaled down.
             # Also, F symbols in the rule have a cost that depletes time.
-            for cmd in self.rules[rule]:
+            # Whether there is enough time is decided when drawing:
+            # the commands in this branch are gated by the time spent up to here.
+            angle = 1.0
+            cost = 0.0
+            env = production.env(args)
+            for i, (cmd, a) in enumerate(successor):
                 # Modification command symbols:
-                if   cmd == "F": time -= self.cost
+                # < and > decrease or increases the segment length,
+                # ( and ) decrease or increases the rotation angle.
+                if   cmd == "F": cost += self.cost
                 elif cmd == "!": angle = -angle
                 elif cmd == "(": angle *= 1.1
                 elif cmd == ")": angle *= 0.9
                 elif cmd == "<": length *= 0.9
                 elif cmd == ">": length *= 1.1
-                self._grow(
-                    generation-1,
-                    cmd,
-                    angle,
-                    length*self.decrease,
-                    time,
-                    draw
-                )
+                if a is not None:
+                    a = eval(a, _namespace, env)
+                child = self._expand(generation-1, cmd, length*self.decrease, a, path+(i,))
+                tree.children.append((child, angle, cost))
+                tree.segments += child.segments
+                if child.duration is not None:
+                    tree.duration = cost + child.duration
+                tree.lowest = min(tree.lowest, tree.depth + child.lowest)
+                tree.depth += child.depth
 
         elif rule == "F" \
-        or (rule in self.rules and self.rules[rule] == ""):
+        or successor == []:
             # Draw segment:
             # If the rule is an F symbol or empty (e.g. in Penrose tiles).
-            # Segment length grows to its full size as time progresses.
-            self._segments += 1
-            if draw and time >= 0:
-                length = min(length, length*time)
-                if self._timed:
-                    self.segment(length, generation, time, id=self._segments)
-                else:
-                    self.segment(length, generation, None, id=self._segments)
-                _ctx.translate(0, -length)
+            tree.segments = 1
+            tree.head.append((SEGMENT, generation, length*k, 1.0, 0.0, float("-inf"), rule))
+
+        return tree
+
+    def _run(self, stream, angle, time):
+
+        """ Draws the commands in the stream that are reached in the given time.
+
+        When a segment is drawn, the LSsytem.segment() method will be called.
+        You can customize this method to create your own visualizations.
+        It takes an optional time parameter.
+
+        If you divide this parameter by LSsytem.duration() you get
+        a number between 0.0 and 1.0 you can use as an alpha value for example.
+
+        The method also has an id parameter which is a unique number
+        between 0 and LSystem.segments.
+
+        """
+
+        self._duration = stream.duration
+        for op, generation, length, a, cost, gate, rule in stream:
+            if time <= gate:
+                continue
+            t = time - cost
+            a *= angle
+            if op == SEGMENT:
+                # Segment length grows to its full size as time progresses.
+                self._segments += 1
+                if t >= 0:
+                    length = min(length, length*t)
+                    if self._timed:
+                        self.segment(length, generation, t, id=self._segments)
+                    else:
+                        self.segment(length, generation, None, id=self._segments)
+                    _ctx.translate(0, -length)
+            elif op == MOVE  : _ctx.translate(0, -min(length, length*t))
+            elif op == LEFT  : _ctx.rotate(max(-a, -a*t))
+            elif op == RIGHT : _ctx.rotate(min(+a, +a*t))
+            elif op == FLIP  : _ctx.rotate(180)
+            elif op == PUSH  : _ctx.push()
+            elif op == POP   : _ctx.pop()
+            elif op == COMMAND:
+                self.commands[rule](self, generation, rule, a, length, t)
+
+    def geometry(self, generation, time=None, angle=None):
+
+        """ Returns the segments drawn for a number of generations as a Geometry object.
+
+        The turtle is moved through the compiled system arithmetically,
+        without any transformations on the canvas.
+        The geometry is cached for each generation, angle, length and ruleset,
+        so that in an animation each frame only filters the segments by time.
+
+        """
+
+        if numpy is None:
+            raise ImportError("LSystem.geometry() requires numpy")
+        if angle is None:
+            angle = self.angle
+        key = self._key(generation) + (angle,)
+        if key in self._geometries:
+            self._geometries.move_to_end(key)
+            g = self._geometries[key]
+        else:
+            a = self._shape(self._subtree(generation), angle)[0]
+            columns = dict((f, a[:,i]) for i, f in enumerate(Turtle.fields))
+            columns["depth"] = columns["depth"].astype(numpy.int32)
+            columns["id"] = numpy.arange(1, len(a)+1, dtype=numpy.int32)
+            g = Geometry(**columns)
+            self._geometries[key] = g
+            while len(self._geometries) > self._streams_size:
+                self._geometries.popitem(last=False)
+        if time:
+            g = g.at(time)
+        return g
+
+    def _shape(self, tree, angle):
+
+        """ Returns the memoized geometry of a subtree at the given angle.
+
+        The geometry is relative to the turtle when it reaches the subtree,
+        i.e. at 0,0 heading up. Balanced subtrees (that pop what they push)
+        are placed with a single transformation of their memoized segments.
+
+        """
+
+        key = (tree.key, angle)
+        if key in self._shapes:
+            return self._shapes[key]
+        turtle = Turtle()
+        turtle.run(tree.head, angle)
+        for child, a, cost in tree.children:
+            if child.balanced and child.segments >= 8:
+                turtle.instance(self._shape(child, angle*a), cost)
+            else:
+                turtle.run(child.commands, angle*a, cost, 0.0)
+        shape = turtle.shape()
+        if len(self._shapes) > self._shapes_size:
+            self._shapes = {}
+        self._shapes[key] = shape
+        return shape
+
+    def draw_geometry(self, x, y, generation, time=None, ease=None, leaves=True):
+
+        """ Draws a number of generations at the given position, fast.
+
+        Instead of calling LSystem.segment() for each segment,
+        all segments are drawn as lines in a single path,
+        and the default square leaves in a second path.
+        Custom segment() methods and commands are not used.
+
+        """
+
+        angle = self.angle
+        if time and ease:
+            angle = min(self.angle, self.angle * time / ease)
+        g = self.geometry(generation, time, angle)
+        if len(g) == 0:
+            return
+
+        p = _ctx.bezier(plot=False)
+        for x0, y0, x1, y1 in zip((g.x0+x).tolist(), (g.y0+y).tolist(), (g.x1+x).tolist(), (g.y1+y).tolist()):
+            p.moveto(x0, y0)
+            p.lineto(x1, y1)
+        _ctx.drawpath(p)
+
+        if leaves:
+            # The leaf square from LSystem.segment(),
+            # in local coordinates scaled by 0.65 and rotated by the heading.
+            h = numpy.radians(g.heading)
+            cos_h, sin_h = numpy.cos(h), numpy.sin(h)
+            corners = []
+            for u, v in ((-0.325, -0.975), (0.325, -0.975), (0.325, -0.325), (-0.325, -0.325)):
+                u, v = u * g.length, v * g.length
+                corners.append((x + g.x0 + u*cos_h + v*sin_h).tolist())
+                corners.append((y + g.y0 - u*sin_h + v*cos_h).tolist())
+            p = _ctx.bezier(plot=False)
+            for ax, ay, bx, by, cx, cy, dx, dy in zip(*corners):
+                p.moveto(ax, ay)
+                p.lineto(bx, by)
+                p.lineto(cx, cy)
+                p.lineto(dx, dy)
+                p.closepath()
+            _ctx.drawpath(p)
 
     def segment(self, length, generation, time=None, id=None):
 
@@ -176,12 +744,13 @@ class LSystem(object):
             self._timed = False
             time = maxsize
 
+        stream = self.compile(generation)
         mode = _ctx._transformmode
         _ctx.transform(CORNER)
         _ctx.push()
         _ctx.translate(x, y)
         self._reset()
-        self._grow(generation, self.root, angle, self.d, time, draw=True)
+        self._run(stream, angle, time)
         _ctx.pop()
         _ctx.transform(mode)
 
@@ -199,12 +768,8 @@ class LSystem(object):
         """
 
         if not time:
-            time = maxsize
-        _ctx.push()
-        self._reset()
-        self._grow(generation, self.root, self.angle, self.d, time, draw=False)
-        _ctx.pop()
-        return self._segments
+            return self._subtree(generation).segments
+        return bisect_left(self.compile(generation).gates, time)
 
     def duration(self, generation):
 
@@ -212,18 +777,17 @@ class LSystem(object):
 
         In an animation, the system will expand as time progresses.
         Each F command that draws a segment has a cost that depletes time.
-        To calculate the total amount of time for a number of generations,
-        we need to recurse through the system.
+        The total amount of time for a number of generations
+        is calculated when the rules are expanded.
         Time does not flow through the system linearly,
         it "branches" from generation to generation.
 
         """
 
-        _ctx.push()
-        self._reset()
-        self._grow(generation, self.root, self.angle, self.d, draw=False)
-        _ctx.pop()
-        return self._duration
+        tree = self._subtree(generation)
+        if tree.duration is None:
+            return 0
+        return 1 + tree.duration
 
 def lsystem(angle=20, segmentlength=40, rules={}, root=None):
 
@@ -238,6 +802,18 @@ def lsystem(angle=20, segmentlength=40, rules={}, root=None):
 
 create = lsystem
 
+def forest(tree, n, seed=0):
+
+    """ Returns a list of n copies of the given system, each with its own seed.
+
+    With stochastic rules each tree grows differently.
+    All trees share the same parsed grammar and each tree caches its own geometry,
+    so redrawing the forest in an animation only filters segments by time.
+
+    """
+
+    return [tree.copy(seed+i) for i in range(n)]
+
 ### TREE RULESETS ####################################################################################
 
 def oak(angle=20, segmentlength=40):
@@ -8,13 +8,24 @@
 
 ######################################################################################################
 
+import os
 import random
 from sys import maxsize
 from math import floor
+from hashlib import md5
 from warnings import warn
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ######################################################################################################
 
+def fade(t): return t * t * t * (t * (t * 6 - 15) + 10)
+def lerp(t, a, b): return a + t * (b - a)
+
 try:
     
     """ Attempt to load the C library which is faster.
@@ -57,8 +68,6 @@ except:
         global p
         p = [max(0, min(int(x), 512-1)) for x in a[:512]]
 
-    def fade(t): return t * t * t * (t * (t * 6 - 15) + 10)
-    def lerp(t, a, b): return a + t * (b - a)
     def grad(hash, x, y, z):
         # Convert lo 4 bits of hash code into 12 gradient directions.
         h = hash & 15
@@ -164,4 +173,123 @@ def generate(x, y=0.0, z=0.0, width=1.0, height=1.0, depth=1.0, scale=1.0):
 
     return perlin(x, y, z) * 0.5 + 0.5
 
+######################################################################################################
+
+# Precomputed noise textures, keyed by their parameters.
+# The oldest texture is evicted when the cache holds more than _texture_cache_size entries.
+_texture_cache = OrderedDict()
+_texture_cache_size = 16
+
+def _permutation(seed):
+    # A permutation array independent from the global seed() state,
+    # so that a texture only depends on its own parameters.
+    s = random.getstate()
+    random.seed(seed)
+    p = [int(random.random()*256) for i in range(256)] * 2
+    random.setstate(s)
+    return numpy.array(p, dtype=numpy.int32)
+
+def _grad(hash, x, y):
+    # Vectorized grad() for the z=0 plane.
+    h = hash & 15
+    u = numpy.where(h < 8, x, y)
+    v = numpy.where(h < 4, y, numpy.where((h == 12) | (h == 14), x, 0.0))
+    return numpy.where(h & 1, -u, u) + numpy.where(h & 2, -v, v)
+
+def _perlin2d(p, x, y, px=None, py=None):
+    # Vectorized perlin(x, y, 0) over a grid of x (columns) and y (rows).
+    # When a period px, py is given the lattice wraps around,
+    # which makes the noise seamlessly tileable.
+    X0 = numpy.floor(x).astype(numpy.int32)
+    Y0 = numpy.floor(y).astype(numpy.int32)
+    x = x - X0
+    y = y - Y0
+    X1 = X0 + 1
+    Y1 = Y0 + 1
+    if px: X0, X1 = X0 % px, X1 % px
+    if py: Y0, Y1 = Y0 % py, Y1 % py
+    X0, X1, Y0, Y1 = X0 & 255, X1 & 255, Y0 & 255, Y1 & 255
+    u = fade(x)[numpy.newaxis,:]
+    v = fade(y)[:,numpy.newaxis]
+    x = x[numpy.newaxis,:]
+    y = y[:,numpy.newaxis]
+    A = p[X0][numpy.newaxis,:]
+    B = p[X1][numpy.newaxis,:]
+    Y0 = Y0[:,numpy.newaxis]
+    Y1 = Y1[:,numpy.newaxis]
+    return lerp(v,
+        lerp(u, _grad(p[p[A+Y0]], x  , y  ),
+                _grad(p[p[B+Y0]], x-1, y  )),
+        lerp(u, _grad(p[p[A+Y1]], x  , y-1),
+                _grad(p[p[B+Y1]], x-1, y-1)))
+
+def texture(w, h, scale=1.0, octaves=1, seed=0, tileable=True, cache=None):
+
+    """ Returns a h x w float32 array of noise values between 0.0 and 1.0.
+
+    The texture covers the same pattern as generate(x, y, width=w, height=h, scale=scale),
+    with each extra octave adding detail at double the frequency and half the amplitude.
+    When tileable is True, the lattice wraps around so the texture
+    repeats seamlessly in both directions (the scale is rounded to fit a whole number of cells).
+
+    Textures are cached in memory, so animations can look values up
+    from a precomputed tile instead of calling generate() for each pixel every frame.
+    The returned array is read-only and shared between calls, copy it to modify.
+    If cache is a folder path, the texture is also stored there as a .npy file
+    and memory-mapped on subsequent runs.
+
+    """
+
+    if numpy is None:
+        raise ImportError("noise.texture() requires numpy")
+
+    w, h, octaves, seed = int(w), int(h), max(1, int(octaves)), int(seed)
+    if scale == 0: scale += 0.00000001
+    key = (w, h, float(scale), octaves, seed, bool(tileable))
+    if key in _texture_cache:
+        _texture_cache.move_to_end(key)
+        return _texture_cache[key]
+
+    path = None
+    if cache is not None:
+        name = md5(repr(key).encode("utf-8")).hexdigest()
+        path = os.path.join(cache, "noise-%s.npy" % name)
+    if path and os.path.exists(path):
+        a = numpy.load(path, mmap_mode="r")
+    else:
+        p = _permutation(seed)
+        # Number of lattice cells spanned by the texture at the first octave.
+        cells = 1.0 / abs(scale)
+        if tileable:
+            cells = max(1, int(round(cells)))
+        a = numpy.zeros((h, w), dtype=numpy.float64)
+        amplitude = 1.0
+        total = 0.0
+        for i in range(octaves):
+            f = 2 ** i
+            x = numpy.arange(w, dtype=numpy.float64) / max(w, 1) * cells * f
+            y = numpy.arange(h, dtype=numpy.float64) / max(h, 1) * cells * f
+            if tileable:
+                a += amplitude * _perlin2d(p, x, y, cells*f, cells*f)
+            else:
+                a += amplitude * _perlin2d(p, x, y)
+            total += amplitude
+            amplitude *= 0.5
+        a = (a / total * 0.5 + 0.5).astype(numpy.float32)
+        if path:
+            if not os.path.exists(cache):
+                os.makedirs(cache)
+            # Write to a temporary file first so concurrent runs never read a partial texture.
+            tmp = "%s.%s.tmp" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                numpy.save(f, a)
+            os.replace(tmp, path)
+            a = numpy.load(path, mmap_mode="r")
+        a.flags.writeable = False
+
+    _texture_cache[key] = a
+    while len(_texture_cache) > _texture_cache_size:
+        _texture_cache.popitem(last=False)
+    return a
+
 seed()
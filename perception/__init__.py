@@ -33,6 +33,7 @@ from socket import setdefaulttimeout
 from urllib.request import urlopen
 import pickle as pickle
 from random import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import wordnet
 import graph
@@ -640,36 +641,78 @@ class _index(dict):
     def _set_name(self, v):
         self._name = v
         self._file = os.path.join(INDEX, v)
+        self.clear()
         if os.path.exists(self._file):
             dict.__init__(self, pickle.load(open(self._file, 'rb'), encoding='utf-8'))
         else:
             dict.__init__(self, {})
     name = property(_get_name, _set_name)
 
-    def build(self, name, concepts=[], heuristic=None):
+    def build(self, name, concepts=[], heuristic=None, processes=None, resume=True, progress=None):
         """ Caches the shortest paths between nodes in the given set.
         Retrieves the entire online Perception database as a graph.
         Creates a pickled index file.
         By supplying different sets of concepts, different index names
         and a different heuristic we can build custom indices.
-        This proces can take some time (e.g. 30 minutes for 200 concepts on a MacBook Pro).
+        A single shortest path search from each concept finds the paths to all the others.
+        The searches are spread over a pool of processes (one per core by default,
+        processes=1 searches in this process).
+        Finished searches are kept in a partial file next to the index,
+        an interrupted build resumes from there unless resume=False.
+        The progress function is called with the number of concepts done and the total,
+        by default the progress is printed.
         """
-        self._name = name
+        if progress == None:
+            progress = lambda done, total: _build_progress(name, done, total)
         g = cluster(None, depth=None, wait=600)
         if isinstance(heuristic, cost):
             heuristic.graph = g
+        # The weighted edges (with the heuristic applied) are all a worker needs.
+        G = graph.proximity.adjacency(g, heuristic=heuristic)
+        concepts = list(concepts)
+        partial = os.path.join(INDEX, name+".partial")
+        paths = {}
+        if resume:
+            paths = _read_partial(partial, concepts)
+        elif os.path.exists(partial):
+            os.unlink(partial)
+        # The paths between each pair are searched from the concept first in the list.
+        todo = [i for i in range_(len(concepts)-1) if concepts[i] not in paths]
+        total = max(0, len(concepts)-1)
+        f = open(partial, "ab")
+        pool = None
+        try:
+            if f.tell() == 0:
+                pickle.dump(concepts, f)
+            if processes == 1 or len(todo) <= 1:
+                _build_worker(G, concepts)
+                results = (_build_paths(i) for i in todo)
+            else:
+                pool = ProcessPoolExecutor(processes, initializer=_build_worker, initargs=(G, concepts))
+                results = (future.result() for future in 
+                    as_completed([pool.submit(_build_paths, i) for i in todo]))
+            for i, p in results:
+                pickle.dump((concepts[i], p), f)
+                f.flush()
+                paths[concepts[i]] = p
+                progress(len(paths), total)
+        finally:
+            f.close()
+            if pool:
+                pool.shutdown(cancel_futures=True)
+            _build_worker(None, None)
         index = {}
         for i, concept1 in enumerate(concepts):
-            for concept2 in concepts[i+1:]:
-                path = g.shortest_path(concept1, concept2, heuristic)
-                if concept1 not in index: index[concept1] = {}
+            if concept1 not in index: index[concept1] = {}
+            for concept2, path in paths.get(concept1, {}).items():
                 if concept2 not in index: index[concept2] = {}
-                if path:
-                    index[concept1][concept2] = path[1:-1]
-                    index[concept2][concept1] = list(reversed(path[1:-1]))
-        f = open(os.path.join(INDEX, self.name), "w")
+                index[concept1][concept2] = path[1:-1]
+                index[concept2][concept1] = list(reversed(path[1:-1]))
+        f = open(os.path.join(INDEX, name), "wb")
         pickle.dump(index, f)
         f.close()
+        os.unlink(partial)
+        self.name = name
 
     def shortest_path(self, concept1, concept2):
         """ Returns the shortest path between the given concepts (or None).
@@ -703,6 +746,64 @@ class _index(dict):
 
 index = _index()
 
+def _read_partial(path, concepts):
+    """ Returns the paths from a partial index build for the given list of concepts.
+    A partial file from a build with other concepts is removed,
+    an incomplete last entry is cut off.
+    """
+    paths = {}
+    if not os.path.exists(path):
+        return paths
+    f = open(path, "rb")
+    try:
+        try:
+            header = pickle.load(f)
+        except Exception:
+            header = None
+        if header != concepts:
+            f.close()
+            os.unlink(path)
+            return paths
+        end = f.tell()
+        while True:
+            try:
+                concept, p = pickle.load(f)
+            except Exception:
+                break
+            paths[concept] = p
+            end = f.tell()
+    finally:
+        f.close()
+    f = open(path, "r+b")
+    f.truncate(end)
+    f.close()
+    return paths
+
+def _build_progress(name, done, total):
+    # Prints the progress of an index build, about every percent.
+    if done == total or done % max(1, total // 100) == 0:
+        print("index '%s': %d/%d concepts" % (name, done, total))
+
+# Index builds in worker processes get the graph adjacency and concepts once.
+_build = {}
+
+def _build_worker(G, concepts):
+    _build["G"] = G
+    _build["concepts"] = concepts
+
+def _build_paths(i):
+    """ Returns the i-th concept in the build and its shortest paths to the concepts after it.
+    """
+    G, concepts = _build["G"], _build["concepts"]
+    paths = {}
+    if concepts[i] in G:
+        targets = [c for c in concepts[i+1:] if c in G]
+        found = graph.proximity.single_source_shortest_paths(G, concepts[i], targets)
+        for concept in targets:
+            if concept in found and concept != concepts[i]:
+                paths[concept] = found[concept]
+    return i, paths
+
 def _build_properties_index():
     index.build(
         "properties",
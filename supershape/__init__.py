@@ -10,9 +10,15 @@ from plotdevice.lib import register
 _ctx = register(__name__)
 
 import sys
-from math import pi, sin, cos, pow
+from math import pi, sin, cos, pow, floor
+from collections import OrderedDict
 _range = range
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 TWOPI = pi * 2
 EPS = sys.float_info.epsilon
 
@@ -45,32 +51,118 @@ except:
             r = 1 / r
             return (r * cos(phi), r * sin(phi))
 
+try:
+
+    # A build of the C library without supercalc_array()
+    # still provides supercalc().
+    from .cSuperformula import supercalc_array
+
+except:
+
+    def supercalc_array(m, n1, n2, n3, phis):
+        # Evaluates the superformula for a list of angles at once.
+        # With NumPy, returns an (n, 2) array of x, y coordinates.
+        if numpy is None:
+            return [supercalc(m, n1, n2, n3, phi) for phi in phis]
+        phis = numpy.asarray(phis, dtype=numpy.float64)
+        with numpy.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            t1 = numpy.abs(numpy.cos(m * phis / 4)) ** n2
+            t2 = (numpy.abs(numpy.sin(m * phis / 4)) + EPS) ** n3
+            r = (t1 + t2) ** (1.0 / n1)
+            r = numpy.where(r == 0, 0.0, 1.0 / r)
+        return numpy.column_stack((r * numpy.cos(phis), r * numpy.sin(phis)))
+
+# Supershapes with a radius of 1 centered at 0,0, keyed by their parameters.
+# Animations that only change the position or size of a shape reuse the same curve.
+# The least recently used shape is evicted when the cache holds more than _cache_size entries.
+_cache = OrderedDict()
+_cache_size = 100
+
+def unit(m, n1, n2, n3, points=1000, range=TWOPI):
+    """ Returns the list of points of the supershape with radius 1 at 0,0.
+    """
+    key = (m, n1, n2, n3, points, range)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    phis = [i * range / points for i in _range(points)]
+    if numpy is not None:
+        phis = numpy.arange(points) * (range / points)
+    pts = supercalc_array(m, n1, n2, n3, phis)
+    if numpy is not None:
+        pts = numpy.asarray(pts, dtype=numpy.float64).reshape(-1, 2)
+        pts.flags.writeable = False
+    _cache[key] = pts
+    while len(_cache) > _cache_size:
+        _cache.popitem(last=False)
+    return pts
+
+def _polyline(points):
+    # Builds the path from a list of coordinates in one go,
+    # instead of a _ctx.lineto() call for each point.
+    p = _ctx.bezier(plot=False)
+    if len(points) > 0:
+        p.moveto(*points[0])
+        for x, y in points[1:]:
+            p.lineto(x, y)
+        if getattr(_ctx, "_autoclosepath", True):
+            p.closepath()
+    return p
+
+def frompoints(pts, x=0, y=0, w=1, h=1, percentage=1.0):
+    """ Returns a path from a list of unit supershape points,
+        as returned from unit(), batch() or morph().
+    """
+    pts = pts[:max(0, int(floor(len(pts)*percentage))+1)]
+    if numpy is not None:
+        pts = (numpy.asarray(pts) * (w, h) + (x, y)).tolist()
+    else:
+        pts = [(dx*w + x, dy*h + y) for dx, dy in pts]
+    return _polyline(pts)
+
 def path(x, y, w, h, m, n1, n2, n3, points=1000, percentage=1.0, range=TWOPI):
-    first = True
-    for i in _range(points):
-        if i > points*percentage:
-            continue
-        phi = i * range / points
-        dx, dy = supercalc(m, n1, n2, n3, phi)
-        dx = (dx * w) + x
-        dy = (dy * h) + y
-        if first:
-            _ctx.beginpath(dx, dy)
-            first = False
-        else:
-            _ctx.lineto(dx, dy)
-    return _ctx.endpath(draw=False)
+    return frompoints(unit(m, n1, n2, n3, points, range), x, y, w, h, percentage)
 
 def transform(path, m, n1, n2, n3, points=100, range=TWOPI):
-    first = True
-    for i in _range(points):
+    pts = []
+    for i, (dx, dy) in enumerate(unit(m, n1, n2, n3, points, range)):
         pt = path.point(float(i)/points)
-        phi = i * range / points
-        dx, dy = supercalc(m, n1, n2, n3, phi)
-        if first:
-            _ctx.beginpath(pt.x+dx, pt.y+dy)
-            first = False
-        else:
-            _ctx.lineto(pt.x+dx, pt.y+dy)
-    return _ctx.endpath(draw=False)
+        pts.append((pt.x+dx, pt.y+dy))
+    return _polyline(pts)
+
+def batch(params, points=1000, range=TWOPI):
+    """ Returns the unit supershapes for a list of (m, n1, n2, n3) parameters.
+        All the shapes are calculated in a single vectorized call,
+        the result is a (len(params), points, 2) array.
+    """
+    if numpy is None:
+        raise ImportError("supershape.batch() requires numpy")
+    params = numpy.asarray(params, dtype=numpy.float64).reshape(-1, 4)
+    m, n1, n2, n3 = [params[:,i:i+1] for i in _range(4)]
+    phis = numpy.arange(points) * (range / points)
+    with numpy.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        t1 = numpy.abs(numpy.cos(m * phis / 4)) ** n2
+        t2 = (numpy.abs(numpy.sin(m * phis / 4)) + EPS) ** n3
+        r = (t1 + t2) ** (1.0 / n1)
+        r = numpy.where(r == 0, 0.0, 1.0 / r)
+    return numpy.stack((r * numpy.cos(phis), r * numpy.sin(phis)), axis=-1)
 
+def morph(p0, p1, t, points=1000, range=TWOPI, blend=True):
+    """ Returns the unit supershape at time t (0.0-1.0) between p0 and p1.
+        Both p0 and p1 can be (m, n1, n2, n3) parameters or lists of points.
+        By default, the outlines of both shapes are blended,
+        which costs a single array operation once both are cached.
+        With blend=False, the parameters themselves are interpolated
+        and the in-between supershape is calculated.
+    """
+    if not blend:
+        m, n1, n2, n3 = [a + (b-a) * t for a, b in zip(p0, p1)]
+        return unit(m, n1, n2, n3, points, range)
+    if not hasattr(p0[0], "__len__"):
+        p0 = unit(*tuple(p0) + (points, range))
+    if not hasattr(p1[0], "__len__"):
+        p1 = unit(*tuple(p1) + (points, range))
+    if numpy is not None:
+        p0, p1 = numpy.asarray(p0), numpy.asarray(p1)
+        return p0 + (p1 - p0) * t
+    return [(x0 + (x1-x0) * t, y0 + (y1-y0) * t) for (x0, y0), (x1, y1) in zip(p0, p1)]
@@ -1,10 +1,9 @@
-from distutils.core import setup, Extension
+from setuptools import setup, Extension
+
+# Builds cSuperformula for the current Python and architecture:
+# python setup.py build_ext --inplace
 
 CFLAGS=[
-    "-DMACOSX",
-    "-DAPPLE_RUNTIME",
-    "-no-cpp-precomp",
-    "-Wno-long-double",
     "-g",
 
     # Loads of warning flags
@@ -14,26 +13,13 @@ CFLAGS=[
     "-Wmissing-declarations",
     "-Wnested-externs",
     "-Wno-long-long",
-    "-Wno-import",
-    
-    # Universal binary flags
-    "-arch", "i386",
-    "-arch", "ppc",
-    "-isysroot", "/Developer/SDKs/MacOSX10.4u.sdk",
     ]
 
-BASE_LDFLAGS = [
-    # Universal binary flags
-    "-arch", "i386",
-    "-arch", "ppc",
-    "-isysroot", "/Developer/SDKs/MacOSX10.4u.sdk",
-]
-
-cSuperformula = Extension("cSuperformula", sources = ["superformula.c"], 
-    extra_compile_args=CFLAGS, extra_link_args=BASE_LDFLAGS)
+cSuperformula = Extension("cSuperformula", sources = ["superformula.c"],
+    extra_compile_args=CFLAGS)
 
 setup (name = "supershape",
        version = "1.0",
        author = "Frederik De Bleser. Superformula by Johan Gielis.",
        description = "Library for calculating the superformula.",
-       ext_modules = [cSuperformula])
\ No newline at end of file
+       ext_modules = [cSuperformula])
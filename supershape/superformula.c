@@ -2,7 +2,7 @@
 #include <math.h>
 //#include <stdio.h>
 
-void _eval(double m,double n1,double n2,double n3,double phi,double *x,double *y)
+static void _eval(double m,double n1,double n2,double n3,double phi,double *x,double *y)
 {
     double r;
     double t1,t2;
@@ -40,37 +40,79 @@ cSuperformula_supercalc(PyObject *self, PyObject *args)
     return Py_BuildValue("dd", x, y);
 }
 
+static PyObject *
+cSuperformula_supercalc_array(PyObject *self, PyObject *args)
+{
+    double m, n1, n2, n3, phi;
+    double x, y;
+    PyObject *phis, *seq, *list, *pt;
+    Py_ssize_t i, n;
+
+    if (!PyArg_ParseTuple(args, "ddddO", &m, &n1, &n2, &n3, &phis))
+        return NULL;
+
+    seq = PySequence_Fast(phis, "phis must be a sequence of angles.");
+    if (seq == NULL)
+        return NULL;
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    list = PyList_New(n);
+    if (list == NULL) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+
+    for (i = 0; i < n; i++) {
+        phi = PyFloat_AsDouble(PySequence_Fast_GET_ITEM(seq, i));
+        if (phi == -1.0 && PyErr_Occurred()) {
+            Py_DECREF(seq);
+            Py_DECREF(list);
+            return NULL;
+        }
+        _eval(m, n1, n2, n3, phi, &x, &y);
+        pt = Py_BuildValue("dd", x, y);
+        if (pt == NULL) {
+            Py_DECREF(seq);
+            Py_DECREF(list);
+            return NULL;
+        }
+        PyList_SET_ITEM(list, i, pt);
+    }
+
+    Py_DECREF(seq);
+    return list;
+}
+
 static PyObject *SuperformulaError;
 
 static PyMethodDef SuperformulaMethods[] = {
     {"supercalc",  cSuperformula_supercalc, METH_VARARGS,
     "Supercalc."},
+    {"supercalc_array",  cSuperformula_supercalc_array, METH_VARARGS,
+    "Supercalc for a sequence of angles."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
+static struct PyModuleDef SuperformulaModule = {
+    PyModuleDef_HEAD_INIT,
+    "cSuperformula",
+    NULL,
+    -1,
+    SuperformulaMethods,
+    NULL, NULL, NULL, NULL
+};
+
 PyMODINIT_FUNC
-initcSuperformula(void)
+PyInit_cSuperformula(void)
 {
     PyObject *m;
     
-    m = Py_InitModule("cSuperformula", SuperformulaMethods);
+    m = PyModule_Create(&SuperformulaModule);
+    if (m == NULL)
+        return NULL;
     
     SuperformulaError = PyErr_NewException("cSuperformula.error", NULL, NULL);
     Py_INCREF(SuperformulaError);
     PyModule_AddObject(m, "error", SuperformulaError);
+    return m;
 }
-
-int
-main(int argc, char *argv[])
-{
-    /* Pass argv[0] to the Python interpreter */
-    Py_SetProgramName(argv[0]);
-
-    /* Initialize the Python interpreter.  Required. */
-    Py_Initialize();
-
-    /* Add a static module */
-    initcSuperformula();
-    
-    return 0;
-}
\ No newline at end of file
@@ -5,15 +5,21 @@
 # See also the SVG DOM specification: http://www.w3.org/TR/SVG/
 
 __author__    = "Tom De Smedt"
-__version__   = "1.9.4.5"
+__version__   = "1.9.5"
 __copyright__ = "Copyright (c) 2007-2009 Tom De Smedt"
 __license__   = "GPL"
 
 from . import arc
-import xml.dom.minidom as parser
+import xml.etree.ElementTree as etree
 import re
+import os
+import sys
+import pickle
+from io import BytesIO
 from hashlib import md5
-from plotdevice.gfx import RGB, MOVETO
+from math import radians, sin, cos, tan
+from plotdevice.gfx import RGB, MOVETO, LINETO, CURVETO, CLOSE, Transform, BezierPath
+from plotdevice.util import _copy_attrs
 from plotdevice.lib import register
 _ctx = register(__name__)
 
@@ -21,20 +27,27 @@ _ctx = register(__name__)
 
 class cache(dict):
 
-    """ Caches BezierPaths from parsed SVG data.
+    """ Caches the geometry of paths from parsed SVG data.
+
+    The geometry is immutable and shared:
+    loading from the cache returns a new cachedpath handle for each path,
+    which doesn't copy any points until the path is modified.
+
     """
 
     def id(self, svg):
+        if isinstance(svg, bytes):
+            svg = svg.decode('utf-8')
         return md5((str(_ctx)+svg).encode('utf-8')).digest()
 
     def save(self, id, paths):
-        self[id] = paths
+        self[id] = [Geometry(_geometry(path)) for path in paths]
 
     def load(self, id, copy=True):
         if id in self:
             if copy:
-                return [self.copypath(path) for path in self[id]]
-            return self[id]
+                return [cachedpath(g) for g in self[id]]
+            return [g.path for g in self[id]]
 
     def copypath(self, path):
         # Expand the path copy with the properties from add_color_info()
@@ -50,6 +63,245 @@ class cache(dict):
 
 _cache = cache()
 
+#--- DISK CACHE --------------------------------------------------------------------------------------
+# Parsed SVG files are stored on disk as plain geometry (path elements and colors),
+# so they open instantly the next time the script runs.
+
+# For Mac OS X, the cache is stored inside the svg library folder.
+# For Linux, it is stored in $HOME/.plotdevice-svg-cache/
+if sys.platform.startswith("darwin") \
+or sys.platform.startswith("win"):
+    CACHE_PATH = os.path.join(os.path.dirname(__file__), "cache", "")
+else:
+    CACHE_PATH = os.path.join(os.path.expanduser("~"), ".plotdevice-svg-cache", "")
+
+class diskcache:
+
+    """ Stores parsed geometry in files, keyed by SVG file path, modification time and parser version.
+    When the files take up more than size bytes, the least recently used are removed.
+    """
+
+    def __init__(self, path=CACHE_PATH, size=64*1024*1024):
+        self.path = path
+        self.size = size
+
+    def id(self, path):
+        st = os.stat(path)
+        key = "%s|%s|%s|%s" % (os.path.abspath(path), st.st_mtime, st.st_size, __version__)
+        return md5(key.encode('utf-8')).hexdigest()
+
+    def _file(self, id):
+        return os.path.join(self.path, id+".pickle")
+
+    def load(self, id):
+        try:
+            f = open(self._file(id), "rb")
+        except IOError:
+            return None
+        try:
+            geometry = pickle.load(f)
+        except Exception:
+            return None
+        finally:
+            f.close()
+        # Touch the file to mark it as recently used.
+        try: os.utime(self._file(id), None)
+        except OSError:
+            pass
+        return geometry
+
+    def save(self, id, geometry):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Write to a temporary file first,
+        # so another script never reads a half-written file.
+        tmp = self._file(id)+".%s.tmp" % os.getpid()
+        f = open(tmp, "wb")
+        pickle.dump(geometry, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, self._file(id))
+        self.evict()
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".pickle"):
+                st = os.stat(os.path.join(self.path, name))
+                files.append((st.st_mtime, st.st_size, name))
+        files.sort()
+        total = sum(size for t, size, name in files)
+        while total > self.size and len(files) > 1:
+            t, size, name = files.pop(0)
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def clear(self):
+        if os.path.exists(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith(".pickle"):
+                    os.remove(os.path.join(self.path, name))
+
+_diskcache = diskcache()
+
+#--- GEOMETRY ----------------------------------------------------------------------------------------
+# BezierPaths can't be pickled, so they are stored as tuples:
+# (elements, fill, stroke, strokewidth, closed).
+
+def _rgba(clr):
+    if clr is None:
+        return None
+    return (clr.red, clr.green, clr.blue, clr.alpha)
+
+def _geometry(path):
+
+    """ Returns the elements and color information of the path as a tuple.
+    """
+
+    elements = []
+    for pt in path:
+        if pt.cmd == CURVETO:
+            elements.append((CURVETO, pt.ctrl1.x, pt.ctrl1.y, pt.ctrl2.x, pt.ctrl2.y, pt.x, pt.y))
+        elif pt.cmd == CLOSE:
+            elements.append((CLOSE,))
+        else:
+            elements.append((pt.cmd, pt.x, pt.y))
+    return (tuple(elements), _rgba(path.fill), _rgba(path.stroke), path.strokewidth, path.closed)
+
+class Geometry(tuple):
+
+    """ The immutable (elements, fill, stroke, strokewidth, closed) of a cached path.
+    The BezierPath with the elements is created once and shared by all cachedpath handles.
+    """
+
+    def __new__(cls, geometry):
+        g = tuple.__new__(cls, geometry)
+        g._path = None
+        return g
+
+    elements    = property(lambda self: self[0])
+    fill        = property(lambda self: self[1])
+    stroke      = property(lambda self: self[2])
+    strokewidth = property(lambda self: self[3])
+    closed      = property(lambda self: self[4])
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = _bezier(self)
+        return self._path
+
+class cachedpath(BezierPath):
+
+    """ A BezierPath that shares its points with other paths parsed from the same SVG data.
+
+    Creating or copying a cachedpath doesn't copy any points.
+    The fill, stroke, strokewidth, closed and transformations (e.g. translate(), rotate())
+    belong to each cachedpath, so the same geometry can be drawn at many places.
+    The points are copied the first time they are modified (copy-on-write),
+    for example with lineto() or fit().
+
+    """
+
+    # Grob attributes are collected from the direct base classes only,
+    # so take them over from BezierPath.
+    ctxAttrs   = tuple(getattr(BezierPath, "_inherit", ()))
+    stateAttrs = tuple(getattr(BezierPath, "_state", ()))
+    opts       = tuple(getattr(BezierPath, "_opts", ()))
+
+    def __init__(self, geometry):
+        # Only the grob state (colors, transformation) comes from the context,
+        # the points come from the shared geometry.
+        super(BezierPath, self).__init__()
+        self._segment_cache = {}
+        self._fulcrum = None
+        self._needs_closure = False
+        if isinstance(geometry, cachedpath):
+            self._geometry = geometry._geometry
+            self._points = geometry._points
+            geometry._shared = True
+        else:
+            self._geometry = geometry
+            self._points = geometry.path._nsBezierPath
+        self._shared = True
+        path = self._geometry.path
+        self.fill = path.fill
+        self.stroke = path.stroke
+        self.strokewidth = path.strokewidth
+        self.closed = path.closed
+
+    def _get_points(self):
+        return self._points
+    def _set_points(self, points):
+        self._points = points
+        self._shared = False
+    _nsBezierPath = property(_get_points, _set_points)
+
+    def _unshare(self):
+        if self._shared:
+            self._points = self._points.copy()
+            self._shared = False
+
+    def copy(self):
+        p = cachedpath(self)
+        p.inherit(self)
+        p.closed = self.closed
+        return p
+
+    def inherit(self, src=None):
+        # Copy the grob state, but share the points.
+        if isinstance(src, cachedpath):
+            _copy_attrs(src, self, set(src._state).intersection(self._state) - set(["_nsBezierPath"]))
+        else:
+            BezierPath.inherit(self, src)
+
+def _copy_on_write(name):
+    method = getattr(BezierPath, name)
+    def f(self, *args, **kwargs):
+        self._unshare()
+        return method(self, *args, **kwargs)
+    f.__name__ = name
+    f.__doc__ = method.__doc__
+    setattr(cachedpath, name, f)
+
+for name in ("moveto", "lineto", "curveto", "arcto", "closepath",
+             "rect", "oval", "line", "poly", "arc", "star", "arrow", "append", "extend"):
+    if hasattr(BezierPath, name):
+        _copy_on_write(name)
+
+def _bezier(geometry):
+
+    """ Returns a BezierPath from a geometry tuple.
+    """
+
+    elements, fill, stroke, strokewidth, closed = geometry
+    p = _emit(elements)
+    _ctx.colormode(RGB, 1.0)
+    p.fill = fill and _ctx.color(*fill)
+    p.stroke = stroke and _ctx.color(*stroke)
+    p.strokewidth = strokewidth
+    p.closed = closed
+    return p
+
+def _emit(elements):
+
+    """ Returns a BezierPath with the given (cmd, x, y, ...) elements.
+    """
+
+    moveto, lineto, curveto, closepath = _ctx.moveto, _ctx.lineto, _ctx.curveto, _ctx.closepath
+    _ctx.autoclosepath(False)
+    _ctx.beginpath()
+    for pt in elements:
+        cmd = pt[0]
+        if cmd == LINETO:
+            lineto(pt[1], pt[2])
+        elif cmd == CURVETO:
+            curveto(pt[1], pt[2], pt[3], pt[4], pt[5], pt[6])
+        elif cmd == MOVETO:
+            moveto(pt[1], pt[2])
+        elif cmd == CLOSE:
+            closepath()
+    return _ctx.endpath(draw=False)
+
 #### SVG PARSER ######################################################################################
 
 def parse(svg, cached=False, _copy=True):
@@ -58,70 +310,100 @@ def parse(svg, cached=False, _copy=True):
     """
 
     if not cached:
-        dom = parser.parseString(svg)
-        paths = parse_node(dom, [])
+        paths = list(iterparse(_stream(svg)))
     else:
         id = _cache.id(svg)
         if id not in _cache:
-            dom = parser.parseString(svg)
-            _cache.save(id, parse_node(dom, []))
+            _cache.save(id, list(iterparse(_stream(svg))))
         paths = _cache.load(id, _copy)
 
     return paths
 
+def _stream(svg):
+    if isinstance(svg, str):
+        svg = svg.encode('utf-8')
+    return BytesIO(svg)
+
+def load(path, cached=True):
+
+    """ Returns the paths in the SVG file at the given path.
+
+    The file is parsed element by element, without building a DOM.
+    The geometry is cached on disk, so the next time (and the next run),
+    the file is only parsed again if it was modified.
+    Cached paths are returned as cachedpath objects that share their points.
+
+    """
+
+    if not cached:
+        return list(iterparse(path))
+
+    id = _diskcache.id(path)
+    if id not in _cache:
+        g = _diskcache.load(id)
+        if g is None:
+            g = [_geometry(p) for p in iterparse(path)]
+            _diskcache.save(id, g)
+        _cache[id] = [Geometry(p) for p in g]
+
+    return _cache.load(id)
+
 def get_attribute(element, attribute, default=0):
 
     """ Returns XML element's attribute, or default if none.
     """
 
-    a = element.getAttribute(attribute)
+    a = element.get(attribute, "")
     if a == "":
         return default
     return a
 
+def get_tag(element):
+
+    """ Returns XML element's tag name without the namespace.
+    """
+
+    return element.tag.rsplit("}", 1)[-1]
+
 #--- XML NODE ----------------------------------------------------------------------------------------
 
-def parse_node(node, paths=[], ignore=["pattern"]):
+def iterparse(source, ignore=["pattern"]):
 
-    """ Recurse the node tree and find drawable tags.
+    """ Yields a BezierPath for each drawable tag in the SVG file or file object.
 
-    Recures all the children in the node.
-    If a child is something we can draw,
-    a line, rect, oval or path,
-    parse it to a PathElement drawable with drawpath()
+    The XML is read as a stream of start and end tags.
+    When a line, rect, oval or path tag ends,
+    it is parsed to a path drawable with drawpath(),
+    and removed from the tree to keep memory use low.
 
     """
 
-    # Ignore paths in Illustrator pattern swatches etc.
-    if node.nodeType == node.ELEMENT_NODE and node.tagName in ignore:
-        return []
-
-    if node.hasChildNodes():
-        for child in node.childNodes:
-            paths = parse_node(child, paths)
-
-    if node.nodeType == node.ELEMENT_NODE:
-
-        if node.tagName == "line":
-            paths.append(parse_line(node))
-        elif node.tagName == "rect":
-            paths.append(parse_rect(node))
-        elif node.tagName == "circle":
-            paths.append(parse_circle(node))
-        elif node.tagName == "ellipse":
-            paths.append(parse_oval(node))
-        elif node.tagName == "polygon":
-            paths.append(parse_polygon(node))
-        elif node.tagName == "polyline":
-            paths.append(parse_polygon(node))
-        elif node.tagName == "path":
-            paths.append(parse_path(node))
-
-        if node.tagName in ("line", "rect", "circle", "ellipse", "polygon", "polyline", "path"):
-            paths[-1] = parse_transform(node, paths[-1])
-            paths[-1] = add_color_info(node, paths[-1])
-
-    return paths
+    # For each open element, the transformation matrix
+    # composed from its own transform attribute and those of its ancestors.
+    parents = []
+    matrices = [IDENTITY]
+    ignored = 0
+    for event, e in etree.iterparse(source, events=("start", "end")):
+        tag = get_tag(e)
+        if event == "start":
+            parents.append(e)
+            matrices.append(multiply(matrices[-1], parse_matrix(get_attribute(e, "transform", ""))))
+            # Ignore paths in Illustrator pattern swatches etc.
+            if tag in ignore:
+                ignored += 1
+            continue
+
+        parents.pop()
+        matrix = matrices.pop()
+        if tag in ignore:
+            ignored -= 1
+        elif not ignored and tag in _parsers:
+            path = _parsers[tag](e)
+            path = transform_path(path, matrix)
+            path = add_color_info(e, path)
+            yield path
+        if parents:
+            parents[-1].remove(e)
 
 #--- LINE --------------------------------------------------------------------------------------------
 
@@ -179,7 +461,7 @@ def parse_polygon(e):
         if x != "": points.append(float(x))
 
     _ctx.autoclosepath()
-    if (e.tagName == "polyline") :
+    if (get_tag(e) == "polyline") :
         _ctx.autoclosepath(False)
 
     _ctx.beginpath(points[0], points[1])
@@ -190,230 +472,270 @@ def parse_polygon(e):
 
 #--- PATH --------------------------------------------------------------------------------------------
 
-def parse_path(e):
+# A path command followed by its arguments, for example "C 10,20 30,40 50,60".
+_PATH_SEGMENT = re.compile(r"([MmZzLlHhVvCcSsQqTtAa])([^MmZzLlHhVvCcSsQqTtAa]*)")
 
-    d = get_attribute(e, "d", default="")
+# A number, for example "10", "-.5" or "1e-4".
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_PATH_NUMBER = re.compile(_NUMBER)
 
-    # Divide the path data string into segments.
-    # Each segment starts with a path command,
-    # usually followed by coordinates.
-    segments = []
-    i = 0
-    for j in range(len(d)):
-        commands = ["M", "m", "Z", "z", "L", "l", "H", "h", "V", "v", "C","c", "S", "s", "A"]
-        if d[j] in commands:
-            segments.append(d[i:j].strip())
-            i = j
-    segments.append(d[i:].strip())
-    segments.remove("")
-
-    previous_command = ""
+# The arguments of an elliptical arc: rx ry angle large-arc-flag sweep-flag x y.
+# The flags are a single 0 or 1 and can be written without separator, for example "a1,1 0 011,1".
+_PATH_ARC = re.compile(r"[\s,]*".join(["(%s)" % _NUMBER]*3 + ["([01])"]*2 + ["(%s)" % _NUMBER]*2))
 
-    # Path origin (moved by MOVETO).
-    x0 = 0
-    y0 = 0
+# The number of arguments for each path command.
+_PATH_ARGUMENTS = {
+    "M": 2, "L": 2, "T": 2,
+    "H": 1, "V": 1,
+    "C": 6,
+    "S": 4, "Q": 4,
+    "A": 7,
+    "Z": 0
+}
+
+def tokenize_path(d):
+
+    """ Yields a (command, numbers) tuple for each command in the SVG path data.
+
+    Commands with repeated arguments, for example "L 10,20 30,40",
+    yield a tuple for each set of arguments.
+    Extra pairs of coordinates after a MOVETO yield a LINETO (as in the SVG specification).
+
+    """
+
+    for command, arguments in _PATH_SEGMENT.findall(d):
+        n = _PATH_ARGUMENTS[command.upper()]
+        if n == 0:
+            yield command, ()
+            continue
+        if command in "Aa":
+            numbers = [float(x) for arc in _PATH_ARC.findall(arguments) for x in arc]
+        else:
+            numbers = [float(x) for x in _PATH_NUMBER.findall(arguments)]
+        for i in range(0, len(numbers)-n+1, n):
+            yield command, numbers[i:i+n]
+            if command == "M":
+                command = "L"
+            elif command == "m":
+                command = "l"
+
+def path_elements(d):
+
+    """ Returns a list of (cmd, x, y, ...) elements with absolute coordinates for the SVG path data.
+
+    Lines are (LINETO, x, y), curves are (CURVETO, x1, y1, x2, y2, x3, y3).
+    Quadratic curves and elliptical arcs are converted to cubic curves.
+
+    """
+
+    elements = []
+    append = elements.append
 
     # The current point in the path.
-    dx = 0
-    dy = 0
+    x = y = 0.0
 
-    # The previous second control handle.
-    dhx = 0
-    dhy = 0
+    # Path origin (moved by MOVETO).
+    x0 = y0 = 0.0
 
-    _ctx.autoclosepath(False)
-    _ctx.beginpath(0,0)
-    for segment in segments:
+    # The previous second control handle of a cubic curve (for S)
+    # and the previous control handle of a quadratic curve (for T).
+    hx = hy = None
+    qx = qy = None
 
-        command = segment[0]
+    for command, v in tokenize_path(d):
 
-        if command in ["Z", "z"]:
-            _ctx.closepath()
+        c = command.upper()
+
+        # Relative commands are an offset from the current point.
+        if command == c:
+            dx = dy = 0.0
         else:
-            # The command is a pen move, line or curve.
-            # Get the coordinates.
-            points = segment[1:].strip()
-            points = points.replace("-", ",-")
-            points = points.replace(" ", ",")
-            points = re.sub(",+", ",", points)
-            points = points.strip(",")
-            points = [float(i) for i in points.split(",")]
-
-        # Absolute MOVETO.
+            dx, dy = x, y
+
+        cubic = quadratic = None
+
+        # MOVETO.
         # Move the current point to the new coordinates.
-        if command == "M":
-            for i in range(len(points)//2):
-                _ctx.moveto(points[i*2], points[i*2+1])
-                dx = points[i*2]
-                dy = points[i*2+1]
-                x0 = dx
-                y0 = dy
-
-        # Relative MOVETO.
-        # Offset from the current point.
-        elif command == "m":
-            for i in range(len(points)//2):
-                _ctx.moveto(dx+points[i*2], dy+points[i*2+1])
-                dx += points[i*2]
-                dy += points[i*2+1]
-                x0 = dx
-                y0 = dy
-
-        # Absolute LINETO.
+        if c == "M":
+            x = x0 = dx + v[0]
+            y = y0 = dy + v[1]
+            append((MOVETO, x, y))
+
+        # LINETO.
         # Draw a line from the current point to the new coordinate.
-        elif command == "L":
-            for i in range(len(points)//2):
-                _ctx.lineto(points[i*2], points[i*2+1])
-                dx = points[i*2]
-                dy = points[i*2+1]
-
-        # Relative LINETO.
-        # Offset from the current point.
-        elif command == "l":
-            for i in range(len(points)//2):
-                _ctx.lineto(dx+points[i*2], dy+points[i*2+1])
-                dx += points[i*2]
-                dy += points[i*2+1]
-
-        # Absolute horizontal LINETO.
-        # Only the vertical coordinate is supplied.
-        elif command == "H":
-            for i in range(len(points)):
-                _ctx.lineto(points[i], dy)
-                dx = points[i]
-
-        # Relative horizontal LINETO.
-        # Offset from the current point.
-        elif command == "h":
-            for i in range(len(points)):
-                _ctx.lineto(dx+points[i], dy)
-                dx += points[i]
-
-        # Absolute vertical LINETO.
+        elif c == "L":
+            x = dx + v[0]
+            y = dy + v[1]
+            append((LINETO, x, y))
+
+        # Horizontal LINETO.
         # Only the horizontal coordinate is supplied.
-        if command == "V":
-            for i in range(len(points)):
-                _ctx.lineto(dx, points[i])
-                dy = points[i]
-
-        # Relative vertical LINETO.
-        # Offset from the current point.
-        elif command == "v":
-            for i in range(len(points)):
-                _ctx.lineto(dx, dy+points[i])
-                dy += points[i]
-
-        # Absolute CURVETO.
+        elif c == "H":
+            x = dx + v[0]
+            append((LINETO, x, y))
+
+        # Vertical LINETO.
+        # Only the vertical coordinate is supplied.
+        elif c == "V":
+            y = dy + v[0]
+            append((LINETO, x, y))
+
+        # CURVETO.
         # Draw a bezier with given control handles and destination.
-        elif command == "C":
-            for i in range(len(points)//6):
-                _ctx.curveto(points[i*6],   points[i*6+1],
-                             points[i*6+2], points[i*6+3],
-                             points[i*6+4], points[i*6+5])
-                dhx = points[i*6+2]
-                dhy = points[i*6+3]
-                dx = points[i*6+4]
-                dy = points[i*6+5]
-
-        # Relative CURVETO.
-        # Offset from the current point.
-        elif command == "c":
-            for i in range(len(points)//6):
-                _ctx.curveto(dx+points[i*6],   dy+points[i*6+1],
-                             dx+points[i*6+2], dy+points[i*6+3],
-                             dx+points[i*6+4], dy+points[i*6+5])
-                dhx = dx+points[i*6+2]
-                dhy = dy+points[i*6+3]
-                dx += points[i*6+4]
-                dy += points[i*6+5]
-
-        # Absolute reflexive CURVETO.
+        elif c == "C":
+            cubic = (dx+v[0], dy+v[1], dx+v[2], dy+v[3], dx+v[4], dy+v[5])
+
+        # Reflexive CURVETO.
         # Only the second control handle is given,
-        # the first is the reflexion of the previous handle.
-        elif command == "S":
-            for i in range(len(points)//4):
-                if previous_command not in ["C", "c", "S", "s"]:
-                    dhx = dx
-                    dhy = dy
-                else:
-                    dhx = dx-dhx
-                    dhy = dy-dhy
-                _ctx.curveto(dx+dhx, dy+dhy,
-                             points[i*4],   points[i*4+1],
-                             points[i*4+2], points[i*4+3])
-                dhx = points[i*4]
-                dhy = points[i*4+1]
-                dx = points[i*4+2]
-                dy = points[i*4+3]
-
-        # Relative reflexive CURVETO.
-        # Offset from the current point.
-        elif command == "s":
-            for i in range(len(points)//4):
-                if previous_command not in ["C", "c", "S", "s"]:
-                    dhx = dx
-                    dhy = dy
-                else:
-                    dhx = dx-dhx
-                    dhy = dy-dhy
-                _ctx.curveto(dx+dhx, dy+dhy,
-                             dx+points[i*4],   dy+points[i*4+1],
-                             dx+points[i*4+2], dy+points[i*4+3])
-                dhx = dx+points[i*4]
-                dhy = dy+points[i*4+1]
-                dx += points[i*4+2]
-                dy += points[i*4+3]
-
-        # Absolute elliptical arc.
-        elif command == "A":
-            rx, ry, phi, large_arc_flag, sweep_flag, x2, y2 = points
-            for p in arc.elliptical_arc_to(dx, dy, rx, ry, phi, large_arc_flag, sweep_flag, x2, y2):
+        # the first is the reflexion of the previous handle (or the current point).
+        elif c == "S":
+            if hx is None:
+                x1, y1 = x, y
+            else:
+                x1, y1 = 2*x-hx, 2*y-hy
+            cubic = (x1, y1, dx+v[0], dy+v[1], dx+v[2], dy+v[3])
+
+        # Quadratic CURVETO.
+        # One control handle for both ends of the curve.
+        elif c == "Q":
+            quadratic = (dx+v[0], dy+v[1], dx+v[2], dy+v[3])
+
+        # Reflexive quadratic CURVETO.
+        elif c == "T":
+            if qx is None:
+                quadratic = (x, y, dx+v[0], dy+v[1])
+            else:
+                quadratic = (2*x-qx, 2*y-qy, dx+v[0], dy+v[1])
+
+        # Elliptical arc.
+        elif c == "A":
+            rx, ry, phi, large_arc_flag, sweep_flag, x2, y2 = v
+            x2 += dx
+            y2 += dy
+            for p in arc.elliptical_arc_to(x, y, rx, ry, phi, large_arc_flag, sweep_flag, x2, y2):
                 if len(p) == 2:
-                    _ctx.lineto(*p)
+                    append((LINETO, p[0], p[1]))
                 elif len(p) == 6:
-                    _ctx.curveto(*p)
-            dx = p[-2]
-            dy = p[-1]
+                    append((CURVETO,) + tuple(p))
+            x, y = x2, y2
+
+        # CLOSEPATH.
+        # The current point moves back to the path origin.
+        elif c == "Z":
+            append((CLOSE,))
+            x, y = x0, y0
+
+        if quadratic:
+            qx, qy, x2, y2 = quadratic
+            cubic = (x + 2.0/3 * (qx-x), y + 2.0/3 * (qy-y),
+                     x2 + 2.0/3 * (qx-x2), y2 + 2.0/3 * (qy-y2),
+                     x2, y2)
+        else:
+            qx = qy = None
 
-        previous_command = command
+        if cubic:
+            append((CURVETO,) + cubic)
+            hx, hy, x, y = cubic[2:]
+        if quadratic or not cubic:
+            # S only reflects the handle of a previous C or S,
+            # after a quadratic curve it starts at the current point.
+            hx = hy = None
 
-    p = _ctx.endpath(draw=False)
-    return p
+    return elements
+
+def parse_path(e):
+
+    d = get_attribute(e, "d", default="")
+    return _emit(path_elements(d))
 
 #--- PATH TRANSFORM ----------------------------------------------------------------------------------
 
-def parse_transform(e, path):
+# A matrix is an (a, b, c, d, e, f) tuple, as in transform="matrix(a,b,c,d,e,f)":
+# x' = a*x + c*y + e
+# y' = b*x + d*y + f
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+_TRANSFORM = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+
+def multiply(m1, m2):
+
+    """ Returns the matrix that applies m2 first and then m1.
+    """
+
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1*a2 + c1*b2,
+            b1*a2 + d1*b2,
+            a1*c2 + c1*d2,
+            b1*c2 + d1*d2,
+            a1*e2 + c1*f2 + e1,
+            b1*e2 + d1*f2 + f1)
+
+def parse_matrix(t):
+
+    """ Returns the matrix for the given transform attribute.
+
+    The attribute can be a list of transformations,
+    for example "translate(10,20) rotate(45) scale(2)",
+    which are applied from right to left.
+
+    """
+
+    m = IDENTITY
+    for mode, v in _TRANSFORM.findall(t):
+        v = [float(x) for x in _PATH_NUMBER.findall(v)]
+        if mode == "matrix" and len(v) == 6:
+            m = multiply(m, tuple(v))
+        elif mode == "translate" and len(v) in (1, 2):
+            m = multiply(m, (1, 0, 0, 1, v[0], v[1] if len(v) > 1 else 0))
+        elif mode == "scale" and len(v) in (1, 2):
+            m = multiply(m, (v[0], 0, 0, v[1] if len(v) > 1 else v[0], 0, 0))
+        elif mode == "rotate" and len(v) in (1, 3):
+            a = radians(v[0])
+            r = (cos(a), sin(a), -sin(a), cos(a), 0, 0)
+            if len(v) == 3:
+                # Rotate around the given point.
+                r = multiply((1, 0, 0, 1, v[1], v[2]), multiply(r, (1, 0, 0, 1, -v[1], -v[2])))
+            m = multiply(m, r)
+        elif mode == "skewX" and len(v) == 1:
+            m = multiply(m, (1, 0, tan(radians(v[0])), 1, 0, 0))
+        elif mode == "skewY" and len(v) == 1:
+            m = multiply(m, (1, tan(radians(v[0])), 0, 1, 0, 0))
+    return m
+
+def transform_path(path, matrix):
+
+    """ Returns the path transformed by the given matrix.
+    All the points are transformed in a single call, creating one new path.
+    """
+
+    if matrix == IDENTITY:
+        return path
+    t = Transform()
+    t._set_matrix(matrix)
+    return t.transformBezierPath(path)
+
+def parse_transform(e, path, matrix=IDENTITY):
 
     """ Transform the path according to a defined matrix.
 
-    Attempts to extract a transform="matrix()|translate()" attribute.
-    Transforms the path accordingly.
+    Attempts to extract a transform attribute (matrix, translate, scale, rotate, skewX, skewY).
+    Transforms the path accordingly,
+    combined with the given matrix of the element's ancestors.
 
     """
 
-    t = get_attribute(e, "transform", default="")
-
-    for mode in ("matrix", "translate"):
-        if t.startswith(mode):
-            v = t.replace(mode, "").lstrip("(").rstrip(")")
-            v = v.replace(", ", ",").replace(" ", ",")
-            v = [float(x) for x in v.split(",")]
-            from plotdevice.gfx import Transform
-            t = Transform()
-            if mode == "matrix":
-                t._set_matrix(v)
-            elif mode == "translate":
-                t.translate(*v)
-            path = t.transformBezierPath(path)
-            break
-
-    # Transformations can also be defined as <g transform="matrix()"><path /><g>
-    # instead of <g><path transform="matrix() /></g>.
-    e = e.parentNode
-    if e and e.tagName == "g":
-        path = parse_transform(e, path)
+    return transform_path(path, multiply(matrix, parse_matrix(get_attribute(e, "transform", default=""))))
 
-    return path
+_parsers = {
+    "line"     : parse_line,
+    "rect"     : parse_rect,
+    "circle"   : parse_circle,
+    "ellipse"  : parse_oval,
+    "polygon"  : parse_polygon,
+    "polyline" : parse_polygon,
+    "path"     : parse_path
+}
 
 #--- PATH COLOR INFORMATION --------------------------------------------------------------------------
 
@@ -487,6 +809,16 @@ def add_color_info(e, path):
     return path
 
 #-----------------------------------------------------------------------------------------------------
+# 1.9.5
+# The cache stores immutable geometry, parse(cached=True) returns cachedpath objects
+# that share their points until modified, instead of copying each BezierPath.
+# Transformations are composed into one matrix down the tree, so each path is transformed once.
+# Added scale(), rotate(), skewX(), skewY() and lists of transformations.
+# parse_path() uses a regular expression tokenizer and supports the full SVG path grammar:
+# quadratic curves (Q, T), relative arcs, exponents, implicit LINETO after MOVETO.
+# Parsing streams the XML with ElementTree.iterparse() instead of building a DOM.
+# Added load() to parse a file, with a disk cache of the parsed geometry.
+
 # 1.9.4.5
 # Added default fill color and strokewidth.
 
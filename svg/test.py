@@ -57,6 +57,22 @@ class SVGTest(unittest.TestCase):
         self.assertNoFill(paths[8])
         self.assertStroke(paths[8], RED)
         self.assertStrokewidth(paths[8], 10) 
+
+    def test_reflexive_curves(self):
+        # S after a quadratic curve starts at the current point,
+        # T after a quadratic curve reflects its control handle.
+        elements = svg.path_elements("M0,0 Q10,10 20,0 S30,10 40,0")
+        self.assertEqual((svg.CURVETO, 20, 0, 30, 10, 40, 0), elements[2])
+        elements = svg.path_elements("M0,0 Q10,10 20,0 T40,0")
+        x1, y1 = elements[2][1:3]
+        self.assertAlmostEqual(20 + 2.0/3 * 10, x1)
+        self.assertAlmostEqual(2.0/3 * -10, y1)
+
+    def test_parse_matrix(self):
+        self.assertEqual((2, 0, 0, 0, 0, 0), svg.parse_matrix("scale(2, 0)"))
+        self.assertEqual((2, 0, 0, 2, 0, 0), svg.parse_matrix("scale(2)"))
+        self.assertEqual((1, 0, 0, 1, 10, 0), svg.parse_matrix("translate(10)"))
+        self.assertEqual((2, 0, 0, 2, 10, 20), svg.parse_matrix("translate(10, 20) scale(2)"))
         
     def assertFill(self, path, c):
         self.assertColorEquals(c, path.fill)        
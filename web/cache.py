@@ -1,15 +1,22 @@
 ### CACHE ############################################################################################
 # Code for caching XML-queries, HTML, images in subfolders in /cache.
-# The filenames are unique MD5-hases.
+# The filenames are unique MD5-hashes, sharded in two levels of folders
+# named after the start of the hash: /cache/html/3f/a2/3fa2...html
 
 # Authors: Frederik De Bleser, Tom De Smedt.
 # Copyright (c) 2007 Tom De Smedt.
 # See LICENSE.txt for details.
 
 import os
-import md5
+import hashlib
 import datetime
+import time
+import json
 import sys
+import threading
+import tempfile
+import atexit
+import shutil
 from glob import glob
 
 # For Mac OS X, the cache is stored inside the web library folder.
@@ -20,75 +27,388 @@ or sys.platform.startswith("win"):
 else:
     CACHE_PATH = os.path.join(os.environ['HOME'], ".nodebox-web-cache", "")
 
+# The default size of each cache subfolder in bytes,
+# and the default lifetime of cache entries in seconds (None lives forever).
+# Beyond its size, the least recently used entries in a cache are removed.
+BUDGET = 128 * 1024 * 1024
+TTL = None
+
+def _write(path, data):
+
+    # Writes to a temporary file first and then renames it,
+    # so other threads never read a half-written file.
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=folder)
+    try:
+        f = os.fdopen(fd, "wb")
+        f.write(data)
+        f.close()
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+### CACHE INDEX ######################################################################################
+
+class Index:
+
+    def __init__(self, path):
+
+        """ Keeps the size, write time and access time of each entry in a cache folder.
+
+        The index is stored as index.json in the folder.
+        When it is missing the folder is scanned once,
+        files from the old flat cache layout are moved into their shard.
+
+        """
+
+        self.path = path
+        self.file = os.path.join(path, "index.json")
+        self.entries = {}
+        self.size = 0
+        self._lock = threading.RLock()
+        self._saved = 0
+        self._dirty = False
+        self.load()
+
+    def load(self):
+
+        self._lock.acquire()
+        try:
+            try:
+                f = open(self.file)
+                try:
+                    self.entries = json.loads(f.read())
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                self.entries = self.scan()
+                self._dirty = True
+            self.size = sum(e[0] for e in self.entries.values())
+        finally:
+            self._lock.release()
+
+    def scan(self):
+
+        entries = {}
+        for f in glob(os.path.join(self.path, "*")):
+            name = os.path.basename(f)
+            if os.path.isfile(f) and len(name) > 32 and name != "index.json":
+                shard = os.path.join(self.path, name[:2], name[2:4])
+                if not os.path.exists(shard):
+                    os.makedirs(shard)
+                os.rename(f, os.path.join(shard, name))
+        for root, folders, files in os.walk(self.path):
+            for name in files:
+                if root == self.path \
+                or name.endswith(".tmp") \
+                or name.endswith(".headers"):
+                    continue
+                key = os.path.relpath(os.path.join(root, name), self.path)
+                entries[key] = self._stat(key)
+        return entries
+
+    def _stat(self, key):
+
+        # Returns [size, written, accessed] for an entry on disk.
+        path = os.path.join(self.path, key)
+        stat = os.stat(path)
+        size = stat.st_size
+        if os.path.exists(path+".headers"):
+            size += os.stat(path+".headers").st_size
+        return [size, stat.st_mtime, stat.st_mtime]
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, written=None):
+
+        """ Adds (or updates) the entry from the files on disk.
+        """
+
+        self._lock.acquire()
+        try:
+            self.discard(key)
+            entry = self._stat(key)
+            if written != None:
+                entry[1] = entry[2] = written
+            self.entries[key] = entry
+            self.size += entry[0]
+            self._dirty = True
+        finally:
+            self._lock.release()
+
+    def touch(self, key):
+
+        self._lock.acquire()
+        try:
+            if key in self.entries:
+                self.entries[key][2] = time.time()
+                self._dirty = True
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+
+        self._lock.acquire()
+        try:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[0]
+                self._dirty = True
+        finally:
+            self._lock.release()
+
+    def clear(self):
+
+        self._lock.acquire()
+        try:
+            self.entries = {}
+            self.size = 0
+            self._dirty = True
+        finally:
+            self._lock.release()
+
+    def save(self, force=False):
+
+        """ Writes the index to disk, at most once per second unless forced.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._dirty and (force or time.time() - self._saved > 1):
+                if os.path.exists(self.path):
+                    _write(self.file, json.dumps(self.entries).encode("utf-8"))
+                self._saved = time.time()
+                self._dirty = False
+        finally:
+            self._lock.release()
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def _index(path):
+    _indexes_lock.acquire()
+    try:
+        if path not in _indexes:
+            _indexes[path] = Index(path)
+        return _indexes[path]
+    finally:
+        _indexes_lock.release()
+
+def _save_indexes():
+    for index in list(_indexes.values()):
+        index.save(force=True)
+
+atexit.register(_save_indexes)
+
+### CACHE ############################################################################################
+
 class Cache:
-    
-    def __init__(self, name, type=".xml"):
-        
+
+    def __init__(self, name, type=".xml", budget=None, ttl=None):
+
         """ The cache can be used to store data downloads.
-        
+
         All of the data is stored in subfolders of the CACHE_PATH.
         Each filename is hashed to a unique md5 string.
-        
+
+        The cache holds at most budget bytes (BUDGET by default):
+        beyond that the least recently used entries are removed.
+        Entries older than ttl seconds (TTL by default) are removed too.
+
         """
-        
+
         self.path = CACHE_PATH+name
         self.type = type
-        
+        self.budget = budget
+        self.ttl = ttl
+        if self.budget == None:
+            self.budget = BUDGET
+        if self.ttl == None:
+            self.ttl = TTL
+
         if not os.path.exists(self.path):
             os.makedirs(self.path)
-        
+
+        self._index = _index(self.path)
+
     def hash(self, id):
-    
+
         """ Creates a unique filename in the cache for the id.
         """
-    
-        h = md5.new(id).hexdigest()
-        return os.path.join(self.path, h+self.type)
 
-    def write(self, id, data):
-        
-        f = open(self.hash(id), "w")
-        f.write(data)
-        f.close()
-    
-    def read(self, id):
-    
-        path = self.hash(id)
-        if os.path.exists(path):
-            f = open(path)
-            data = f.read()
-            f.close()
-            return data
+        if not isinstance(id, bytes):
+            id = str(id).encode("utf-8")
+        h = hashlib.md5(id).hexdigest()
+        return os.path.join(self.path, h[:2], h[2:4], h+self.type)
+
+    def _key(self, id):
+        return os.path.relpath(self.hash(id), self.path)
+
+    def write(self, id, data, headers=None):
+
+        """ Stores the data for the id, text or binary (e.g. images).
+        """
+
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        _write(self.hash(id), data)
+        if headers != None:
+            self.write_headers(id, headers)
         else:
+            self._index.add(self._key(id))
+        self.evict()
+
+    def write_headers(self, id, headers):
+
+        """ Stores the HTTP response headers for the id next to its data.
+
+        The headers are kept in a .headers file with the time they were stored,
+        which is also updated when a cached download is revalidated.
+
+        """
+
+        now = time.time()
+        data = json.dumps({"date": now, "headers": dict(headers)})
+        _write(self.hash(id)+".headers", data.encode("utf-8"))
+        if os.path.exists(self.hash(id)):
+            self._index.add(self._key(id), written=now)
+        self._index.save()
+
+    def headers(self, id):
+
+        """ Returns a dictionary of the stored HTTP response headers for the id.
+        """
+
+        return self._headers(id).get("headers", {})
+
+    def _headers(self, id):
+        try:
+            f = open(self.hash(id)+".headers")
+            try:
+                return json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    def stored(self, id):
+
+        """ Returns the time the id was last downloaded or revalidated.
+        """
+
+        if self.exists(id):
+            return self._index.get(self._key(id))[1]
+        return None
+
+    def read(self, id, binary=False):
+
+        """ Returns the data for the id, or None.
+
+        Text is returned as a string, with binary=True as bytes.
+
+        """
+
+        if not self.exists(id):
             return None
+        try:
+            f = open(self.hash(id), "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            self._index.discard(self._key(id))
+            return None
+        self._index.touch(self._key(id))
+        self._index.save()
+        if not binary:
+            data = data.decode("utf-8", "replace")
+        return data
 
     def exists(self, id):
 
-        return os.path.exists(self.hash(id))
-        
+        """ Returns True when the id is in the cache (and has not expired).
+
+        Entries are looked up in the index,
+        entries written by another process are added to it.
+
+        """
+
+        key = self._key(id)
+        entry = self._index.get(key)
+        if entry == None:
+            if not os.path.exists(self.hash(id)):
+                return False
+            self._index.add(key)
+            entry = self._index.get(key)
+        if self.ttl != None and time.time() - entry[1] > self.ttl:
+            self.remove(id)
+            return False
+        return True
+
     def age(self, id):
-        
+
         """ Returns the age of the cache entry, in days.
         """
-        
-        path = self.hash(id)
-        if os.path.exists(path):
-            modified = datetime.datetime.fromtimestamp(os.stat(path)[8])
+
+        if self.exists(id):
+            modified = datetime.datetime.fromtimestamp(self._index.get(self._key(id))[1])
             age = datetime.datetime.today() - modified
             return age.days
         else:
             return 0
-            
+
     def remove(self, id):
-        
+
         path = self.hash(id)
-        if os.path.exists(path):
-            os.unlink(path)
-            
+        for f in (path, path+".headers"):
+            if os.path.exists(f):
+                os.unlink(f)
+        self._index.discard(self._key(id))
+        self._index.save()
+
+    def evict(self):
+
+        """ Removes expired entries, then the least recently used until the cache fits its budget.
+        """
+
+        index = self._index
+        index._lock.acquire()
+        try:
+            now = time.time()
+            expired = []
+            if self.ttl != None:
+                expired = [k for k, e in index.entries.items() if now - e[1] > self.ttl]
+            lru = []
+            if index.size > self.budget:
+                lru = sorted(index.entries.keys(), key=lambda k: index.entries[k][2])
+            size = index.size
+            for key in expired + lru:
+                if size <= self.budget and key not in expired:
+                    break
+                if key in index.entries:
+                    size -= index.entries[key][0]
+                    path = os.path.join(self.path, key)
+                    for f in (path, path+".headers"):
+                        if os.path.exists(f):
+                            os.unlink(f)
+                    index.discard(key)
+            index.save()
+        finally:
+            index._lock.release()
+
     def clear(self):
-        
+
         for path in glob(os.path.join(self.path,"*")):
-            os.unlink(path)
-        
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        self._index.clear()
+
 #c = Cache("kuler")
-#print c.age("http://kuler.adobe.com/kuler/services/theme/getList.cfm?listType=popular")
\ No newline at end of file
+#print c.age("http://kuler.adobe.com/kuler/services/theme/getList.cfm?listType=popular")
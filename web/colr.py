@@ -101,15 +101,15 @@ class Colr(list, URLAccumulator):
         else:
             url += "tag/" + quote(q)
 
-        # Refresh cached results every day
+        # Revalidate cached results every day
         # for latest requests.
+        max_age = None
         if q == "latest":
-            if cached and Cache(cache).age(url) > 0:
-                Cache(cache).remove(url)
+            max_age = 24*60*60
         if q == "random":
             Cache(cache).remove(url)
 
-        URLAccumulator.__init__(self, url, wait, asynchronous, cache, type=".xml", throttle=3)
+        URLAccumulator.__init__(self, url, wait, asynchronous, cache, type=".xml", throttle=3, max_age=max_age)
 
     def load(self, data):
 
@@ -155,13 +155,13 @@ class Kuler(list, URLAccumulator):
             url += "search/get.cfm?searchQuery="+quote(q)
             url += "&startIndex="+str(page*30)+"&itemsPerPage=30"
 
-        # Refresh cached results every day
+        # Revalidate cached results every day
         # for highest rating or popular requests.
+        max_age = None
         if q in ["popular", "rating"]:
-            if cached and Cache(cache).age(url) > 0:
-                Cache(cache).remove(url)
+            max_age = 24*60*60
 
-        URLAccumulator.__init__(self, url, wait, asynchronous, cache, type=".xml", throttle=3)
+        URLAccumulator.__init__(self, url, wait, asynchronous, cache, type=".xml", throttle=3, max_age=max_age)
 
     def load(self, data):
 
@@ -112,11 +112,8 @@ class NewsfeedDownload(Newsfeed, URLAccumulator):
         else:
             cache = None
             
-        # Refresh cached news results every day.
-        if cached and Cache(cache).age(url) > 0:
-            Cache(cache).remove(url)
-            
-        URLAccumulator.__init__(self, url, wait, asynchronous, cache, ".xml")
+        # Revalidate cached news results every day.
+        URLAccumulator.__init__(self, url, wait, asynchronous, cache, ".xml", max_age=24*60*60)
 
     def load(self, data):
         
@@ -65,7 +65,7 @@ class UrbanDictionary(list):
         # For cached queries,
         # unpack the pickled version in the cache.
         else:
-            definitions = cache.read(q)
+            definitions = cache.read(q, binary=True)
             definitions = pickle.loads(definitions)
             for item in definitions:
                 ubd = UrbanDictionaryDefinition(
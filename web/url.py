@@ -8,7 +8,10 @@
 
 import os
 import socket, urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse, urllib.parse
-import _thread, time
+import http.client, io, base64, threading
+import asyncio, concurrent.futures
+import time
+from email.utils import parsedate_tz, mktime_tz
 from warnings import warn
 
 from .cache import Cache
@@ -28,8 +31,13 @@ class URLTimeout(URLError):
     # URL took to long to load.
     def __str__(self): return str(self.__class__)  
 
+class URLConnectionError(URLError):
+    # No connection to the server, or the connection was dropped.
+    def __str__(self): return str(self.__class__)  
+
 class HTTPError(URLError):
-    # Error on server.
+    # Error on server, status is the HTTP status code.
+    def __init__(self, status=None): self.status = status
     def __str__(self): return str(self.__class__)  
 
 class HTTP401Authentication(HTTPError):
@@ -178,49 +186,215 @@ def set_proxy(host, type="https"):
     else:
         PROXY = None
 
-def open(url, wait=10):
+MAX_REDIRECTS = 5
+
+# Requests with these methods can safely be sent again after an error.
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
+class ConnectionPool:
+    
+    def __init__(self, size=4):
+        
+        """ Keeps HTTP connections open so they can be reused (keep-alive).
+        
+        Idle connections are stored per protocol, host and port (and proxy).
+        A connection is only returned to the pool once its response is read,
+        at most size idle connections are kept for each host.
+        
+        """
+        
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+    
+    def _connect(self, protocol, host, port, wait):
+        
+        # Requests for the proxy's protocol are sent to the proxy.
+        # HTTPS is tunneled through it, HTTP uses the absolute url as path.
+        if PROXY and PROXY[1] == protocol:
+            proxy = urllib.parse.urlsplit("//"+PROXY[0].split("://")[-1])
+            if protocol == "https":
+                connection = http.client.HTTPSConnection(proxy.hostname, proxy.port, timeout=wait)
+                connection.set_tunnel(host, port)
+            else:
+                connection = http.client.HTTPConnection(proxy.hostname, proxy.port, timeout=wait)
+            return connection
+        if protocol == "https":
+            return http.client.HTTPSConnection(host, port, timeout=wait)
+        return http.client.HTTPConnection(host, port, timeout=wait)
+    
+    def request(self, protocol, host, port, method, path, body=None, headers={}, wait=10):
+        
+        """ Sends a request over a pooled connection, returns (response, data).
+        
+        A reused connection may have been closed by the server in the meantime,
+        in that case the request is sent once more over a fresh connection.
+        Requests that are not idempotent (e.g. POST) are never sent twice,
+        they always go over a fresh connection.
+        
+        """
+        
+        key = (protocol, host, port, PROXY)
+        if PROXY and PROXY[1] == "http" and protocol == "http":
+            path = "http://%s%s%s" % (host, port and ":"+str(port) or "", path)
+        for attempt in range(2):
+            # Only the first attempt takes an idle connection,
+            # the retry always opens a fresh one.
+            connection = None
+            if attempt == 0 and method in IDEMPOTENT:
+                self._lock.acquire()
+                try:
+                    if len(self._idle.get(key, [])) > 0:
+                        connection = self._idle[key].pop()
+                finally:
+                    self._lock.release()
+            reused = connection != None
+            if not reused:
+                connection = self._connect(protocol, host, port, wait)
+            else:
+                connection.timeout = wait
+                if connection.sock != None:
+                    try: connection.sock.settimeout(wait)
+                    except OSError:
+                        # The socket is already closed, reconnect.
+                        connection.close()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if reused: 
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._lock.acquire()
+                try:
+                    idle = self._idle.setdefault(key, [])
+                    if len(idle) < self.size:
+                        idle.append(connection)
+                        connection = None
+                finally:
+                    self._lock.release()
+                if connection != None:
+                    connection.close()
+            return response, data
+    
+    def clear(self):
+        
+        """ Closes all idle connections.
+        """
+        
+        self._lock.acquire()
+        try:
+            for connections in list(self._idle.values()):
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+pool = ConnectionPool()
+
+class Response:
+    
+    def __init__(self, url, status, headers, data):
+        
+        """ The downloaded data for a url, read from a pooled connection.
+        
+        Behaves like the file-like object returned by urllib:
+        it has read(), info() and geturl() methods.
+        A status of 304 means the cached copy is still valid (data is empty).
+        
+        """
+        
+        self.url = url
+        self.status = self.code = status
+        self.headers = headers
+        self._data = io.BytesIO(data)
+        
+    def read(self, *args):
+        return self._data.read(*args)
+        
+    def info(self):
+        return self.headers
+        
+    def geturl(self):
+        return self.url
+
+def open(url, wait=10, headers={}):
     
     """ Returns a connection to a url which you can read().
 
     When the wait amount is exceeded, raises a URLTimeout.
     When an error occurs, raises a URLError.
     404 errors specifically return a HTTP404NotFound.
+    
+    Connections to the same host are kept open and reused.
+    Extra request headers can be given, for example If-None-Match.
 
     """
     
     # If the url is a URLParser, get any POST parameters.
     post = None
     if isinstance(url, URLParser) and url.method == "post":
-        post = urllib.parse.urlencode(url.query)
+        post = urllib.parse.urlencode(url.query).encode("utf-8")
     
     # If the url is a URLParser (or a YahooResult or something), 
     # use its string representation.
     url = str(url)
     
-    # Use urllib instead of urllib2 for local files.
+    # Use urllib for local files.
     if os.path.exists(url):
         return urllib.request.urlopen(url)
- 
-    else:
-        socket.setdefaulttimeout(wait)
-        try:
-            #connection = urllib2.urlopen(url, post)
-            request = urllib.request.Request(url, post, {"User-Agent": USER_AGENT, "Referer": REFERER})
-            if PROXY:
-                p = urllib.request.ProxyHandler({PROXY[1]: PROXY[0]})
-                o = urllib.request.build_opener(p, urllib.request.HTTPHandler)
-                urllib.request.install_opener(o)
-            connection = urllib.request.urlopen(request)
-        except urllib.error.HTTPError as e:
-            if e.code == 401: raise HTTP401Authentication
-            if e.code == 403: raise HTTP403Forbidden
-            if e.code == 404: raise HTTP404NotFound
-            raise HTTPError
-        except urllib.error.URLError as e:
-            if e.reason[0] == 36: raise URLTimeout
-            raise URLError
-
-    return connection
+    
+    h = {"User-Agent": USER_AGENT, "Referer": REFERER}
+    h.update(headers)
+    if post != None:
+        h["Content-Type"] = "application/x-www-form-urlencoded"
+    method = post != None and "POST" or "GET"
+    try:
+        for i in range(MAX_REDIRECTS+1):
+            u = urllib.parse.urlsplit(url)
+            if u.scheme not in ("http", "https") or not u.hostname:
+                raise URLError
+            if u.username != None:
+                login = "%s:%s" % (urllib.parse.unquote(u.username), urllib.parse.unquote(u.password or ""))
+                h["Authorization"] = "Basic " + base64.b64encode(login.encode("utf-8")).decode("ascii")
+            path = u.path or "/"
+            if u.query: 
+                path += "?" + u.query
+            response, data = pool.request(u.scheme, u.hostname, u.port, method, path, post, h, wait)
+            # Follow redirects, a 303 (or a redirected POST) continues with a GET.
+            location = response.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                # Credentials are not sent along to another host.
+                if urllib.parse.urlsplit(url).hostname != u.hostname:
+                    h.pop("Authorization", None)
+                if response.status == 303 \
+                or response.status in (301, 302) and method == "POST":
+                    method, post = "GET", None
+                    h.pop("Content-Type", None)
+                continue
+            break
+    except socket.timeout:
+        raise URLTimeout
+    except (socket.error, http.client.HTTPException):
+        raise URLConnectionError
+    
+    if response.status == 401: raise HTTP401Authentication(401)
+    if response.status == 403: raise HTTP403Forbidden(403)
+    if response.status == 404: raise HTTP404NotFound(404)
+    if response.status >= 400: raise HTTPError(response.status)
+    if response.status >= 300 and response.status != 304: raise HTTPError(response.status)
+
+    return Response(url, response.status, response.msg, data)
 
 #print open("http://nodebox.net")
 #print open("http:/nodebox.net")
@@ -310,16 +484,179 @@ def is_archive(url, wait=10):
 #print is_webpage("http://nodebox.net")
 #print is_archive("http://nodebox.net/code/data/media/coreimage.zip")
 
-### URLACCUMULATOR ###################################################################################
+### CACHE POLICY #####################################################################################
+
+def _header(headers, name):
+    for k, v in headers.items():
+        if k.lower() == name.lower(): 
+            return v
+    return None
 
+def is_fresh(headers, stored, max_age=None):
+    
+    """ Returns True when cached data can be used without asking the server.
+    
+    The headers are the stored response headers,
+    stored is the time the data was downloaded or last revalidated.
+    With a max_age (in seconds) cached data is fresh for that long.
+    Otherwise the Cache-Control max-age or Expires headers decide,
+    data without either stays fresh (as it always did).
+    
+    """
+    
+    age = time.time() - (stored or 0)
+    if max_age != None:
+        return age < max_age
+    for directive in (_header(headers, "Cache-Control") or "").lower().split(","):
+        directive = directive.strip()
+        if directive in ("no-cache", "no-store"):
+            return False
+        if directive.startswith("max-age="):
+            try: return age < int(directive[8:])
+            except ValueError:
+                return False
+    expires = _header(headers, "Expires")
+    if expires != None:
+        # An invalid date like "0" means the data has already expired.
+        expires = parsedate_tz(expires)
+        date = parsedate_tz(_header(headers, "Date") or "")
+        if expires == None:
+            return False
+        if date == None:
+            return time.time() < mktime_tz(expires)
+        return age < mktime_tz(expires) - mktime_tz(date)
+    return True
+
+def conditional(headers):
+    
+    """ Returns the request headers that revalidate data with the given response headers.
+    
+    The server will answer 304 Not Modified when the data hasn't changed.
+    
+    """
+    
+    h = {}
+    if _header(headers, "ETag") != None:
+        h["If-None-Match"] = _header(headers, "ETag")
+    if _header(headers, "Last-Modified") != None:
+        h["If-Modified-Since"] = _header(headers, "Last-Modified")
+    return h
+
+### FETCHER ##########################################################################################
+
+# Time of the last live request to each domain.
 urlaccumulator_throttle = {}
 
+class Fetcher:
+    
+    def __init__(self, concurrency=8, retries=2, backoff=0.5):
+        
+        """ Downloads urls concurrently on an asyncio event loop.
+        
+        The event loop runs in a background thread.
+        At most concurrency downloads happen at the same time,
+        each over a pooled connection in a worker thread.
+        Requests to a domain can be throttled: they will be spaced
+        at least throttle seconds apart (see also set_throttle()).
+        Timeouts, connection errors and server errors (5xx) are retried
+        with an exponential backoff, other errors are raised at once.
+        POST requests are never retried, they might be submitted twice.
+        
+        """
+        
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.throttles = {}
+        self._last = urlaccumulator_throttle
+        self._loop = None
+        self._executor = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+    
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._loop == None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+                self._loop = asyncio.new_event_loop()
+                t = threading.Thread(target=self._loop.run_forever)
+                t.daemon = True
+                t.start()
+        finally:
+            self._lock.release()
+        return self._loop
+    
+    def set_throttle(self, domain, seconds):
+        
+        """ Spaces all live requests to the domain at least the given seconds apart.
+        """
+        
+        self.throttles[domain] = seconds
+    
+    async def _throttled(self, domain, throttle):
+        
+        # Reserves the next free time slot for the domain and waits for it.
+        throttle = max(throttle, self.throttles.get(domain, 0))
+        if throttle > 0:
+            now = time.time()
+            t = max(now, self._last.get(domain, now - throttle) + throttle)
+            self._last[domain] = t
+            await asyncio.sleep(t - now)
+        else:
+            self._last[domain] = time.time()
+    
+    async def fetch(self, url, wait=10, headers={}, throttle=0):
+        
+        """ Returns the Response for the url, to await in the fetcher's event loop.
+        
+        The wait is the socket timeout: a download stalling for that long fails,
+        a slow download that keeps on receiving data does not.
+        
+        """
+        
+        if self._semaphore == None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        domain = URLParser(url).domain
+        retries = self.retries
+        if isinstance(url, URLParser) and url.method == "post":
+            retries = 0
+        for attempt in range(retries+1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2**(attempt-1))
+            await self._throttled(domain, throttle)
+            async with self._semaphore:
+                try:
+                    return await self._loop.run_in_executor(self._executor, open, url, wait, headers)
+                except (URLTimeout, URLConnectionError) as e:
+                    error = e
+                except HTTPError as e:
+                    if e.status == None or e.status < 500:
+                        raise
+                    error = e
+        raise error
+    
+    def submit(self, coroutine):
+        
+        """ Runs the coroutine in the event loop, returns a concurrent.futures.Future.
+        """
+        
+        return asyncio.run_coroutine_threadsafe(coroutine, self._start())
+
+fetcher = Fetcher()
+
+def set_throttle(domain, seconds):
+    fetcher.set_throttle(domain, seconds)
+
+### URLACCUMULATOR ###################################################################################
+
 class URLAccumulator:
     
-    def __init__(self, url, wait=60, asynchronous=False, cache=None, type=".html", throttle=0):
+    def __init__(self, url, wait=60, asynchronous=False, cache=None, type=".html", throttle=0, max_age=None):
         
-        """ Creates a threaded connection to a url and reads data.
+        """ Creates a connection to a url and reads data.
         
+        The download is scheduled in the fetcher's event loop.
         URLAccumulator can run asynchronously which is useful for animations.
         The done property is set to True when downloading is complete.
         The error attribute contains a URLError exception when no data is found.
@@ -328,6 +665,9 @@ class URLAccumulator:
         Downloads that resulted in an error will write an empty file to the cache,
         the data property will be an empty string but no error is logged
         when the data is read from the cache in later calls.
+        The response headers are cached with the data.
+        Cached data older than max_age seconds (or expired according to its headers)
+        is revalidated: when the server answers 304 Not Modified it is used again.
         
         URLAccumulator can be throttled.
         This ensures only a certain amount of requests to a domain
@@ -340,6 +680,7 @@ class URLAccumulator:
 
         self.url = url
         self.data = None
+        self.headers = None
         self.redirect = None
         self.error = None
 
@@ -350,11 +691,16 @@ class URLAccumulator:
             self.cached = False
             self._cache = None
         
+        # Cached data is used as long as it is fresh,
+        # otherwise it is revalidated with a conditional request.
+        self.max_age = max_age
+        self._fresh = self.cached and self._cache.exists(str(url)) \
+                      and is_fresh(self._cache.headers(str(url)), self._cache.stored(str(url)), max_age)
+        self._downloaded = False
+        self._revalidated = False
+        
         self._domain = URLParser(self.url).domain
         self._throttle = throttle
-        global urlaccumulator_throttle
-        if not self._domain in urlaccumulator_throttle:
-            urlaccumulator_throttle[self._domain] = time.time() - self._throttle
 
         self._start = time.time()
         self._wait = wait
@@ -363,35 +709,36 @@ class URLAccumulator:
  
         # Synchronous downloads wait until completed,
         # otherwise check the done property.
-        _thread.start_new_thread(self._retrieve, (self.url,))
+        self._future = fetcher.submit(self._retrieve(self.url))
         if not asynchronous:
-            while not self._done():
-                time.sleep(0.1)
+            try: self._future.result(self._wait)
+            except concurrent.futures.TimeoutError:
+                pass
+            self._done()
     
-    def _queued(self):
-
-        # Throttles live requests: 
-        # waits until the current time is greater than
-        # the time of the last request plus the throttle amount.
-        global urlaccumulator_throttle   
-        if self.cached and self._cache.exists(str(self.url)):
-            return False
-        elif time.time() < urlaccumulator_throttle[self._domain] + self._throttle:
-            return True
-        else:
-            urlaccumulator_throttle[self._domain] = time.time()
-            return False
-    
-    def _retrieve(self, url):
+    async def _retrieve(self, url):
 
         # When the url data is stored in cache, load that.
-        # Otherwise, retrieve it from the web.
-        if self.cached and self._cache.exists(str(url)):
-            self.data = self._cache.read(str(url))
+        # Otherwise, retrieve it from the web,
+        # asking the server if stale cached data is still valid.
+        if self._fresh:
+            self.data = self._cache.read(str(url), binary=True)
+            self.headers = self._cache.headers(str(url))
         else:
+            headers = {}
+            if self.cached and self._cache.exists(str(url)):
+                headers = conditional(self._cache.headers(str(url)))
             try: 
-                connection = open(url)
-                self.data = connection.read()
+                connection = await fetcher.fetch(url, self._wait, headers, self._throttle)
+                if connection.status == 304:
+                    self.headers = self._cache.headers(str(url))
+                    self.headers.update(dict(connection.info()))
+                    self.data = self._cache.read(str(url), binary=True)
+                    self._revalidated = True
+                else:
+                    self.headers = dict(connection.info())
+                    self.data = connection.read()
+                    self._downloaded = True
                 self.redirect = connection.geturl()
                 if self.redirect == str(url):
                     self.redirect = None
@@ -408,17 +755,20 @@ class URLAccumulator:
         # 2) Once uncached data is ready, stores it in cache.
         # 3) Loads the data.
         # 4) Issues a warning when an error occured.
-        if (not self._busy or time.time() >= self._start + self._wait) \
-        and not self._queued():                                           # 1
+        if not self._busy or time.time() >= self._start + self._wait:     # 1
             if self.data == None and \
                self.error == None:
                 self.data = ""
                 self.error = URLTimeout()
                 self.load(self.data)
                 self._busy = False
-            if self.cached and not self._cache.exists(str(self.url)) \
-               and self.data != None and self.data != "":                 # 2
-                self._cache.write(str(self.url), str(self.data))
+            if self.cached and self._downloaded \
+               and self.data != None and len(self.data) > 0:              # 2
+                self._cache.write(str(self.url), self.data, self.headers)
+                self._downloaded = False
+            if self.cached and self._revalidated:
+                self._cache.write_headers(str(self.url), self.headers)
+                self._revalidated = False
             if not self._loaded and self.error == None:                   # 3
                 self.load(self.data)
                 self._loaded = True
@@ -437,11 +787,34 @@ class URLAccumulator:
         
         pass
 
-def retrieve(url, wait=60, asynchronous=False, cache=None, type=".html"):
+def retrieve(url, wait=60, asynchronous=False, cache=None, type=".html", max_age=None):
     
-    ua = URLAccumulator(url, wait, asynchronous, cache, type)
+    ua = URLAccumulator(url, wait, asynchronous, cache, type, max_age=max_age)
     return ua
 
+def retrieve_many(urls, wait=60, cache=None, type=".html", throttle=0, max_age=None):
+    
+    """ Downloads the urls concurrently and yields them as they complete.
+    
+    Yields a URLAccumulator for each url, in the order the downloads finish.
+    Downloads still busy after wait seconds are yielded last, with a URLTimeout error.
+    
+    """
+    
+    pending = {}
+    for url in urls:
+        ua = URLAccumulator(url, wait, True, cache, type, throttle, max_age)
+        pending[ua._future] = ua
+    try:
+        for future in concurrent.futures.as_completed(list(pending.keys()), wait):
+            ua = pending.pop(future)
+            ua._done()
+            yield ua
+    except concurrent.futures.TimeoutError:
+        for ua in list(pending.values()):
+            ua._done()
+            yield ua
+
 #r = retrieve("http://nodebox.net")
 #print r.data
 #print r.redirect
@@ -459,6 +832,9 @@ def retrieve(url, wait=60, asynchronous=False, cache=None, type=".html"):
 #    time.sleep(0.1)
 #print r.redirect
 
+#for r in retrieve_many(["http://nodebox.net", "http://nodebox.net/code"]):
+#    print r.url, len(r.data)
+
 
 
 # XXX - should or should we not do quote_plus() somewhere in here?
\ No newline at end of file
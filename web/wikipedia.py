@@ -9,11 +9,13 @@
 # See LICENSE.txt for details.
 
 import re
+import threading
+import concurrent.futures
 from xml.dom import minidom
 from urllib.parse import quote
 
 from .url import URLAccumulator
-from .html import replace_entities, strip_tags
+from .html import replace_entities
 from .cache import Cache
 from . import mimetex
 
@@ -419,62 +421,247 @@ class WikipediaTableCell(str):
     
     def __init__(self, data):
         
-        str.__init__(self, data)
         self.properties = ""
 
+### WIKIPEDIA MARKUP TOKENIZER #######################################################################
+# Splits Wikipedia markup into (type, chunk) tokens in a single scan.
+# Joined together, the chunks are the original markup.
+# Links, templates and tables end at their balanced closing brackets,
+# so a link in an image description or a citation in a table is part of the outer token.
+# The contents of a token can be tokenized in turn.
+
+# Token types besides "text":
+# "link"      : [[Computer program|programs]], also images, categories and translations.
+# "template"  : {{cite journal | last = Einstein}}
+# "table"     : {| border="1" ... |}
+# "reference" : <ref>...</ref>, <ref name="" /> or a loose <ref> tag.
+# "url"       : [http://www.pbs.org/ Stephen Hawking's Universe]
+# "footnote"  : --REF--(1), the mark WikipediaPage leaves in place of a reference.
+# "gallery", "math", "pre", "comment", "bold", "italic", "break" (<br />), "tag" (other HTML).
+
+# The lookahead skips ahead to characters that can start a token (much faster).
+_tokens = re.compile(r"(?=[<\[{'-])(?:" + "|".join((
+    r"(?P<comment><!--.*?-->)",
+    r"(?P<reference><ref[^>]*/>|<ref(?:\s[^>]*)?>.*?</ref>|</?ref[^>]*>)",
+    r"(?P<gallery><gallery[^>]*>.*?</gallery>)",
+    r"(?P<math><math>.*?</math>)",
+    r"(?P<pre><pre[^>]*>.*?</pre>)",
+    r"(?P<break><br[^>]*>)",
+    r"(?P<tag></?[a-z][^>]*>)",
+    r"(?P<link>\[\[)",
+    r"(?P<table>\{\|)",
+    r"(?P<template>\{\{)",
+    r"(?P<url>\[(?:https?|ftp)://[^\]\n]*\])",
+    r"(?P<footnote>--REF--\([0-9]*\))",
+    r"(?P<bold>'''(?:'')?)",
+    r"(?P<italic>'')",
+)) + ")", re.DOTALL | re.I)
+
+# The light version only splits off links, comments and disambiguation templates,
+# other markup (e.g. links inside templates or references) is text.
+_light_tokens = re.compile(r"(?=[<\[{])(?:" + "|".join((
+    r"(?P<comment><!--.*?-->)",
+    r"(?P<link>\[\[)",
+    r"(?P<template>\{\{(?= {0,2}dablink))",
+)) + ")", re.DOTALL | re.I)
+
+_brackets = {
+    "link"     : ("[[", "]]", re.compile(r"\[\[|\]\]")),
+    "template" : ("{{", "}}", re.compile(r"\{\{|\}\}")),
+    # A |}} closes a template inside the table, or the table itself.
+    "table"    : ("{|", "|}", re.compile(r"\{\||\|\}\}|\|\}|\{\{|\}\}")),
+}
+
+def _pairs(markup, kind):
+
+    # Maps the start of each link or template opener to the end of its closer
+    # (-1 when it is unbalanced), matched in a single scan.
+    opener, closer, pattern = _brackets[kind]
+    pairs = {}
+    stack = []
+    for m in pattern.finditer(markup):
+        if m.group() == opener:
+            stack.append(m.start())
+        elif stack:
+            pairs[stack.pop()] = m.end()
+    for i in stack:
+        pairs[i] = -1
+    return pairs
+
+def _close(markup, i, kind, pairs=None):
+
+    # Returns the end of the token opening at i, or -1 when the brackets are unbalanced.
+    # Nested links and templates are looked up in the pairs cache of the tokenizer,
+    # otherwise each unclosed opener would scan the rest of the markup.
+    opener, closer, pattern = _brackets[kind]
+    if kind != "table":
+        if pairs != None and i in pairs.get(kind, ()):
+            return pairs[kind][i]
+        # Most links and templates have nothing nested inside.
+        j = markup.find(closer, i+2)
+        if j >= 0 and markup.find(opener, i+2, j) < 0:
+            return j + 2
+        if pairs != None:
+            if kind not in pairs:
+                pairs[kind] = _pairs(markup, kind)
+            if i in pairs[kind]:
+                return pairs[kind][i]
+    depth = 0
+    templates = 0
+    for m in pattern.finditer(markup, i):
+        s = m.group()
+        if s == opener:
+            depth += 1
+        elif kind == "table" and s == "{{":
+            templates += 1
+        elif kind == "table" and (s == "}}" or s == "|}}" and templates > 0):
+            templates = max(0, templates-1)
+        else:
+            depth -= 1
+            if depth == 0:
+                return m.start() + 2
+    return -1
+
+def tokenize(markup, light=False):
+
+    """ Yields (type, chunk) tuples for the given Wikipedia markup, in a single scan.
+
+    Unbalanced link, template and table brackets are yielded as text.
+    With light=True, only links, comments and {{dablink}} templates are yielded (faster).
+
+    """
+
+    tokens = _tokens
+    if light:
+        tokens = _light_tokens
+    pairs = {}
+    i = 0
+    n = len(markup)
+    while i < n:
+        m = tokens.search(markup, i)
+        if m == None:
+            yield ("text", markup[i:])
+            break
+        kind = m.lastgroup
+        j = m.end()
+        if kind in _brackets:
+            j = _close(markup, m.start(), kind, pairs)
+        if j < 0:
+            yield ("text", markup[i:m.end()])
+            i = m.end()
+        else:
+            if m.start() > i:
+                yield ("text", markup[i:m.start()])
+            yield (kind, markup[m.start():j])
+            i = j
+
+def _inner(kind, chunk):
+
+    # Returns the contents of a link, template, table, reference or gallery token.
+    if kind in _brackets:
+        return chunk[2:-2]
+    return chunk[chunk.find(">")+1:chunk.rfind("<")]
+
+# Link prefixes that don't point to articles, besides the language codes.
+namespaces = [
+    "category", "image", "file", "media", "special", "talk", "user", "user talk",
+    "wikipedia", "wp", "template", "help", "portal", "wiktionary", "wikt", "commons", "meta"
+]
+
+_spaces = re.compile(r"[ ]+")
+_footnote_punctuation = re.compile(r"\] ([,.\"?)])")
+
+# HTML tags that start a new line of plain text.
+_blocks = [
+    "h1", "h2", "h3", "h4", "h5", "h6", "p", "center", "blockquote",
+    "div", "table", "ul", "ol", "pre", "code", "form", "tr", "li"
+]
+
 ### WIKIPEDIAPAGE ####################################################################################
 
+# Sections of a page are parsed on first access.
+# Prefetched sections are parsed in the background by a pool of threads,
+# while the main thread goes on downloading and drawing.
+PREFETCH_THREADS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _executor():
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool == None:
+            _pool = concurrent.futures.ThreadPoolExecutor(PREFETCH_THREADS)
+        return _pool
+    finally:
+        _pool_lock.release()
+
+def _lazy(name):
+    
+    # A page section that is parsed when it is first accessed.
+    # It can be set like a normal attribute.
+    return property(
+        lambda page: page.section(name),
+        lambda page, value: page._sections.__setitem__(name, value)
+    )
+
 class WikipediaPage:
     
-    def __init__(self, title, markup, light=False, full_strip=True):
+    sections = [
+        "disambiguation", "categories", "links", "paragraphs", "images", 
+        "tables", "references", "translations", "important"
+    ]
+    
+    disambiguation = _lazy("disambiguation")
+    categories     = _lazy("categories")
+    links          = _lazy("links")
+    paragraphs     = _lazy("paragraphs")
+    images         = _lazy("images")
+    tables         = _lazy("tables")
+    references     = _lazy("references")
+    translations   = _lazy("translations")
+    important      = _lazy("important")
+    
+    def __init__(self, title, markup, light=False, full_strip=True, prefetch=[]):
         
         """ Wikipedia page parser.
         
         The expected markup is the stuff in Wikipedia's edit textarea.
-        With light=True, it will onlt parse links to other articles (which is faster).
+        With light=True, it will only parse links to other articles (which is faster).
         With full_strip=False, it will preserve some HTML markup (links, bold, italic).
         
+        Nothing is parsed up front: each section (paragraphs, tables, links, ...)
+        is parsed when it is first accessed, and then kept.
+        Sections in the prefetch list are parsed right away in a background thread.
+        
         """
         
         self.title = title
         self.markup = markup
+        self.light = light
         self.full_strip = full_strip
         
-        self.disambiguation = []
-        self.categories = []
-        self.links = []
-        
-        self.paragraphs = []
-        self.images = []
-        self.tables = []
-        self.references = []
-        self.translations = {}
-        self.important = []
+        self._sections = {}
+        self._parse_lock = threading.RLock()
         
-        # Main regular expressions used in the parser.
+        # Regular expressions for HTML converted to Wikipedia markup,
+        # and for lines in paragraphs. The rest of the markup is split by tokenize().
         self.re = {
-            "disambiguation" : r"\{\{dablink\|(.*)\}\}",
-            "category"       : r"\[\[[:]{0,1}Category:(.*?)\]\]",
-            "link"           : r"\[\[([^\:]*?)\]\]",
-            "image"          : re.compile(r"\[\[Image:[^\[]*\|.*\]\]", re.I),
-            "gallery"        : re.compile("<gallery>(.*?)</gallery>", re.DOTALL),
-            "table"          : re.compile(r"\{\|.*?\|\}", re.DOTALL),
             "html-table"     : re.compile(r"<table.*?>.*?</table>", re.DOTALL),
-            "reference"      : re.compile(r"<ref.*?>.*?</ref>", re.DOTALL),
-            "citation"       : re.compile(r"\{\{cite.*?\}\}", re.DOTALL),
-            "url"            : r"\[(http\://.*?)\]",            
             "preformatted"   : re.compile(r"<pre.*?>.*?</pre>", re.DOTALL),
-            "translation"    : r"\[\[([^\].]*?):(.*?)\]\]",
-            "bold"           : r"\'\'\'(.*?)\'\'\'",
-            "comment"        : re.compile(r"<!--.*?-->", re.DOTALL),       
+            "main"           : re.compile("^{{main", re.I),
+            "see-also"       : re.compile("^{{see {0,1}also", re.I),
+            "list"           : re.compile("^[ *#;]"),
         }
         
         # In the process of stripping references and citations from the markup,
         # they are temporarily marked by this pattern.
-        # Don't use any regex characters in it.
+        # It is the "footnote" token in tokenize().
         self.ref = "--REF--"
         
-        self.parse(light)
+        if prefetch:
+            self.prefetch(prefetch)
 
     def __unicode__(self):
         
@@ -496,6 +683,59 @@ class WikipediaPage:
     def __unicode__(self):
         return str(self).decode("utf-8")
 
+    def section(self, name):
+        
+        """ Returns the given section of the page, e.g. "paragraphs".
+        
+        The section is parsed on first access (along with the sections it needs),
+        when another thread is already parsing it we wait for the result.
+        
+        """
+        
+        try:
+            return self._sections[name]
+        except KeyError:
+            pass
+        self._parse_lock.acquire()
+        try:
+            if name not in self._sections:
+                self.parse_section(name)
+            return self._sections[name]
+        finally:
+            self._parse_lock.release()
+    
+    def parse_section(self, name):
+        
+        """ Parses the given section into the page.
+        
+        Links, categories and disambiguation come from the same scan as the other sections
+        (a light scan for a light page), so they don't depend on what was accessed first.
+        Images and translations need a full scan.
+        Paragraphs and tables are parsed together from the full scan (they link to each other),
+        paragraphs update its references. Important words exclude table titles.
+        
+        """
+        
+        if name in ("disambiguation", "categories", "links"):
+            self.scan(light=self.light)
+        elif name not in self.sections and name != "body":
+            raise KeyError(name)
+        elif self.light and name == "translations":
+            self._sections[name] = {}
+        elif self.light and name != "body":
+            self._sections[name] = []
+        elif name in ("images", "translations", "body"):
+            self.scan()
+        elif name in ("paragraphs", "references", "tables"):
+            markup, tables, bold = self.section("body")
+            self._sections["paragraphs"] = self.parse_paragraphs(markup)
+            self._sections["references"] = self._references
+            self._sections["tables"] = self.parse_tables(markup, tables)
+        elif name == "important":
+            markup, tables, bold = self.section("body")
+            self.section("tables")
+            self._sections["important"] = self.parse_important(bold)
+    
     def parse(self, light=False):
 
         """ Parses data from Wikipedia page markup.
@@ -504,38 +744,99 @@ class WikipediaPage:
         We parse it here into objects containing plain text.
         The light version parses only links to other articles, it's faster than a full parse.    
         
+        Sections are parsed lazily when accessed,
+        this parses all of them at once (again).
+        
+        """
+        
+        self.light = light
+        self._parse_lock.acquire()
+        try:
+            self._sections = {}
+            for name in self.sections:
+                self.section(name)
+        finally:
+            self._parse_lock.release()
+    
+    def prefetch(self, sections=["links", "paragraphs"]):
+        
+        """ Parses the given sections in a background thread.
+        Returns a concurrent.futures.Future for the page.
+        """
+        
+        def parse():
+            for name in sections:
+                self.section(name)
+            return self
+        
+        return _executor().submit(parse)
+    
+    def scan(self, light=False):
+        
+        """ Harvests sections from the markup in a single scan.
+        
+        The markup is tokenized.
+        Links, categories, translations, references and images are harvested from the tokens, 
+        the rest is joined into the markup for paragraphs and tables (the "body" section),
+        with references replaced by footnotes.
+        The light version only harvests links, categories and disambiguation.
+        
+        Sections that were already parsed (or set) are kept.
+        
         """
 
         markup = self.markup
         
-        self.disambiguation = self.parse_disambiguation(markup)
-        self.categories = self.parse_categories(markup)
-        self.links = self.parse_links(markup)
+        self._disambiguation = []
+        self._categories = []
+        self._links = set()
+        self._references = []
+        self._images = []
+        self._translations = {}
+        
+        if light:
+            self.parse_markup(markup, light=True)
         
-        if not light:
+        else:
         
             # Conversion of HTML markup to Wikipedia markup.
             markup = self.convert_pre(markup)
             markup = self.convert_li(markup)
             markup = self.convert_table(markup)
             markup = replace_entities(markup)
-        
-            # Harvest references from the markup
-            # and replace them by footnotes.
-            markup = markup.replace("{{Cite", "{{cite")
-            markup = re.sub("\{\{ {1,2}cite", "{{cite", markup)
-            self.references, markup = self.parse_references(markup)
-
-            # Make sure there are no legend linebreaks in image links.
-            # Then harvest images and strip them from the markup.
-            markup = re.sub("\n+(\{\{legend)", "\\1", markup)
-            self.images, markup = self.parse_images(markup)
-            self.images.extend(self.parse_gallery_images(markup))
             
-            self.paragraphs = self.parse_paragraphs(markup)
-            self.tables = self.parse_tables(markup)
-            self.translations = self.parse_translations(markup)
-            self.important = self.parse_important(markup)
+            # Keep track of where the tables are, 
+            # and of the markup between bold ''' marks on a line.
+            body = []
+            tables = []
+            bold = []
+            b = None
+            k = 0
+            for kind, chunk in tokenize(markup):
+                chunk = self.parse_token(kind, chunk)
+                if kind == "table":
+                    tables.append((k, chunk))
+                if kind == "bold":
+                    if b == None:
+                        b = []
+                    else:
+                        bold.append("".join(b))
+                        b = None
+                elif b != None:
+                    if kind == "text" and "\n" in chunk:
+                        b = None
+                    else:
+                        b.append(chunk)
+                body.append(chunk)
+                k += len(chunk)
+            
+            self._sections.setdefault("body", ("".join(body), tables, bold))
+            self._sections.setdefault("images", self._images)
+            self._sections.setdefault("translations", self._translations)
+        
+        self._sections.setdefault("disambiguation", self._disambiguation)
+        self._sections.setdefault("categories", self._categories)
+        self._sections.setdefault("links", sorted(self._links))
     
     def plain(self, markup):
         
@@ -550,87 +851,118 @@ class WikipediaPage:
         
         """
         
-        # Strip bold and italic.
-        if self.full_strip:
-            markup = markup.replace("'''", "")
-            markup = markup.replace("''", "")
-        else:
+        markup = self.plain_tokens(markup)
+        
+        # Bold and italic as HTML.
+        if not self.full_strip:
             markup = re.sub("'''([^']*?)'''", "<b>\\1</b>", markup)
             markup = re.sub("''([^']*?)''", "<i>\\1</i>", markup)
         
-        # Strip image gallery sections.
-        markup = re.sub(self.re["gallery"], "", markup)
-        
-        # Strip tables.
-        markup = re.sub(self.re["table"], "", markup)
-        markup = markup.replace("||", "")
-        markup = markup.replace("|}", "")
-        
-        # Strip links, keeping the display alias.
-        # We'll strip the ending ]] later.
-        if self.full_strip:
-            markup = re.sub(r"\[\[[^\]]*?\|", "", markup)
-        else:
-            markup = re.sub(r"\[\[([^]|]*|)\]\]", '<a href="\\1">\\1</a>', markup)
-            markup = re.sub(r"\[\[([^]|]*|)\|([^]]*)\]\]", '<a href="\\1">\\2</a>', markup)    
-
-        # Strip translations, users, etc.
-        markup = re.sub(self.re["translation"], "", markup)
-        
-        # This math TeX is not supported:
-        markup = markup.replace("\displaytyle", "")
-        markup = markup.replace("\textstyle", "")
-        markup = markup.replace("\scriptstyle", "")
-        markup = markup.replace("\scriptscriptstyle", "")
-        
-        # Before stripping [ and ] brackets,
-        # make sure they are retained inside <math></math> equations.
-        markup = re.sub("(<math>.*?)\[(.*?</math>)", "\\1MATH___OPEN\\2", markup)
-        markup = re.sub("(<math>.*?)\](.*?</math>)", "\\1MATH___CLOSE\\2", markup)
-        markup = markup.replace("[", "")
-        markup = markup.replace("]", "")
-        markup = markup.replace("MATH___OPEN", "[")
-        markup = markup.replace("MATH___CLOSE", "]")
-        
-        # a) Strip references.
-        # b) Strip <ref></ref> tags.
-        # c) Strip <ref name="" /> tags.
-        # d) Replace --REF--(12) by [12].
-        # e) Remove space between [12] and trailing punctuation .,
-        # f) Remove HTML comment <!-- -->
-        # g) Keep the Latin Extended-B template: {{latinx| }}
-        # h) Strip Middle-Earth references.
-        # i) Keep quotes: {{quote| }}
-        # j) Remove templates
-        markup = re.sub(self.re["reference"], "", markup)                  # a
-        markup = re.sub("</{0,1}ref.*?>", "", markup)                      # b
-        markup = re.sub("<ref name=\".*?\" {0,1}/>", "", markup)           # c
-        markup = re.sub(self.ref+"\(([0-9]*?)\)", "[\\1] ", markup)        # d
-        markup = re.sub("\] ([,.\"\?\)])", "]\\1", markup)                 # e
-        markup = re.sub(self.re["comment"], "", markup)                    # f
-        markup = re.sub("\{\{latinx\|(.*?)\}\}", "\\1", markup)            # g
-        markup = re.sub("\{\{ME-ref.*?\}\}", "", markup)                   # h
-        markup = re.sub("\{\{quote\|(.*?)\}\}", "\"\\1\"", markup)         # i
-        markup = re.sub(re.compile("\{\{.*?\}\}", re.DOTALL), "", markup)  # j
-        markup = markup.replace("}}", "")
-        
         # Collapse multiple spaces between words,
         # unless they appear in preformatted text.
-        markup = re.sub("<br.*?/{0,1}>", " ", markup)
+        # Remove space between [12] and trailing punctuation.
         markup = markup.split("\n")
         for i in range(len(markup)):
             if not markup[i].startswith(" "):
-                markup[i] = re.sub(r"[ ]+", " ", markup[i])
+                markup[i] = _spaces.sub(" ", markup[i])
         markup = "\n".join(markup)
         markup = markup.replace(" .", ".")
-        
-        # Strip all HTML except <math> tags.
-        if self.full_strip:
-            markup = strip_tags(markup, exclude=["math"], linebreaks=True)
+        markup = _footnote_punctuation.sub("]\\1", markup)
         
         markup = markup.strip()
         return markup
     
+    def plain_tokens(self, markup):
+        
+        """ Returns the markup with each token replaced by its plain text.
+        
+        Images, tables, galleries, references and templates are stripped,
+        links keep their display alias, <math> equations are kept as-is
+        and footnotes are replaced by [12].
+        
+        Called from plain(), and for the contents of links and templates.
+        
+        """
+        
+        s = []
+        for kind, chunk in tokenize(markup):
+            if kind == "text":
+                # Strip leftover brackets and table separators.
+                chunk = chunk.replace("[", "").replace("]", "").replace("}}", "")
+                chunk = chunk.replace("||", "").replace("|}", "")
+            elif kind == "link":
+                chunk = self.plain_link(chunk)
+            elif kind == "template":
+                chunk = self.plain_template(chunk)
+            elif kind == "url":
+                chunk = chunk[1:-1]
+            elif kind == "footnote":
+                chunk = "[" + chunk[len(self.ref)+1:-1] + "] "
+            elif kind == "math":
+                # This math TeX is not supported.
+                for style in (r"\displaystyle", r"\textstyle", r"\scriptscriptstyle", r"\scriptstyle"):
+                    chunk = chunk.replace(style, "")
+            elif kind == "break":
+                chunk = " "
+            elif kind == "tag":
+                if self.full_strip:
+                    tag = chunk.strip("</>").split(" ")[0].lower()
+                    chunk = ""
+                    if tag in _blocks:
+                        chunk = "\n"
+            elif kind == "bold" or kind == "italic":
+                if self.full_strip:
+                    chunk = ""
+            elif kind != "pre":
+                # Comments, references, tables and galleries.
+                chunk = ""
+            s.append(chunk)
+        
+        return "".join(s)
+    
+    def plain_link(self, chunk):
+        
+        """ Returns the display alias of a [[link]] token.
+
+        Images, categories and translations are stripped,
+        as are links to users, etc. without a display alias.
+        If you specified full_strip=False, links to articles become HTML links.
+
+        """
+
+        page, bar, display = chunk[2:-2].partition("|")
+        namespace, colon, name = page.lstrip(":").partition(":")
+        namespace = namespace.strip().lower()
+        if colon and namespace in languages:
+            return ""
+        if colon and namespace in namespaces \
+        and (not bar or namespace in ("category", "image", "file")):
+            return ""
+        if not bar:
+            display = page
+        display = self.plain_tokens(display)
+        if self.full_strip:
+            return display
+        else:
+            return '<a href="'+page+'">'+display+'</a>'
+    
+    def plain_template(self, chunk):
+        
+        """ Returns the plain text of a {{template}} token.
+        
+        Keeps the Latin Extended-B template: {{latinx| }}
+        and quotes: {{quote| }}, other templates are stripped.
+        
+        """
+        
+        name, bar, value = chunk[2:-2].partition("|")
+        name = name.strip().lower()
+        if name == "latinx":
+            return self.plain_tokens(value)
+        if name == "quote":
+            return "\"" + self.plain_tokens(value) + "\""
+        return ""
+    
     def convert_pre(self, markup):
         
         """ Substitutes <pre> to Wikipedia markup by adding a space at the start of a line.
@@ -671,46 +1003,244 @@ class WikipediaPage:
         
         return markup
     
-    def parse_links(self, markup):
+    def parse_markup(self, markup, light=False):
+        
+        """ Harvests data from the tokens in the markup.
+        Returns the markup that remains (see parse_token()).
+        """
+        
+        return "".join([self.parse_token(kind, chunk, light) for kind, chunk in tokenize(markup, light)])
+    
+    def parse_token(self, kind, chunk, light=False):
+        
+        """ Harvests data from a single token and returns the markup to keep in its place.
+        
+        Links, categories and translations are harvested from links,
+        references from <ref> notes, {{cite}} citations and http:// external links,
+        images from image links and galleries.
+        References are replaced by footnotes, images are removed.
+        Tables and templates are kept, with the tokens inside them harvested.
+        
+        The light version only harvests links, categories and disambiguation
+        (it only gets link, comment and dablink tokens from tokenize()).
+        
+        """
+        
+        if kind == "link":
+            return self.parse_link(chunk, light)
+        if kind == "template":
+            return self.parse_template(chunk, light)
+        if kind == "table":
+            return chunk[:2] + self.parse_markup(chunk[2:-2], light) + chunk[-2:]
+        if kind == "reference":
+            return self.parse_reference(chunk)
+        elif kind == "url":
+            return self.parse_url(chunk)
+        elif kind == "gallery":
+            for img in self.parse_gallery(chunk):
+                self._images.append(img)
+                self._links.update(img.links)
+            return ""
+        elif kind == "comment":
+            return ""
+        
+        return chunk
+    
+    def parse_link(self, chunk, light=False):
+        
+        """ Harvests a [[link]] token.
         
-        """ Returns a list of internal Wikipedia links in the markup.
-
         # A Wikipedia link looks like:
         # [[List of operating systems#Embedded | List of embedded operating systems]]
         # It does not contain a colon, this indicates images, users, languages, etc.
         
-        The return value is a list containing the first part of the link,
-        without the anchor.
-
+        Links to other articles are kept in the markup, 
+        images, categories and translations are removed.
+        
+        """
+        
+        page = chunk[2:-2]
+        namespace, colon, name = page.lstrip(":").partition(":")
+        namespace = namespace.strip().lower()
+        if not colon:
+            page = self.parse_link_page(page)
+            if page != "":
+                self._links.add(page)
+        elif namespace == "category":
+            category = name.split("|")[0].strip()
+            if not category in self._categories:
+                self._categories.append(category)
+            return ""
+        elif namespace == "image" or namespace == "file":
+            if light:
+                self.parse_markup(name, light)
+            else:
+                img = self.parse_image(chunk)
+                self._images.append(img)
+                self._links.update(img.links)
+            return ""
+        elif namespace in languages:
+            if not light:
+                self._translations[namespace] = name
+            return ""
+        elif chunk.find("[[", 2) > 0:
+            self._links.update(self.parse_links(chunk[2:-2].partition("|")[2]))
+        
+        return chunk
+    
+    def parse_link_page(self, link):
+        
+        """ Returns the first part of the link, without the anchor.
+        """
+        
+        # We don't like [[{{{1|Universe (disambiguation)}}}]]
+        if link.find("{") >= 0:
+            link = re.sub("\{{1,3}[0-9]{0,2}\|", "", link)
+            link = link.replace("{", "")
+            link = link.replace("}", "")            
+        link = link.split("|")
+        link[0] = link[0].split("#")
+        page = link[0][0].strip()
+        return page
+    
+    def parse_links(self, markup):
+        
+        """ Returns a sorted list of internal Wikipedia links in the markup.
         """
         
         links = []
-        m = re.findall(self.re["link"], markup)
-        for link in m:
-            # We don't like [[{{{1|Universe (disambiguation)}}}]]
-            if link.find("{") >= 0:
-                link = re.sub("\{{1,3}[0-9]{0,2}\|", "", link)
-                link = link.replace("{", "")
-                link = link.replace("}", "")            
-            link = link.split("|")
-            link[0] = link[0].split("#")
-            page = link[0][0].strip()
-            #anchor = u""
-            #display = u""
-            #if len(link[0]) > 1: 
-            #    anchor = link[0][1].strip()
-            #if len(link) > 1: 
-            #    display = link[1].strip()
-            if not page in links:
-                links.append(page)
-                #links[page] = WikipediaLink(page, anchor, display)
-        
-        links.sort()
+        for kind, chunk in tokenize(markup):
+            if kind == "link":
+                page = chunk[2:-2]
+                if page.find(":") < 0:
+                    page = self.parse_link_page(page)
+                    if page != "" and not page in links:
+                        links.append(page)
+                else:
+                    # Links in an image description.
+                    links.extend(self.parse_links(page.partition("|")[2]))
+            elif kind in ("template", "table", "reference", "gallery"):
+                links.extend(self.parse_links(_inner(kind, chunk)))
+        
+        links = sorted(set(links))
         return links
-
-    def parse_images(self, markup, treshold=6):
+    
+    def parse_template(self, chunk, light=False):
+        
+        """ Harvests a {{template}} token.
+        
+        Citations are replaced by a footnote, the links in them are kept.
+        A disambiguation template refers to other pages
+        with the same title but of smaller significance,
+        e.g. {{dablink|For the IEEE magazine see [[Computer (magazine)]].}}
+        
+        """
+        
+        name = chunk[2:-2].split("|")[0].strip().lower()
+        if name.startswith("cite") and not light:
+            self._links.update(self.parse_links(chunk[2:-2]))
+            return self.parse_citation(chunk)
+        if name == "dablink" and len(self._disambiguation) == 0:
+            self._disambiguation = self.parse_links(chunk[2:-2])
         
-        """ Returns a list of images found in the markup.
+        return chunk[:2] + self.parse_markup(chunk[2:-2], light) + chunk[-2:]
+    
+    def parse_footnote(self, reference):
+        
+        """ Adds the reference and returns a --REF--(1)-style footnote.
+        
+        The plain() method finally replaces (1) by [1].
+        Additional references data is gathered in
+        parse_paragraph_references() when we parse paragraphs.
+        
+        """
+        
+        self._references.append(reference)
+        return " "+self.ref+"("+str(len(self._references))+")"
+    
+    def parse_reference(self, chunk):
+        
+        """ Harvests a <ref> token.
+        
+        # A Wikipedia reference note looks like:
+        # <ref>In 1946, [[ENIAC]] consumed an estimated 174 kW. 
+        # By comparison, a typical personal computer may use around 400 W; 
+        # over four hundred times less. {{Ref harvard|kempf1961|Kempf 1961|a}}</ref>
+        
+        References can also appear in image descriptions,
+        tables and taxoboxes, so they might not always pop up in a paragraph.
+        
+        """
+        
+        reference = _inner("reference", chunk)
+        reference = re.sub("^ {0,1}cite", "{{cite", reference)
+        if reference.strip().startswith("[http://") or \
+           re.search(r"\{\{ {0,2}cite", reference, re.I):
+            # References containing a citation or url 
+            # are handled by parse_citation() and parse_url().
+            return self.parse_markup(reference)
+        
+        r = WikipediaReference()
+        r.note = self.plain(reference)
+        if r.note == "":
+            return ""
+        
+        self._links.update(self.parse_links(reference))
+        return self.parse_footnote(r)
+    
+    def parse_citation(self, chunk):
+        
+        """ Harvests a {{cite}} token.
+        
+        # A Wikipedia citation looks like:
+        # {{cite journal
+        # | last = Einstein 
+        # | first = Albert
+        # | authorlink = Albert Einstein
+        # | title = Sidelights on Relativity (Geometry and Experience) 
+        # | publisher = P. Dutton., Co 
+        # | date = 1923}}
+        
+        """
+        
+        c = chunk.replace("\n", "")
+        r = WikipediaReference()
+        for key in list(r.__dict__.keys()):
+            value = re.search("\| {0,1}"+key+"(.*?)[\|}]", c)
+            if value:
+                value = value.group(1)
+                value = value.replace("link", "")
+                value = value.strip().strip(" =[]")
+                value = self.plain(value)
+                setattr(r, key, value)
+        if r.first != "" and r.last != "":
+            r.author = r.first + " " + r.last
+        
+        return self.parse_footnote(r)
+    
+    def parse_url(self, chunk):
+        
+        """ Harvests an external link token.
+        
+        # A Wikipedia embedded url looks like:
+        # [http://www.pbs.org/wnet/hawking/html/home.html ''Stephen Hawking's Universe'']
+        
+        """
+        
+        url = chunk[1:-1]
+        r = WikipediaReference()
+        i = url.find(" ")
+        if i > 0:
+            r.url = url[:i].strip()
+            r.note = self.plain(url[i:])
+        else:
+            r.url = url.strip()
+        
+        return r.note + self.parse_footnote(r)
+    
+    def parse_image(self, chunk, treshold=6):
+        
+        """ Returns a WikipediaImage from an image link token.
         
         An image has a pathname, a description in plain text
         and a list of properties Wikipedia uses to size and place images.
@@ -724,72 +1254,40 @@ class WikipediaPage:
         
         """
         
-        images = []
-        m = re.findall(self.re["image"], markup)
-        for p in m:
-            p = self.parse_balanced_image(p)
-            img = p.split("|")
-            path = img[0].replace("[[Image:", "").strip()
+        path, bar, img = chunk[2:-2].partition("|")
+        path = path.partition(":")[2].strip()
+        description = ""
+        links = []
+        properties = []
+        if bar:
+            links = self.parse_links(img)
+            properties = self.plain(img).split("|")
             description = ""
-            links = {}
-            properties = []
-            if len(img) > 1:
-                img = "|".join(img[1:])
-                links = self.parse_links(img)
-                properties = self.plain(img).split("|")
-                description = ""
-                # Best guess: an image description is normally
-                # longer than six characters, properties like
-                # "thumb" and "right" are less than six characters.
-                if len(properties[-1]) > treshold:
-                    description = properties[-1]
-                    properties = properties[:-1]
-            img = WikipediaImage(path, description, links, properties)
-            images.append(img)
-            markup = markup.replace(p, "")
-        
-        return images, markup.strip()
-    
-    def parse_balanced_image(self, markup):
-        
-        """ Corrects Wikipedia image markup.
-
-        Images have a description inside their link markup that 
-        can contain link markup itself, make sure the outer "[" and "]" brackets 
-        delimiting the image are balanced correctly (e.g. no [[ ]] ]]).
-
-        Called from parse_images().
-
-        """
-
-        opened = 0
-        closed = 0
-        for i in range(len(markup)):
-            if markup[i] == "[": opened += 1
-            if markup[i] == "]": closed += 1
-            if opened == closed:
-                return markup[:i+1]
-                
-        return markup
+            # Best guess: an image description is normally
+            # longer than six characters, properties like
+            # "thumb" and "right" are less than six characters.
+            if len(properties[-1]) > treshold:
+                description = properties[-1]
+                properties = properties[:-1]
+        
+        return WikipediaImage(path, description, links, properties)
 
-    def parse_gallery_images(self, markup):
+    def parse_gallery(self, chunk):
         
-        """ Parses images from the <gallery></gallery> section.
+        """ Parses images from a <gallery></gallery> token.
         
         Images inside <gallery> tags do not have outer "[[" brackets.
-        Add these and then parse again.
+        Each line is an image.
         
         """
         
-        gallery = re.search(self.re["gallery"], markup)
-        if gallery:
-            gallery = gallery.group(1)
-            gallery = gallery.replace("Image:", "[[Image:")
-            gallery = gallery.replace("\n", "]]\n")
-            images, markup = self.parse_images(gallery)
-            return images
+        images = []
+        for img in _inner("gallery", chunk).split("\n"):
+            img = img.strip()
+            if img.split("|")[0].find(":") > 0:
+                images.append(self.parse_image("[["+img+"]]"))
         
-        return []
+        return images
     
     def parse_paragraph(self, markup):
         
@@ -829,7 +1327,7 @@ class WikipediaPage:
                 if not chunk.startswith("|"):
                     ch += chunk + "\n"
             if ch.strip() != "":
-                if not re.search("^[ *#;]", chunk):
+                if not self.re["list"].search(chunk):
                     ch = self.parse_paragraph_list(ch)
                     chunks.append(ch.rstrip())
                     ch = ""
@@ -940,7 +1438,7 @@ class WikipediaPage:
                 chunk = self.plain(chunk)
                 i = int(m.group(1))
                 if chunk != "":
-                    self.references[i-1].note = chunk
+                    self._references[i-1].note = chunk
             # If it's not a citation we don't have this reference yet.
             elif chunk.strip().startswith("*") \
              and chunk.find("{{cite") < 0:
@@ -949,7 +1447,7 @@ class WikipediaPage:
                 if chunk != "":
                     r = WikipediaReference()
                     r.note = chunk
-                    self.references.append(r)
+                    self._references.append(r)
     
     def parse_paragraphs(self, markup):
         
@@ -1005,7 +1503,7 @@ class WikipediaPage:
             # e.g. Main articles: Computer program and Computer programming
             # which in wiki markup would be {{main|Computer program|Computer programming}}
             # The second line corrects" {{Main|Credit (finance)}} or {{Main|Usury}}".
-            elif re.search(re.compile("^{{main", re.I), chunk):
+            elif self.re["main"].search(chunk):
                 paragraph.main = [link.strip("} ") for link in chunk.split("|")[1:]]
                 paragraph.main = [re.sub(re.compile("}}.*?{{main", re.I), "", link) 
                                   for link in paragraph.main]
@@ -1013,7 +1511,7 @@ class WikipediaPage:
             # At the bottom might be links to related articles,
             # e.g. See also: Abundance of the chemical elements
             # which in wiki markup would be {{see also|Abundance of the chemical elements}}
-            elif re.search(re.compile("^{{see {0,1}also", re.I), chunk):
+            elif self.re["see-also"].search(chunk):
                 paragraph.related = [link.strip("} ") for link in chunk.split("|")[1:]]
                 
             # Accumulate the data in this paragraph,
@@ -1074,16 +1572,18 @@ class WikipediaPage:
         
         return row
 
-    def connect_table(self, table, chunk, markup):
+    def connect_table(self, table, chunk, markup, k=None):
 
         """ Creates a link from the table to paragraph and vice versa.
         
         Finds the first heading above the table in the markup.
         This is the title of the paragraph the table belongs to.
+        k is the position of the table in the markup, if known.
         
         """
 
-        k = markup.find(chunk)
+        if k == None:
+            k = markup.find(chunk)
         i = markup.rfind("\n=", 0, k)
         j = markup.find("\n", i+1)
         paragraph_title = markup[i:j].strip().strip("= ")
@@ -1092,7 +1592,7 @@ class WikipediaPage:
                 paragraph.tables.append(table)
                 table.paragraph = paragraph
 
-    def parse_tables(self, markup):
+    def parse_tables(self, markup, chunks=None):
         
         """ Returns a list of tables in the markup.
 
@@ -1104,16 +1604,26 @@ class WikipediaPage:
         |align="right" |Cell 2 (right aligned)
         |-
         |}
+        
+        The chunks are (position, markup) for each table,
+        as found by parse(). Otherwise, the markup is tokenized.
 
         """
 
+        if chunks == None:
+            chunks = []
+            k = 0
+            for kind, chunk in tokenize(markup):
+                if kind == "table":
+                    chunks.append((k, chunk))
+                k += len(chunk)
+
         tables = []
-        m = re.findall(self.re["table"], markup)
-        for chunk in m:
+        for k, chunk in chunks:
 
             table = WikipediaTable()
             table.properties = chunk.split("\n")[0].strip("{|").strip()
-            self.connect_table(table, chunk, markup)
+            self.connect_table(table, chunk, markup, k)
                   
             # Tables start with "{|".
             # On the same line can be properties, e.g. {| border="1"
@@ -1144,175 +1654,11 @@ class WikipediaPage:
         
         return tables
 
-    def parse_references(self, markup):
-
-        """ Returns a list of references found in the markup.
-        
-        References appear inline as <ref> footnotes, 
-        http:// external links, or {{cite}} citations.
-        We replace it with (1)-style footnotes.
-        Additional references data is gathered in
-        parse_paragraph_references() when we parse paragraphs.
-        
-        References can also appear in image descriptions,
-        tables and taxoboxes, so they might not always pop up in a paragraph.
-        
-        The plain() method finally replaces (1) by [1].
-        
-        """
-    
-        references = []
-        
-        # A Wikipedia reference note looks like:
-        # <ref>In 1946, [[ENIAC]] consumed an estimated 174 kW. 
-        # By comparison, a typical personal computer may use around 400 W; 
-        # over four hundred times less. {{Ref harvard|kempf1961|Kempf 1961|a}}</ref>
-        m = re.findall(self.re["reference"], markup)
-        for reference in m:
-            reference = re.sub("<ref> {0,1}cite", "<ref>{{cite", reference)
-            if not reference.strip().startswith("[http://") and \
-               not re.search("\{\{cite", reference):
-                r = WikipediaReference()
-                r.note = self.plain(re.sub("</{0,1}ref.*?>", "", reference))
-                if r.note != "":
-                    references.append(r)
-                    p = " "+self.ref+"("+str(len(references))+")"
-                    markup = markup.replace(reference, p, 1)
-            else:
-                # References containing a citation or url 
-                # are better handled by the next patterns.
-                pass
-        
-        # A Wikipedia citation looks like:
-        # {{cite journal
-        # | last = Einstein 
-        # | first = Albert
-        # | authorlink = Albert Einstein
-        # | title = Sidelights on Relativity (Geometry and Experience) 
-        # | publisher = P. Dutton., Co 
-        # | date = 1923}}
-        m = re.findall(self.re["citation"], markup)
-        for citation in m:
-            c = citation.replace("\n", "")
-            r = WikipediaReference()
-            for key in list(r.__dict__.keys()):
-                value = re.search("\| {0,1}"+key+"(.*?)[\|}]", c)
-                if value:
-                    value = value.group(1)
-                    value = value.replace("link", "")
-                    value = value.strip().strip(" =[]")
-                    value = self.plain(value)
-                    setattr(r, key, value)
-            if r.first != "" and r.last != "":
-                r.author = r.first + " " + r.last
-            references.append(r)
-            p = " "+self.ref+"("+str(len(references))+")"
-            markup = markup.replace(citation, p, 1)
-        
-        # A Wikipedia embedded url looks like:
-        # [http://www.pbs.org/wnet/hawking/html/home.html ''Stephen Hawking's Universe'']
-        m = re.findall(self.re["url"], markup)
-        for url in m:
-            r = WikipediaReference()
-            i = url.find(" ")
-            if i > 0:
-                r.url = url[:i].strip()
-                r.note = self.plain(url[i:])
-            else:
-                r.url = url.strip()
-            references.append(r)
-            p = r.note+" "+self.ref+"("+str(len(references))+")"
-            markup = markup.replace("["+url+"]", p, 1)
-
-        # Since we parsed all citations first and then all notes and urls,
-        # the ordering will not be correct in the markup,
-        # e.g. (1) (11) (12) (2) (3).
-        sorted = []
-        m = re.findall(self.ref+"\(([0-9]*)\)", markup)
-        for i in m:
-            sorted.append(references[int(i)-1])
-            markup = markup.replace(
-                self.ref+"("+i+")", 
-                self.ref+"**("+str(len(sorted))+")"
-                )
-        markup = markup.replace(self.ref+"**", self.ref)
-        for r in references:
-            if r not in sorted:
-                sorted.append(r)
-        references = sorted
-
-        return references, markup.strip()
-                
-    def parse_categories(self, markup):
-        
-        """ Returns a list of categories the page belongs to.
-
-        # A Wikipedia category link looks like:
-        # [[Category:Computing]]
-        # This indicates the page is included in the given category.
-        # If "Category" is preceded by ":" this indicates a link to a category.
-        
-        """
-        
-        categories = []
-        m = re.findall(self.re["category"], markup)
-        for category in m:
-            category = category.split("|")
-            page = category[0].strip()
-            display = ""
-            if len(category) > 1: 
-                display = category[1].strip()
-            #if not categories.has_key(page):
-            #    categories[page] = WikipediaLink(page, u"", display)
-            if not page in categories:
-                categories.append(page)
-                
-        return categories
-    
-    def parse_translations(self, markup):
-        
-        """ Returns a dictionary of translations for the page title.
-        
-        A Wikipedia language link looks like: [[af:Rekenaar]].
-        The parser will also fetch links like "user:" and "media:"
-        but these are stripped against the dictionary of
-        Wikipedia languages.
-        
-        You can get a translated page by searching Wikipedia
-        with the appropriate language code and supplying
-        the translated title as query.
-        
-        """
-        
-        global languages
-        translations = {}
-        m = re.findall(self.re["translation"], markup)
-        for language, translation in m:
-            if language in languages:
-                translations[language] = translation
-         
-        return translations
-    
-    def parse_disambiguation(self, markup):
-        
-        """ Gets the Wikipedia disambiguation page for this article.
-        
-        A Wikipedia disambiguation link refers to other pages
-        with the same title but of smaller significance,
-        e.g. {{dablink|For the IEEE magazine see [[Computer (magazine)]].}}
-        
-        """
-        
-        m = re.search(self.re["disambiguation"], markup)
-        if m:
-            return self.parse_links(m.group(1))
-        else:
-            return []
-    
-    def parse_important(self, markup):
+    def parse_important(self, bold):
         
         """ Returns a list of words that appear in bold in the article.
         
+        The bold markup is harvested by parse().
         Things like table titles are not added to the list,
         these are probably bold because it makes the layout nice,
         not necessarily because they are important.
@@ -1321,11 +1667,10 @@ class WikipediaPage:
         
         important = []
         table_titles = [table.title for table in self.tables]
-        m = re.findall(self.re["bold"], markup)
-        for bold in m:
-            bold = self.plain(bold)
-            if not bold in table_titles:
-                important.append(bold.lower())
+        for b in bold:
+            b = self.plain(b)
+            if not b in table_titles:
+                important.append(b.lower())
         
         return important
 
@@ -1546,7 +1891,7 @@ class WikipediaSearch(WikipediaPage, URLAccumulator):
         return url
     
     def __init__(self, q, language="en", light=False, wait=10, asynchronous=False, cached=True,
-                 case_sensitive=False, full_strip=True):
+                 case_sensitive=False, full_strip=True, prefetch=[]):
         
         """ A download manager for Wikipedia pages.
         
@@ -1556,11 +1901,13 @@ class WikipediaSearch(WikipediaPage, URLAccumulator):
         
         Retrieves the latest revision.
         Redirects are handled by the Wikipedia server.
+        Sections in the prefetch list are parsed in the background once the page is loaded.
         
         """
         
         self._light = light
         self._full_strip = full_strip
+        self._prefetch = prefetch
         
         if cached: 
             cache = "wikipedia"
@@ -1586,11 +1933,27 @@ class WikipediaSearch(WikipediaPage, URLAccumulator):
                 self.error = WikipediaPageMissing()
             data = ""
 
-        WikipediaPage.__init__(self,  title, data, light=self._light, full_strip=self._full_strip)
+        WikipediaPage.__init__(self,  title, data, light=self._light, full_strip=self._full_strip, 
+                               prefetch=self._prefetch)
 
 def search(q, language="en", light=False, wait=10, asynchronous=False, cached=True, 
-           case_sensitive=False, full_strip=True):
-    return WikipediaSearch(q, language, light, wait, asynchronous, cached, case_sensitive, full_strip)
+           case_sensitive=False, full_strip=True, prefetch=[]):
+    return WikipediaSearch(q, language, light, wait, asynchronous, cached, case_sensitive, full_strip, 
+                           prefetch)
+
+def prefetch(pages, sections=["links", "paragraphs"], wait=None):
+    
+    """ Parses the given sections of many pages concurrently in a pool of threads.
+    
+    Returns the list of pages once they are parsed, 
+    or after wait seconds (the rest of the sections is then parsed on access).
+    
+    """
+    
+    pages = list(pages)
+    futures = [page.prefetch(sections) for page in pages]
+    concurrent.futures.wait(futures, wait)
+    return pages
 
 ######################################################################################################
 # Some interesting things...